@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Compare the memory used by a plain dict as _FILE_MAP with BoundedFileMap.
+
+Run from the root of the project:
+
+    DJANGO_SETTINGS_MODULE=settings python benchmarks/file_map_memory.py
+
+It simulates a site where the keys are themed assets, i.e. many distinct
+paths, plus combinations of them from {% slimall %}.
+"""
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+from django_static.templatetags.django_static import BoundedFileMap
+
+
+def deep_sizeof(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple)):
+        for each in obj:
+            size += deep_sizeof(each, seen)
+    elif isinstance(obj, BoundedFileMap):
+        size += deep_sizeof(obj._young, seen) + deep_sizeof(obj._old, seen)
+    return size
+
+
+def generate_keys(count, seed=0):
+    random.seed(seed)
+    themes = ['theme%d' % i for i in range(count // 20 + 1)]
+    names = ['reset', 'base', 'layout', 'forms', 'icons', 'print']
+    for i in range(count):
+        theme = random.choice(themes)
+        if i % 3:
+            yield u'/css/%s/%s.css' % (theme, random.choice(names))
+        else:
+            yield u';'.join(u'/css/%s/%s.css' % (theme, name)
+                            for name in random.sample(names, 3))
+
+
+def fill(file_map, count):
+    m_time = 1300000000
+    for key in generate_keys(count):
+        base, ext = os.path.splitext(key.split(';')[0])
+        file_map[key] = (u'%s.%s%s' % (base, m_time, ext), m_time)
+    return file_map
+
+
+def main(counts=(1000, 10000, 50000)):
+    print "%10s %14s %14s %14s" % ('keys', 'dict', 'unbounded', 'bounded 10k')
+    for count in counts:
+        plain = fill({}, count)
+        unbounded = fill(BoundedFileMap(), count)
+        bounded = fill(BoundedFileMap(10000), count)
+        print "%10d %13.1fK %13.1fK %13.1fK" % (
+          count,
+          deep_sizeof(plain) / 1024.0,
+          deep_sizeof(unbounded) / 1024.0,
+          deep_sizeof(bounded) / 1024.0)
+        print "%10s %s" % ('', bounded.stats())
+
+
+if __name__ == '__main__':
+    main()
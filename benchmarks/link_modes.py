@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Compare the ways DJANGO_STATIC_LINK_MODE can put unoptimized files in place.
+
+Run from the root of the project:
+
+    DJANGO_SETTINGS_MODULE=settings python benchmarks/link_modes.py [count] [directory]
+
+It creates `count` (default 10000) images of mixed sizes in a temporary
+directory (or `directory`, so you can test a particular filesystem) and then
+times publishing all of them with every mode. The mode that was actually
+used is printed too since the ones that aren't supported fall back on
+another.
+"""
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+from django_static.templatetags import django_static as _django_static
+
+# roughly what a site has: lots of small icons and some large photos
+SIZES = [(500, 40), (5000, 30), (50000, 20), (500000, 9), (2000000, 1)]
+
+
+def create_images(directory, count, seed=0):
+    random.seed(seed)
+    weighted = []
+    for size, weight in SIZES:
+        weighted.extend([size] * weight)
+    filepaths = []
+    total = 0
+    for i in range(count):
+        size = random.choice(weighted)
+        filepath = os.path.join(directory, 'image%d.png' % i)
+        with open(filepath, 'wb') as f:
+            f.write(os.urandom(size))
+        filepaths.append(filepath)
+        total += size
+    return filepaths, total
+
+
+def main(count=10000, directory=None):
+    directory = tempfile.mkdtemp(dir=directory)
+    try:
+        sources = os.path.join(directory, 'sources')
+        os.mkdir(sources)
+        filepaths, total = create_images(sources, count)
+        print "%d files, %.1f MB" % (count, total / 1024.0 / 1024)
+        modes = ['symlink', 'hardlink', 'reflink', 'copy_file_range',
+                 'sendfile', 'copy']
+        for mode in modes:
+            output = os.path.join(directory, mode)
+            os.mkdir(output)
+            used = defaultdict(int)
+            t0 = time.time()
+            for filepath in filepaths:
+                new_filepath = os.path.join(output, os.path.basename(filepath))
+                used[_django_static._publish_file(filepath, new_filepath, mode)] += 1
+            t1 = time.time()
+            print "%16s %8.3fs   %s" % (mode, t1 - t0, dict(used))
+            shutil.rmtree(output)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(args and int(args[0]) or 10000, len(args) > 1 and args[1] or None)
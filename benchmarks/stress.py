@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+"""Render cold pages in many processes and threads at the same moment and
+check that nothing breaks.
+
+Run from the root of the project:
+
+    DJANGO_SETTINGS_MODULE=settings python benchmarks/stress.py [options]
+
+It copies media/ into a temporary directory, starts --processes processes
+with --threads threads each that all wait for the same moment and then each
+render a random one of --pages pages that share most of their files. Faults
+can be injected into the workers:
+
+  --slow-optimizer SECONDS  every optimizer run sleeps this long first
+  --eexist P                with probability P making a directory fails
+                            with EEXIST (after it's been made, as if by
+                            another process)
+  --enospc P                with probability P writing a file fails half
+                            way with ENOSPC
+  --kill P                  with probability P a process is killed half way
+                            through writing the manifest
+
+Afterwards it checks that the manifest is valid JSON, that every file in it
+exists and has the right content, that no temporary files were left
+behind (except by the killed processes) and that every render either
+succeeded, failed because of an injected fault or was in a killed process,
+and that at least one succeeded. It prints a JSON report with the
+first render latencies (p50/p99), how many builds there were and how many
+of those were duplicates (the same file built more than once), and exits
+with 1 if any check failed.
+
+By default the file map is the manifest (--mode manifest). Use
+--mode memory to see how many duplicate builds each process's own file
+map causes.
+"""
+import os
+import re
+import sys
+import json
+import time
+import errno
+import random
+import signal
+import shutil
+import tempfile
+import threading
+import traceback
+import multiprocessing
+from collections import defaultdict
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+from django.conf import settings
+from django.template import Template, Context
+
+from django_static import stats
+from django_static.templatetags import django_static as _django_static
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, '..', 'media')
+
+CSS_FIXTURES = ['/css/reset.css', '/css/sub-module2.css']
+JS_FIXTURES = ['/javascript/canbe.js', '/javascript/script.js']
+IMAGE_FIXTURES = ['/images/icon1.png', '/images/icon2.png',
+                  '/images/icon3.png']
+FILES_PER_KIND = 20
+
+
+def setup_media_root():
+    media_root = tempfile.mkdtemp()
+    for each in os.listdir(FIXTURES):
+        if os.path.isdir(os.path.join(FIXTURES, each)):
+            shutil.copytree(os.path.join(FIXTURES, each),
+                            os.path.join(media_root, each))
+    files = {}
+    for kind, fixtures in (('css', CSS_FIXTURES), ('js', JS_FIXTURES),
+                           ('img', IMAGE_FIXTURES)):
+        files[kind] = []
+        for i in range(FILES_PER_KIND):
+            fixture = fixtures[i % len(fixtures)]
+            directory, basename = os.path.split(fixture)
+            filename = '%s/stress%d-%s' % (directory, i, basename)
+            shutil.copyfile(media_root + fixture, media_root + filename)
+            files[kind].append(filename)
+    return media_root, files
+
+
+def make_pages(files, count, seed=0):
+    """templates that each use a random selection of the files, both on their
+    own and in {% slimall %} combos"""
+    random.seed(seed)
+    pages = []
+    for i in range(count):
+        parts = ['{% load django_static %}']
+        for filename in random.sample(files['img'], 5):
+            parts.append('<img src="{% staticfile "' + filename + '" %}">')
+        parts.append('{% slimall %}')
+        for filename in random.sample(files['css'], 3):
+            parts.append('<link rel="stylesheet" href="%s">' % filename)
+        for filename in random.sample(files['js'], 3):
+            parts.append('<script src="%s"></script>' % filename)
+        for filename in random.sample(files['img'], 3):
+            parts.append('<img src="%s">' % filename)
+        parts.append('{% endslimall %}')
+        for filename in random.sample(files['js'], 2):
+            parts.append('<script src="{% slimfile "' + filename + '" %}">'
+                         '</script>')
+        pages.append('\n'.join(parts))
+    return pages
+
+
+def configure(media_root, options):
+    settings.DJANGO_STATIC = True
+    settings.DEBUG = False
+    settings.DJANGO_STATIC_SAVE_PREFIX = os.path.join(media_root, 'static')
+    settings.DJANGO_STATIC_NAME_PREFIX = ''
+    settings.DJANGO_STATIC_MEDIA_URL = ''
+    settings.DJANGO_STATIC_MEDIA_ROOTS = [media_root]
+    settings.DJANGO_STATIC_HASHED_SUBDIRS = True
+    settings.DJANGO_STATIC_USE_MANIFEST_FILE = options.mode == 'manifest'
+    _django_static._MANIFEST_PATH = os.path.join(media_root, 'manifest.json')
+    _django_static._FILE_MAP = {}
+
+
+## Fault injection, only ever done in the worker processes
+
+def inject_faults(options):
+    rand = random.Random(os.getpid())
+
+    if options.slow_optimizer:
+        original_optimize = _django_static.optimize
+        def slow_optimize(content, type_):
+            time.sleep(options.slow_optimizer)
+            return original_optimize(content, type_)
+        _django_static.optimize = slow_optimize
+
+    if options.eexist:
+        original_makedirs = os.makedirs
+        def racing_makedirs(name, *args):
+            original_makedirs(name, *args)
+            if rand.random() < options.eexist:
+                raise OSError(errno.EEXIST, "File exists (injected)", name)
+        os.makedirs = racing_makedirs
+
+    if options.enospc or options.kill:
+        original_publish = _django_static._publish
+        def faulty_publish(new_filepath, write):
+            is_manifest = new_filepath == _django_static._MANIFEST_PATH
+            die = is_manifest and rand.random() < options.kill
+            fail = not is_manifest and rand.random() < options.enospc
+            if not die and not fail:
+                return original_publish(new_filepath, write)
+            def faulty_write(tmp_filepath):
+                write(tmp_filepath)
+                # leave half of it
+                with open(tmp_filepath, 'r+b') as f:
+                    f.truncate(os.fstat(f.fileno()).st_size // 2)
+                if die:
+                    os.kill(os.getpid(), signal.SIGKILL)
+                raise IOError(errno.ENOSPC, "No space left on device (injected)")
+            return original_publish(new_filepath, faulty_write)
+        _django_static._publish = faulty_publish
+
+
+def worker(options, pages, ready, start, results):
+    inject_faults(options)
+    stats.reset()
+    templates = [Template(x) for x in pages]
+    rand = random.Random(os.getpid())
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def render(template):
+        start.wait()
+        t0 = time.time()
+        try:
+            template.render(Context())
+        except Exception:
+            with lock:
+                errors.append(traceback.format_exc().splitlines()[-1])
+            return
+        with lock:
+            latencies.append(time.time() - t0)
+
+    threads = [threading.Thread(target=render,
+                                args=(rand.choice(templates),))
+               for i in range(options.threads)]
+    for thread in threads:
+        thread.start()
+    ready.put(os.getpid())
+    for thread in threads:
+        thread.join()
+    builds = dict((k, v) for (k, v) in stats.counters.items()
+                  if k.startswith('build_'))
+    results.put({
+      'pid': os.getpid(),
+      'latencies': latencies,
+      'errors': errors,
+      'builds': builds,
+      'built_keys': built_keys[:],
+    })
+
+
+# the keys that were built in this process (see record_builds())
+built_keys = []
+
+def record_builds(event, key, phase=None, duration=None):
+    if event.startswith('build_'):
+        built_keys.append(key)
+
+
+## Checks, done in the parent afterwards
+
+def check(media_root, files, options):
+    problems = []
+    if options.mode == 'manifest':
+        try:
+            file_map = json.load(open(_django_static._MANIFEST_PATH))
+        except ValueError, msg:
+            return ["manifest isn't valid JSON: %s" % msg], 0
+    else:
+        # every process had its own so just check the files that are there
+        file_map = None
+
+    expected = {}
+    def expected_content(keys, optimize_if_possible):
+        parts = []
+        for key in keys.split(';'):
+            parts.append(open(media_root + key, 'rb').read())
+        if len(parts) > 1:
+            content = '\n'.join(x.strip() for x in parts) + '\n'
+        else:
+            content = parts[0]
+        if optimize_if_possible:
+            type_ = keys.endswith('.css') and _django_static.CSS or \
+              _django_static.JS
+            content = _django_static.optimize(content.decode('utf-8'), type_)
+            content = content.encode('utf-8')
+        return content
+
+    if file_map is not None:
+        for key, (new_filename, m_time) in file_map.items():
+            new_filepath = _django_static._find_output_filepath(new_filename)
+            if not new_filepath:
+                problems.append("%s is in the manifest but %s doesn't exist" %
+                                (key, new_filename))
+                continue
+            content = open(new_filepath, 'rb').read()
+            if key.endswith('.png'):
+                right = content == expected_content(key, False)
+            else:
+                # (which ones were optimized isn't known here)
+                right = content in (expected_content(key, False),
+                                    expected_content(key, True))
+            if not right:
+                problems.append("%s isn't complete" % new_filename)
+
+    leftovers = 0
+    for dirpath, dirnames, filenames in os.walk(media_root):
+        for filename in filenames:
+            if re.match(r'\..*\.tmp$', filename):
+                leftovers += 1
+    return problems, leftovers
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def run(options):
+    media_root, files = setup_media_root()
+    try:
+        configure(media_root, options)
+        pages = make_pages(files, options.pages)
+        stats.callback = record_builds
+
+        ready = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        start = multiprocessing.Event()
+        processes = [multiprocessing.Process(target=worker,
+                                             args=(options, pages, ready,
+                                                   start, results))
+                     for i in range(options.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            ready.get()
+        start.set()
+
+        reports = []
+        alive = set(processes)
+        while alive:
+            try:
+                reports.append(results.get(timeout=0.1))
+            except Exception:
+                pass
+            alive = set(x for x in alive if x.is_alive())
+        while not results.empty():
+            reports.append(results.get())
+        for process in processes:
+            process.join()
+        killed = len([x for x in processes if x.exitcode == -signal.SIGKILL])
+
+        problems, leftovers = check(media_root, files, options)
+        if leftovers and not killed:
+            problems.append("%d temporary files left behind" % leftovers)
+
+        latencies = []
+        errors = []
+        builds = defaultdict(int)
+        build_counts = defaultdict(int)
+        for report in reports:
+            latencies.extend(report['latencies'])
+            errors.extend(report['errors'])
+            for kind, count in report['builds'].items():
+                builds[kind] += count
+            for key in report['built_keys']:
+                build_counts[key] += 1
+        total_builds = sum(builds.values())
+
+        # every render has to be accounted for
+        if not latencies:
+            problems.append("nothing was rendered")
+        faults = options.eexist or options.enospc
+        if errors and not faults:
+            problems.append("%d renders failed" % len(errors))
+        accounted = len(latencies) + (faults and len(errors) or 0) + \
+          killed * options.threads
+        expected = options.processes * options.threads
+        if accounted < expected:
+            problems.append("%d of %d renders are unaccounted for" %
+                            (expected - accounted, expected))
+
+        return {
+          'processes': options.processes,
+          'threads': options.threads,
+          'mode': options.mode,
+          'renders': len(latencies),
+          'errors': len(errors),
+          'error_types': sorted(set(errors)),
+          'killed': killed,
+          'p50': percentile(latencies, 50),
+          'p99': percentile(latencies, 99),
+          'max': latencies and max(latencies) or None,
+          'builds': dict(builds),
+          'duplicate_builds': total_builds - len(build_counts),
+          'leftover_temporary_files': leftovers,
+          'problems': problems,
+        }
+    finally:
+        shutil.rmtree(media_root)
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--processes', type='int', default=8)
+    parser.add_option('--threads', type='int', default=4)
+    parser.add_option('--pages', type='int', default=10)
+    parser.add_option('--mode', choices=['manifest', 'memory'],
+                      default='manifest')
+    parser.add_option('--slow-optimizer', type='float', default=0,
+                      metavar='SECONDS')
+    parser.add_option('--eexist', type='float', default=0, metavar='P')
+    parser.add_option('--enospc', type='float', default=0, metavar='P')
+    parser.add_option('--kill', type='float', default=0, metavar='P')
+    options, args = parser.parse_args()
+
+    report = run(options)
+    print json.dumps(report, indent=2, sort_keys=True)
+    if report['problems']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
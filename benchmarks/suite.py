@@ -0,0 +1,551 @@
+#!/usr/bin/env python
+"""Benchmarks for rendering the template tags and for building files.
+
+Run from the root of the project:
+
+    DJANGO_SETTINGS_MODULE=settings python benchmarks/suite.py [options]
+
+It copies the files in media/ into a temporary directory, generates as many
+variations of them as the benchmarks need and writes the results as JSON
+(to stdout or the file given with --output). To see what has changed
+between two commits compare two such files:
+
+    python benchmarks/suite.py --compare before.json after.json
+
+Benchmarks:
+
+  import           importing the template tags module in a new process
+                   (after Django and the template system) and
+                   import_snapshot_1000 the same with a file map snapshot
+                   of 1000 files to load
+  has_optimizer_*  has_optimizer() for CSS and JS
+  lookup_*         staticfile() of a known file, a known combo and
+                   rendering a {% staticfile %} node on its own
+  render_*         {% staticfile %} of a known file in non-DEBUG, DEBUG and
+                   manifest mode
+  slimall_*        a {% slimall %} block of 10, 100 and 500 tags, both cold
+                   (everything is built) and warm
+  combo_*          building a combo of 10 and 100 files
+  optimize_*       each optimizer backend on the fixture CSS and JS files
+                   (YUI Compressor and Closure Compiler only if
+                   DJANGO_STATIC_YUI_COMPRESSOR and
+                   DJANGO_STATIC_CLOSURE_COMPILER are set)
+  css_large_*      minifying a generated 500 KB stylesheet and finding the
+                   files it refers to with the built-in minifier, cssmin and
+                   slimmer
+  js_large_*       minifying 1 MB of JavaScript (mostly jQuery) with the
+                   built-in minifier, jsmin and slimmer
+  manifest_*       _get() and _set() of a manifest with 100 and 10000 keys
+                   in 1 to 16 processes at the same time
+
+Times are in seconds, and per_op is the best of --repeat runs divided by
+the number of operations in each run.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import tempfile
+import platform
+import subprocess
+import multiprocessing
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+from django.conf import settings
+from django.template import Template, Context
+
+from django_static import stats
+from django_static.templatetags import django_static as _django_static
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, '..', 'media')
+
+CSS_FIXTURES = ['/css/reset.css', '/css/styles.css', '/css/sub/module.css']
+JS_FIXTURES = ['/javascript/canbe.js', '/javascript/script.js']
+IMAGE_FIXTURES = ['/images/icon1.png', '/images/icon2.png',
+                  '/images/icon3.png']
+
+
+def setup_media_root():
+    media_root = tempfile.mkdtemp()
+    for each in os.listdir(FIXTURES):
+        if os.path.isdir(os.path.join(FIXTURES, each)):
+            shutil.copytree(os.path.join(FIXTURES, each),
+                            os.path.join(media_root, each))
+    settings.DJANGO_STATIC = True
+    settings.DEBUG = False
+    settings.DJANGO_STATIC_SAVE_PREFIX = ''
+    settings.DJANGO_STATIC_NAME_PREFIX = ''
+    settings.DJANGO_STATIC_MEDIA_URL = ''
+    settings.DJANGO_STATIC_MEDIA_ROOTS = [media_root]
+    settings.DJANGO_STATIC_USE_MANIFEST_FILE = False
+    return media_root
+
+
+def variations(media_root, fixtures, count, prefix):
+    """copy the fixtures to `count` files with different names and return
+    their names"""
+    filenames = []
+    for i in range(count):
+        fixture = fixtures[i % len(fixtures)]
+        directory, basename = os.path.split(fixture)
+        filename = '%s/%s%d-%s' % (directory, prefix, i, basename)
+        filepath = media_root + filename
+        if not os.path.isfile(filepath):
+            shutil.copyfile(media_root + fixture, filepath)
+        filenames.append(filename)
+    return filenames
+
+
+def reset():
+    _django_static._FILE_MAP = _django_static.BoundedFileMap(
+      settings.DJANGO_STATIC_FILE_MAP_SIZE)
+    stats.reset()
+
+
+def measure(function, number, repeat, setup=None):
+    """return the best time of `repeat` runs of calling `function` `number`
+    times"""
+    best = None
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        t0 = time.time()
+        for j in xrange(number):
+            function()
+        t = time.time() - t0
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def result(name, seconds, number, **extra):
+    extra.update({
+      'name': name,
+      'seconds': seconds,
+      'ops': number,
+      'per_op': seconds / number,
+      'counters': dict(stats.counters),
+    })
+    return extra
+
+
+IMPORT_SCRIPT = '''
+import os, sys, time
+sys.path.insert(0, %(path)r)
+os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
+from django.conf import settings
+settings.DEBUG
+settings.DJANGO_STATIC_MEDIA_ROOTS = [%(media_root)r]
+settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT = %(snapshot)r
+import django.template
+t0 = time.time()
+import django_static.templatetags.django_static
+print time.time() - t0
+'''
+
+def bench_import(media_root, options):
+    """importing it without and with a snapshot of 1000 files (each of
+    which, and its original, is stat'ed when it's loaded)"""
+    results = []
+    snapshot = os.path.join(media_root, 'snapshot.json')
+    reset()
+    for filename in variations(media_root, IMAGE_FIXTURES, 1000, 'import'):
+        _django_static.staticfile(filename)
+    _django_static._save_file_map_snapshot(snapshot, _django_static._FILE_MAP,
+                                           merge=False)
+    number = options.quick and 5 or 20
+    for name, path in (('import', None), ('import_snapshot_1000', snapshot)):
+        script = IMPORT_SCRIPT % {'path': os.path.join(HERE, '..'),
+                                  'media_root': media_root,
+                                  'snapshot': path}
+        times = []
+        for i in range(number):
+            output = subprocess.Popen([sys.executable, '-c', script],
+                                      stdout=subprocess.PIPE).communicate()[0]
+            times.append(float(output))
+        results.append(result(name, min(times), 1,
+                              median=sorted(times)[len(times) // 2]))
+    os.remove(snapshot)
+    return results
+
+
+def bench_has_optimizer(media_root, options):
+    results = []
+    number = options.quick and 10000 or 100000
+    for type_ in ('css', 'js'):
+        function = lambda: _django_static.has_optimizer(type_)
+        seconds = measure(function, number, options.repeat)
+        results.append(result('has_optimizer_%s' % type_, seconds, number))
+    return results
+
+
+def bench_lookup(media_root, options):
+    results = []
+    number = options.quick and 10000 or 100000
+    node = Template('{% load django_static %}'
+                    '{% staticfile "/css/reset.css" %}').nodelist[-1]
+    context = Context()
+    lookups = [
+      ('file', lambda: _django_static.staticfile('/css/reset.css')),
+      ('combo', lambda: _django_static.staticfile(['/css/reset.css',
+                                                   '/css/styles.css'])),
+      ('node', lambda: node.render(context)),
+    ]
+    for name, lookup in lookups:
+        reset()
+        lookup() # warm up
+        stats.reset()
+        seconds = measure(lookup, number, options.repeat)
+        results.append(result('lookup_%s' % name, seconds, number))
+    return results
+
+
+def bench_render(media_root, options):
+    results = []
+    template = Template('{% load django_static %}'
+                        '{% staticfile "/css/reset.css" %}')
+    render = lambda: template.render(Context())
+    number = options.quick and 1000 or 10000
+
+    for mode in ('nondebug', 'debug', 'manifest'):
+        reset()
+        settings.DEBUG = mode == 'debug'
+        if mode == 'manifest':
+            settings.DJANGO_STATIC_USE_MANIFEST_FILE = True
+            _django_static._MANIFEST_PATH = os.path.join(media_root,
+                                                         'manifest.json')
+        try:
+            render() # warm up
+            stats.reset()
+            seconds = measure(render, number, options.repeat)
+            results.append(result('render_%s' % mode, seconds, number))
+        finally:
+            settings.DEBUG = False
+            settings.DJANGO_STATIC_USE_MANIFEST_FILE = False
+    return results
+
+
+def bench_slimall(media_root, options):
+    results = []
+    for size in (10, 100, 500):
+        images = variations(media_root, IMAGE_FIXTURES, size, 'slimall')
+        css = variations(media_root, CSS_FIXTURES, size, 'slimall')
+        js = variations(media_root, JS_FIXTURES, size, 'slimall')
+        tags = []
+        for i in range(size):
+            tags.append([
+              '<img src="%s">' % images[i],
+              '<link rel="stylesheet" type="text/css" href="%s">' % css[i],
+              '<script type="text/javascript" src="%s"></script>' % js[i],
+            ][i % 3])
+        template = Template('{% load django_static %}{% slimall %}' +
+                            '\n'.join(tags) + '{% endslimall %}')
+        render = lambda: template.render(Context())
+
+        number = options.quick and 1 or 3
+        seconds = measure(render, 1, number, setup=reset)
+        results.append(result('slimall_%d_cold' % size, seconds, 1))
+
+        number = options.quick and 100 or 1000
+        reset()
+        render()
+        stats.reset()
+        seconds = measure(render, number, options.repeat)
+        results.append(result('slimall_%d_warm' % size, seconds, number))
+    return results
+
+
+def bench_combo(media_root, options):
+    results = []
+    for size in (10, 100):
+        for optimize in (False, True):
+            filenames = variations(media_root, JS_FIXTURES, size, 'combo')
+            build = lambda: _django_static._static_file(
+              filenames, optimize_if_possible=optimize)
+            number = options.quick and 1 or 5
+            seconds = measure(build, 1, number, setup=reset)
+            results.append(result('combo_%d%s' % (size,
+                                  optimize and '_optimized' or ''),
+                                  seconds, 1))
+    return results
+
+
+def bench_optimize(media_root, options):
+    css = ''.join(open(media_root + x).read() for x in CSS_FIXTURES)
+    css = css.decode('utf-8')
+    js = ''.join(open(media_root + x).read() for x in JS_FIXTURES)
+    js = js.decode('utf-8')
+    backends = [
+      ('cssmin', _django_static._optional_module('cssmin'), css,
+       lambda: _django_static._run_cssmin(css)),
+      ('slimmer_css', _django_static._optional_module('slimmer'), css,
+       lambda: _django_static._run_slimmer(css, 'css')),
+      ('builtin_css', True, css,
+       lambda: _django_static._minify.minify_css(css)),
+      ('builtin_js', True, js,
+       lambda: _django_static._minify.minify_js(js)),
+      ('slimmer_js', _django_static._optional_module('slimmer'), js,
+       lambda: _django_static._run_slimmer(js, 'js')),
+      ('jsmin', _django_static._optional_module('jsmin'), js,
+       lambda: _django_static._run_jsmin(js)),
+      ('yui_compressor_css',
+       getattr(settings, 'DJANGO_STATIC_YUI_COMPRESSOR', None), css,
+       lambda: _django_static._run_yui_compressor(css, 'css')),
+      ('yui_compressor_js',
+       getattr(settings, 'DJANGO_STATIC_YUI_COMPRESSOR', None), js,
+       lambda: _django_static._run_yui_compressor(js, 'js')),
+      ('closure_compiler',
+       getattr(settings, 'DJANGO_STATIC_CLOSURE_COMPILER', None), js,
+       lambda: _django_static._run_closure_compiler(js)),
+    ]
+    results = []
+    for name, available, code, run in backends:
+        if not available:
+            results.append({'name': 'optimize_%s' % name, 'skipped': True})
+            continue
+        # the java ones take long enough as it is
+        number = not name.startswith(('yui', 'closure')) \
+          and (options.quick and 10 or 100) or 1
+        stats.reset()
+        seconds = measure(run, number, options.repeat)
+        results.append(result('optimize_%s' % name, seconds, number,
+                              input_size=len(code), output_size=len(run())))
+    return results
+
+
+def large_stylesheet(media_root, size):
+    """return about `size` bytes of CSS made out of the fixtures, with
+    comments, strings, data: URIs and references to images in it"""
+    fixtures = [open(media_root + x).read().decode('utf-8')
+                for x in CSS_FIXTURES]
+    parts = []
+    length = 0
+    i = 0
+    while length < size:
+        part = (u'/* section %d */\n%s\n'
+                u'.generated-%d, .generated-%d:hover > a {\n'
+                u'    background : url( "../images/icon%d.png" ) no-repeat ;\n'
+                u'    content: "url(not-a-reference.png)";\n'
+                u'}\n'
+                u'.inline-%d { background: url(data:image/png;base64,iVBORw0K) }\n'
+                % (i, fixtures[i % len(fixtures)], i, i, i % 3 + 1, i))
+        parts.append(part)
+        length += len(part)
+        i += 1
+    return u''.join(parts)
+
+
+def bench_css_large(media_root, options):
+    """minifying a 500 KB stylesheet and finding the files it refers to,
+    which is what has to be done with every stylesheet that's optimized"""
+    css = large_stylesheet(media_root, 500 * 1024)
+    minify_css = _django_static._minify.minify_css
+    keep = lambda urls: urls
+    backends = [
+      # the built-in one does both in the same pass...
+      ('builtin', True,
+       lambda: minify_css(css, rewrite=keep)),
+      # ...the others need another one for the references
+      ('cssmin', _django_static._optional_module('cssmin'),
+       lambda: minify_css(_django_static._run_cssmin(css), rewrite=keep,
+                          minify=False)),
+      ('slimmer', _django_static._optional_module('slimmer'),
+       lambda: minify_css(_django_static._run_slimmer(css, 'css'),
+                          rewrite=keep, minify=False)),
+    ]
+    results = []
+    for name, available, run in backends:
+        if not available:
+            results.append({'name': 'css_large_%s' % name, 'skipped': True})
+            continue
+        outputs = []
+        # cssmin takes the better part of a minute on this so it's only
+        # run the once
+        number = name == 'cssmin' and 1 or (options.quick and 1 or 5)
+        repeat = name == 'cssmin' and 1 or options.repeat
+        seconds = measure(lambda: outputs.append(len(run())), number, repeat)
+        results.append(result('css_large_%s' % name, seconds, number,
+                              input_size=len(css), output_size=outputs[-1]))
+    return results
+
+
+def large_script(media_root, size):
+    """return about `size` bytes of JavaScript made out of jQuery and the
+    fixtures"""
+    fixtures = [open(media_root + x).read().decode('utf-8')
+                for x in JS_FIXTURES + ['/javascript/jquery-1.3.2.min.js']]
+    parts = []
+    length = 0
+    i = 0
+    while length < size:
+        part = u'/* part %d */\n%s\n;\n' % (i, fixtures[i % len(fixtures)])
+        parts.append(part)
+        length += len(part)
+        i += 1
+    return u''.join(parts)
+
+
+def bench_js_large(media_root, options):
+    """minifying 1 MB of JavaScript"""
+    js = large_script(media_root, 1024 * 1024)
+    backends = [
+      ('builtin', True, lambda: _django_static._minify.minify_js(js)),
+      ('jsmin', _django_static._optional_module('jsmin'),
+       lambda: _django_static._run_jsmin(js)),
+      ('slimmer', _django_static._optional_module('slimmer'),
+       lambda: _django_static._run_slimmer(js, 'js')),
+    ]
+    results = []
+    for name, available, run in backends:
+        if not available:
+            results.append({'name': 'js_large_%s' % name, 'skipped': True})
+            continue
+        outputs = []
+        number = options.quick and 1 or 3
+        seconds = measure(lambda: outputs.append(len(run())), number,
+                          options.repeat)
+        results.append(result('js_large_%s' % name, seconds, number,
+                              input_size=len(js), output_size=outputs[-1]))
+    return results
+
+
+def _manifest_worker(path, keys, number, start, seed):
+    random.seed(seed)
+    start.wait()
+    for i in xrange(number):
+        key = random.choice(keys)
+        if i % 10:
+            _django_static._get(path, key)
+        else:
+            _django_static._set(path, key, [key + '.%d' % i, i])
+
+
+def bench_manifest(media_root, options):
+    results = []
+    for size in (100, 10000):
+        path = os.path.join(media_root, 'manifest-%d.json' % size)
+        keys = ['/css/file%d.css' % i for i in range(size)]
+        with open(path, 'w') as f:
+            json.dump(dict((key, [key, 0]) for key in keys), f)
+        # every _set() rewrites the whole file so there's less of them
+        # for the big one
+        number = size > 1000 and 50 or 500
+        if options.quick:
+            number /= 10
+        for processes in (1, 2, 4, 8, 16):
+            # (the counting happens in the worker processes)
+            stats.reset()
+            best = None
+            for i in range(options.repeat):
+                start = multiprocessing.Event()
+                workers = [multiprocessing.Process(target=_manifest_worker,
+                                                   args=(path, keys, number,
+                                                         start, j))
+                           for j in range(processes)]
+                for worker in workers:
+                    worker.start()
+                t0 = time.time()
+                start.set()
+                for worker in workers:
+                    worker.join()
+                seconds = time.time() - t0
+                if best is None or seconds < best:
+                    best = seconds
+            # check that all the concurrent writing hasn't broken it
+            json.load(open(path))
+            results.append(result('manifest_%d_keys_%d_processes' % (size, processes),
+                                  best, number * processes,
+                                  processes=processes))
+    return results
+
+
+BENCHMARKS = [
+  ('import', bench_import),
+  ('has_optimizer', bench_has_optimizer),
+  ('lookup', bench_lookup),
+  ('render', bench_render),
+  ('slimall', bench_slimall),
+  ('combo', bench_combo),
+  ('optimize', bench_optimize),
+  ('css_large', bench_css_large),
+  ('js_large', bench_js_large),
+  ('manifest', bench_manifest),
+]
+
+
+def git_commit():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'], cwd=HERE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE).communicate()[0].strip()
+    except OSError:
+        return None
+
+
+def run(options, only=None):
+    media_root = setup_media_root()
+    try:
+        results = []
+        for name, benchmark in BENCHMARKS:
+            if only and name not in only:
+                continue
+            print >>sys.stderr, name
+            results.extend(benchmark(media_root, options))
+    finally:
+        shutil.rmtree(media_root)
+    return {
+      'commit': git_commit(),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'time': time.time(),
+      'results': results,
+    }
+
+
+def compare(before_path, after_path):
+    before = dict((x['name'], x) for x in json.load(open(before_path))['results'])
+    after = json.load(open(after_path))['results']
+    for each in after:
+        old = before.get(each['name'])
+        if each.get('skipped') or not old or old.get('skipped'):
+            continue
+        # (in microseconds)
+        print "%40s %14.3f %14.3f %7.2fx" % (each['name'],
+                                            old['per_op'] * 1e6,
+                                            each['per_op'] * 1e6,
+                                            each['per_op'] / old['per_op'])
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] [benchmark ...]")
+    parser.add_option('--output', help="write the JSON to this file")
+    parser.add_option('--repeat', type='int', default=3,
+                      help="how many times to run each benchmark (the best "
+                           "time counts)")
+    parser.add_option('--quick', action='store_true',
+                      help="fewer iterations")
+    parser.add_option('--compare', action='store_true',
+                      help="compare two JSON files instead")
+    options, args = parser.parse_args()
+    if options.compare:
+        if len(args) != 2:
+            parser.error("--compare needs two files")
+        compare(*args)
+        return
+
+    report = json.dumps(run(options, args), indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(report)
+    else:
+        print report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""Build (and optimize) files up front, e.g. before deploying, rather than
+when they're first used:
+
+    ./manage.py django_static_build /css/screen.css /javascript/app.js ...
+    ./manage.py django_static_build --all
+
+With --all every .css and .js file in DJANGO_STATIC_MEDIA_ROOTS that isn't a
+generated one itself is built.
+
+What's built goes into the manifest (DJANGO_STATIC_USE_MANIFEST_FILE) or the
+file map snapshot (DJANGO_STATIC_FILE_MAP_SNAPSHOT), one of which has to be
+set, for the web server processes to find.
+
+When the Closure Compiler is the Javascript optimizer, all the Javascript
+files that haven't been built yet are compiled first in as few runs of it as
+possible (DJANGO_STATIC_CLOSURE_BATCH_SIZE files at a time, default 100)
+rather than one JVM for every file.
+"""
+import os
+import re
+import codecs
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from django_static.templatetags import django_static as _django_static
+
+
+TIMESTAMPED_REGEX = re.compile('\.(\d{10})\.')
+
+
+def all_filenames():
+    """return every .css and .js file in DJANGO_STATIC_MEDIA_ROOTS that
+    hasn't been generated"""
+    save_prefix = settings.DJANGO_STATIC_SAVE_PREFIX
+    filenames = []
+    for root in settings.DJANGO_STATIC_MEDIA_ROOTS:
+        for dirpath, dirnames, names in os.walk(root):
+            if save_prefix and \
+              os.path.abspath(dirpath).startswith(os.path.abspath(save_prefix)):
+                dirnames[:] = []
+                continue
+            for name in names:
+                if not name.endswith(('.css', '.js')) or \
+                  TIMESTAMPED_REGEX.search(name):
+                    continue
+                filename = '/' + os.path.relpath(os.path.join(dirpath, name),
+                                                 root).replace(os.sep, '/')
+                if filename not in filenames:
+                    filenames.append(filename)
+    return sorted(filenames)
+
+
+def _is_built(filename):
+    if settings.DJANGO_STATIC_USE_MANIFEST_FILE:
+        new_filename = _django_static._get(_django_static._MANIFEST_PATH,
+                                           filename)[0]
+    else:
+        new_filename = _django_static._FILE_MAP.get(filename, (None, None))[0]
+    return bool(new_filename)
+
+
+def optimize_javascript(filenames):
+    """optimize_batch() the Javascript files that haven't been built yet if
+    the Closure Compiler is used and return how many there were"""
+    if _django_static._optimizer(_django_static.JS) != 'closure_compiler':
+        return 0
+    contents = []
+    for filename in filenames:
+        if not filename.endswith('.js') or _is_built(filename):
+            continue
+        filepath = _django_static._find_filepath_in_roots(filename)[0]
+        if filepath:
+            contents.append(codecs.open(filepath, 'r', 'utf-8').read())
+    if contents:
+        _django_static.optimize_batch(contents, _django_static.JS)
+    return len(contents)
+
+
+def build(filenames, optimize=True):
+    """return the new filename of every file"""
+    if optimize:
+        optimize_javascript(filenames)
+        return _django_static.slimfiles_batch(filenames)
+    return _django_static.staticfiles_batch(filenames)
+
+
+class Command(BaseCommand):
+    args = '<filename filename ...>'
+    help = ("Builds the given files, or with --all every CSS and Javascript "
+            "file, so they don't have to be built when first used")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--all', action='store_true', default=False,
+                    help="Build every .css and .js file in "
+                         "DJANGO_STATIC_MEDIA_ROOTS"),
+        make_option('--no-optimize', action='store_false', dest='optimize',
+                    default=True,
+                    help="Don't optimize them (like {% staticfile %} rather "
+                         "than {% slimfile %})"),
+    )
+
+    def handle(self, *filenames, **options):
+        if options['all']:
+            filenames = all_filenames()
+        if not filenames:
+            raise CommandError("Specify the files to build or --all")
+        if not settings.DJANGO_STATIC:
+            raise CommandError("DJANGO_STATIC isn't set")
+        if not (settings.DJANGO_STATIC_USE_MANIFEST_FILE or
+                settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT):
+            # what's built would only be in this process's file map
+            raise CommandError("Either DJANGO_STATIC_USE_MANIFEST_FILE or "
+                               "DJANGO_STATIC_FILE_MAP_SNAPSHOT needs to be "
+                               "set for the web server processes to know "
+                               "what has been built")
+        verbosity = int(options.get('verbosity', 1))
+        new_filenames = build(list(filenames), optimize=options['optimize'])
+        if not settings.DJANGO_STATIC_USE_MANIFEST_FILE:
+            _django_static._save_file_map_snapshot(
+              settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT, _django_static._FILE_MAP)
+        if verbosity > 1:
+            for filename, new_filename in zip(filenames, new_filenames):
+                self.stdout.write("%s -> %s" % (filename, new_filename))
+        if verbosity:
+            self.stdout.write("Built %d files" % len(filenames))
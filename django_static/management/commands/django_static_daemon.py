@@ -0,0 +1,127 @@
+"""Run a process that does all the building (finding, combining, optimizing
+and writing files) for the web server processes on this machine.
+
+Web server processes with DJANGO_STATIC_BUILD_SOCKET set send the files they
+don't know about yet to this daemon over that unix socket and wait at most
+DJANGO_STATIC_BUILD_TIMEOUT seconds for it. See _request_build() in
+django_static.templatetags.django_static for the protocol.
+
+Requests for the same file that arrive while it's being built wait for that
+build instead of doing it again, and the files in each request are built in
+parallel.
+"""
+import os
+import json
+import threading
+import SocketServer
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from django_static.templatetags import django_static as _django_static
+
+
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def _entry(filename):
+    """return [new_filename, m_time, filepath] for the built file or None"""
+    map_key = _django_static._split_filename(filename)[2]
+    if settings.DJANGO_STATIC_USE_MANIFEST_FILE:
+        new_filename, m_time = _django_static._get(
+          _django_static._MANIFEST_PATH, map_key)
+    else:
+        new_filename, m_time = _django_static._FILE_MAP.get(map_key,
+                                                            (None, None))
+    if not new_filename:
+        return None
+    return [new_filename, m_time,
+            _django_static._find_output_filepath(new_filename)]
+
+
+def build(files, optimize_if_possible=False, symlink_if_possible=False):
+    """build the files, unless they're already being built, and return their
+    entries"""
+    mine = []
+    waiting = []
+    with _in_flight_lock:
+        for each in files:
+            key = (_django_static._split_filename(each)[2],
+                   optimize_if_possible, symlink_if_possible)
+            if key in _in_flight:
+                waiting.append(_in_flight[key])
+            else:
+                event = _in_flight[key] = threading.Event()
+                mine.append((each, key, event))
+    try:
+        if mine:
+            _django_static._static_files_batch(
+              [x[0] for x in mine],
+              optimize_if_possible=optimize_if_possible,
+              symlink_if_possible=symlink_if_possible,
+              warn_no_file=False)
+    finally:
+        with _in_flight_lock:
+            for each, key, event in mine:
+                del _in_flight[key]
+                event.set()
+    for event in waiting:
+        event.wait()
+    return [_entry(x) for x in files]
+
+
+class BuildRequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            response = {'results': build(request['files'],
+                                         bool(request.get('optimize')),
+                                         bool(request.get('symlink')))}
+        except Exception, msg:
+            response = {'error': '%s: %s' % (msg.__class__.__name__, msg)}
+        self.wfile.write(json.dumps(response) + '\n')
+
+
+class BuildServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path):
+    if os.path.exists(socket_path):
+        # left behind by a previous daemon that didn't shut down cleanly
+        os.remove(socket_path)
+    server = BuildServer(socket_path, BuildRequestHandler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+class Command(BaseCommand):
+    help = ("Builds files on behalf of the web server processes that send "
+            "requests to DJANGO_STATIC_BUILD_SOCKET")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--socket', dest='socket_path', default=None,
+                    help='Unix socket to listen on (default '
+                         'DJANGO_STATIC_BUILD_SOCKET)'),
+    )
+
+    def handle(self, **options):
+        socket_path = options['socket_path'] or settings.DJANGO_STATIC_BUILD_SOCKET
+        if not socket_path:
+            raise CommandError("Set DJANGO_STATIC_BUILD_SOCKET or use --socket")
+        if not settings.DJANGO_STATIC:
+            raise CommandError("DJANGO_STATIC is not enabled")
+        _django_static._in_build_daemon = True
+        if int(options.get('verbosity', 1)):
+            self.stdout.write("Listening on %s" % socket_path)
+        try:
+            serve(socket_path)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,138 @@
+"""Write the manifest (or file map snapshot) and all the generated files it
+refers to into one archive that can be unpacked on other servers with the
+django_static_import command.
+
+The archive contains:
+
+    manifest.json     the file map, {filename: [new_filename, m_time]}
+    checksums.json    {member name: sha256 hex digest} of all the files
+    files/N/...       the generated files, N being the index of the directory
+                      (DJANGO_STATIC_SAVE_PREFIX or one of
+                      DJANGO_STATIC_MEDIA_ROOTS) they belong in
+"""
+import os
+import json
+import hashlib
+import tarfile
+import zipfile
+from cStringIO import StringIO
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from django_static.templatetags import django_static as _django_static
+
+MANIFEST_NAME = 'manifest.json'
+CHECKSUMS_NAME = 'checksums.json'
+FILES_PREFIX = 'files'
+
+
+def output_roots():
+    """return the directories generated files can be in"""
+    if settings.DJANGO_STATIC_SAVE_PREFIX:
+        return [settings.DJANGO_STATIC_SAVE_PREFIX]
+    return settings.DJANGO_STATIC_MEDIA_ROOTS
+
+
+def archive_format(archive_path, format=None):
+    if format:
+        if format not in ('tar', 'zip'):
+            raise CommandError("Unrecognized format %r" % format)
+        return format
+    if archive_path.endswith('.zip'):
+        return 'zip'
+    return 'tar'
+
+
+def checksum(fileobj):
+    sha = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(1024 * 64), ''):
+        sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _member_name(new_filename):
+    """return the name in the archive of the generated file or None if it
+    can't be found"""
+    prefix = settings.DJANGO_STATIC_NAME_PREFIX
+    if prefix and new_filename.startswith(prefix):
+        new_filename = new_filename[len(prefix):]
+    for i, root in enumerate(output_roots()):
+        filepath = _django_static._filename2filepath(new_filename, root)
+        if os.path.exists(filepath):
+            return '%s/%d/%s' % (FILES_PREFIX, i, new_filename.lstrip('/')), \
+                   filepath
+    return None, None
+
+
+def export(archive_path, format=None):
+    """write the archive and return the number of files in it"""
+    file_map = _django_static._saved_file_map()
+    if not file_map:
+        raise CommandError("Nothing to export. Either "
+                           "DJANGO_STATIC_USE_MANIFEST_FILE or "
+                           "DJANGO_STATIC_FILE_MAP_SNAPSHOT needs to be set and "
+                           "files generated.")
+    members = {}
+    for map_key, (new_filename, m_time) in sorted(file_map.items()):
+        name, filepath = _member_name(new_filename)
+        if name is None:
+            raise CommandError("Can't find the generated file %s for %s" %
+                               (new_filename, map_key))
+        members[name] = filepath
+
+    checksums = {}
+    for name, filepath in members.items():
+        with open(filepath, 'rb') as f:
+            checksums[name] = checksum(f)
+
+    manifest = json.dumps(file_map, indent=4)
+    checksums = json.dumps(checksums, indent=4)
+
+    # written to a temporary name first so there's never a half written
+    # archive for something else to pick up
+    tmp_path = archive_path + '.tmp'
+    if archive_format(archive_path, format) == 'zip':
+        archive = zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED)
+        try:
+            archive.writestr(MANIFEST_NAME, manifest)
+            archive.writestr(CHECKSUMS_NAME, checksums)
+            for name, filepath in sorted(members.items()):
+                archive.write(filepath, name)
+        finally:
+            archive.close()
+    else:
+        # symlinks are stored as the files they point to
+        archive = tarfile.open(tmp_path, 'w:gz', dereference=True)
+        try:
+            for name, content in ((MANIFEST_NAME, manifest),
+                                  (CHECKSUMS_NAME, checksums)):
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, StringIO(content))
+            for name, filepath in sorted(members.items()):
+                archive.add(filepath, name)
+        finally:
+            archive.close()
+    os.rename(tmp_path, archive_path)
+    return len(members)
+
+
+class Command(BaseCommand):
+    args = '<archive>'
+    help = ("Writes the manifest and all generated files into an archive "
+            "for django_static_import")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', default=None,
+                    help="'tar' (gzipped) or 'zip'. Default is based on the "
+                         "archive's file extension."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Specify the archive to write to")
+        count = export(args[0], format=options['format'])
+        if int(options.get('verbosity', 1)):
+            self.stdout.write("Exported %d files to %s" % (count, args[0]))
@@ -0,0 +1,289 @@
+"""Delete old generated (timestamped) files that are no longer needed.
+
+For every original file (e.g. /css/foo.css) the last --keep generations
+(e.g. /css/foo.1300000001.css, /css/foo.1300000002.css) are always kept and
+so is anything younger than --grace seconds or still referred to by the
+manifest or the file map snapshot.
+
+Only files that are known to be generated are deleted: anything with a
+timestamp in its name in DJANGO_STATIC_SAVE_PREFIX, and elsewhere (e.g. in
+DJANGO_STATIC_MEDIA_ROOTS, where there can be uploads like
+photo.1234567890.jpg) only earlier generations of files the manifest or
+the file map snapshot refers to. Without either of them it refuses to run
+outside DJANGO_STATIC_SAVE_PREFIX. Files that the manifest or snapshot shows
+can't be told apart by their names, e.g. combinations whose names were cut
+short to DJANGO_STATIC_NAME_MAX_LENGTH, are left alone.
+
+What has been seen is remembered in a state file so that the next run only
+has to look at directories that have changed since.
+"""
+import os
+import re
+import json
+import time
+import errno
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from django_static.templatetags import django_static as _django_static
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+TIMESTAMPED_REGEX = re.compile('\.(\d{10})\.')
+STATE_FILENAME = '.django_static_gc.json'
+
+
+def _listdir(directory):
+    """yield (name, is_dir) for everything in directory"""
+    if scandir is not None:
+        for entry in scandir(directory):
+            yield entry.name, entry.is_dir(follow_symlinks=False)
+    else:
+        for name in os.listdir(directory):
+            yield name, os.path.isdir(os.path.join(directory, name)) and \
+                        not os.path.islink(os.path.join(directory, name))
+
+
+def _load_state(state_path):
+    try:
+        return json.loads(open(state_path).read())
+    except (IOError, ValueError):
+        return {'last_run': 0, 'generations': {}}
+
+
+def _save_state(state_path, state):
+    _django_static._publish_content(state_path, json.dumps(state))
+
+
+def _generation_key(filepath):
+    """return what all the generations of the generated file have in
+    common, i.e. its path without the timestamp, or None if it hasn't got
+    one"""
+    directory, name = os.path.split(filepath)
+    match = TIMESTAMPED_REGEX.search(name)
+    if not match:
+        return None
+    return os.path.join(directory, name.replace(match.group(), '.', 1))
+
+
+def _known_outputs():
+    """return (referenced, known) where referenced is the set of generated
+    files the manifest or file map snapshot still point to and known is
+    {generation key: set of the files (map keys) that it's generated from}"""
+    referenced = set()
+    known = {}
+    for map_key, (new_filename, m_time) in \
+      _django_static._saved_file_map().items():
+        filepath = _django_static._find_output_filepath(new_filename)
+        if filepath:
+            filepath = os.path.abspath(filepath)
+            referenced.add(filepath)
+            key = _generation_key(filepath)
+            if key:
+                known.setdefault(key, set()).add(map_key)
+    return referenced, known
+
+
+def _in_save_prefix(directory):
+    save_prefix = settings.DJANGO_STATIC_SAVE_PREFIX
+    if not save_prefix:
+        return False
+    save_prefix = os.path.abspath(save_prefix)
+    return directory == save_prefix or \
+      directory.startswith(save_prefix.rstrip(os.sep) + os.sep)
+
+
+def scan(directory, state, full=False):
+    """add the generated files in directory, that were created since the last
+    run, to state['generations']"""
+    generations = state['generations']
+    last_run = not full and state['last_run'] or 0
+    known = set()
+    if last_run:
+        for each in generations.values():
+            known.update(x[0] for x in each)
+
+    scanned = 0
+    looked_at = set()
+    present = set()
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        # if nothing was added to or removed from the directory since the
+        # last run there's no point looking at its files
+        look_at_files = os.stat(current).st_mtime >= last_run
+        if look_at_files:
+            looked_at.add(current)
+        for name, is_dir in _listdir(current):
+            path = os.path.join(current, name)
+            if is_dir:
+                stack.append(path)
+                continue
+            if not look_at_files:
+                continue
+            present.add(path)
+            if path in known:
+                continue
+            match = TIMESTAMPED_REGEX.search(name)
+            if not match or name.startswith('.'):
+                continue
+            try:
+                # (not st_mtime, which for a hardlink is that of the
+                # original, and maybe years old, while making the link, or
+                # renaming it into place, changes st_ctime)
+                created = os.lstat(path).st_ctime
+            except OSError:
+                continue
+            scanned += 1
+            key = _generation_key(path)
+            generations.setdefault(key, []).append(
+              [path, int(match.group(1)), created])
+            known.add(path)
+
+    # forget the ones that have been deleted by something else
+    for key, each in generations.items():
+        each[:] = [x for x in each
+                   if x[0] in present or os.path.dirname(x[0]) not in looked_at]
+        if not each:
+            del generations[key]
+    return scanned
+
+
+def find_garbage(state, keep, grace, referenced, now=None, known=None,
+                 only_known=False):
+    """return the paths that can be deleted. With only_known only the
+    generations of the files in `known` are."""
+    if now is None:
+        now = time.time()
+    if known is None:
+        known = {}
+    garbage = []
+    for key, each in state['generations'].items():
+        if len(known.get(key, ())) > 1:
+            # generations of several different files
+            continue
+        if only_known and key not in known:
+            continue
+        each.sort(key=lambda x: x[1], reverse=True)
+        for path, timestamp, created in each[keep:]:
+            if now - created < grace or path in referenced:
+                continue
+            garbage.append(path)
+    return garbage
+
+
+def collect_garbage(directories, keep=2, grace=7 * 24 * 3600,
+                    dry_run=False, batch_size=1000, state_path=None,
+                    full=False, log=None):
+    """delete old generations of generated files in directories and return
+    the paths that were (or with dry_run, would have been) deleted"""
+    if getattr(settings, 'DJANGO_STATIC_FILENAME_GENERATOR', None):
+        raise CommandError("Old generations of files named by "
+                           "DJANGO_STATIC_FILENAME_GENERATOR can't be "
+                           "recognised")
+    deleted = []
+    referenced, known = _known_outputs()
+    has_saved_map = bool(settings.DJANGO_STATIC_USE_MANIFEST_FILE or
+                         settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT)
+    for directory in directories:
+        directory = os.path.abspath(directory)
+        if not os.path.isdir(directory):
+            raise CommandError("%s is not a directory" % directory)
+        only_known = not _in_save_prefix(directory)
+        if only_known and not has_saved_map:
+            raise CommandError(
+              "%s isn't in DJANGO_STATIC_SAVE_PREFIX and without "
+              "DJANGO_STATIC_USE_MANIFEST_FILE or "
+              "DJANGO_STATIC_FILE_MAP_SNAPSHOT the generated files in it "
+              "can't be told apart from other files" % directory)
+        this_state_path = state_path or os.path.join(directory, STATE_FILENAME)
+        state = _load_state(this_state_path)
+        started = time.time()
+        scanned = scan(directory, state, full=full)
+        garbage = find_garbage(state, keep, grace, referenced, known=known,
+                               only_known=only_known)
+        if log:
+            log("%s: %d new files, %d to delete" % (directory, scanned, len(garbage)))
+        if dry_run:
+            deleted.extend(garbage)
+            continue
+
+        for i in range(0, len(garbage), batch_size):
+            batch = set(garbage[i:i + batch_size])
+            for path in batch:
+                try:
+                    os.remove(path)
+                except OSError, msg:
+                    if msg.errno != errno.ENOENT:
+                        raise
+                deleted.append(path)
+            # save after each batch so an interrupted run doesn't have to
+            # start over
+            for key, each in state['generations'].items():
+                each[:] = [x for x in each if x[0] not in batch]
+                if not each:
+                    del state['generations'][key]
+            _save_state(this_state_path, state)
+        state['last_run'] = started
+        _save_state(this_state_path, state)
+    return deleted
+
+
+class Command(BaseCommand):
+    args = '<directory directory ...>'
+    help = ("Deletes old generated files from DJANGO_STATIC_SAVE_PREFIX (or "
+            "DJANGO_STATIC_MEDIA_ROOTS) or the given directories")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--keep', type='int', default=2,
+                    help='Number of generations to keep of every file '
+                         '(default 2)'),
+        make_option('--grace', type='int', default=7 * 24 * 3600,
+                    help='Never delete files younger than this many seconds '
+                         '(default one week)'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help="Only print what would be deleted"),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Number of files to delete between saving the state '
+                         '(default 1000)'),
+        make_option('--state', dest='state_path', default=None,
+                    help='File to keep the state in (default %s in each '
+                         'directory)' % STATE_FILENAME),
+        make_option('--full', action='store_true', default=False,
+                    help="Look at all files, not just the ones created since "
+                         "the last run"),
+    )
+
+    def handle(self, *directories, **options):
+        if not directories:
+            if settings.DJANGO_STATIC_SAVE_PREFIX:
+                directories = [settings.DJANGO_STATIC_SAVE_PREFIX]
+            else:
+                directories = settings.DJANGO_STATIC_MEDIA_ROOTS
+        verbosity = int(options.get('verbosity', 1))
+
+        def log(msg):
+            if verbosity:
+                self.stdout.write(msg)
+
+        deleted = collect_garbage(directories,
+                                  keep=options['keep'],
+                                  grace=options['grace'],
+                                  dry_run=options['dry_run'],
+                                  batch_size=options['batch_size'],
+                                  state_path=options['state_path'],
+                                  full=options['full'],
+                                  log=log)
+        if verbosity > 1 or options['dry_run']:
+            for path in deleted:
+                self.stdout.write(path)
@@ -0,0 +1,137 @@
+"""Unpack an archive made by django_static_export.
+
+All files are first extracted next to where they're going and checked
+against the archive's checksums. Only when they're all fine are they renamed
+into place and after that the manifest (or file map snapshot) is replaced
+with the one from the archive. The imported snapshot is used as it is, without
+checking the modification times of the originals, which won't be the same as
+where the files were built.
+"""
+import os
+import json
+import shutil
+import tarfile
+import zipfile
+import tempfile
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from django_static.templatetags import django_static as _django_static
+from django_static.management.commands.django_static_export import (
+  MANIFEST_NAME, CHECKSUMS_NAME, FILES_PREFIX, output_roots, archive_format,
+  checksum)
+
+
+class _Archive(object):
+    """the little bit of tarfile and zipfile that is needed, in common"""
+
+    def __init__(self, archive_path, format=None):
+        self.format = archive_format(archive_path, format)
+        if self.format == 'zip':
+            self._archive = zipfile.ZipFile(archive_path)
+        else:
+            self._archive = tarfile.open(archive_path)
+
+    def names(self):
+        if self.format == 'zip':
+            return [x for x in self._archive.namelist() if not x.endswith('/')]
+        return [x.name for x in self._archive.getmembers() if x.isfile()]
+
+    def open(self, name):
+        if self.format == 'zip':
+            return self._archive.open(name)
+        return self._archive.extractfile(name)
+
+    def close(self):
+        self._archive.close()
+
+
+def _destination(name, roots):
+    """return where a member of the archive is going"""
+    prefix, index, filename = name.split('/', 2)
+    if prefix != FILES_PREFIX:
+        raise CommandError("Unexpected file %s in the archive" % name)
+    index = int(index)
+    if index >= len(roots):
+        raise CommandError("No directory number %d to put %s in" % (index, name))
+    filename = os.path.normpath(filename)
+    if filename.startswith('..') or os.path.isabs(filename):
+        raise CommandError("Refusing to unpack %s" % name)
+    return os.path.join(roots[index], filename)
+
+
+def import_(archive_path, format=None):
+    """unpack the archive and return the number of files in it"""
+    if not settings.DJANGO_STATIC_USE_MANIFEST_FILE and \
+      not settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT:
+        raise CommandError("Nowhere to put the manifest. Either "
+                           "DJANGO_STATIC_USE_MANIFEST_FILE or "
+                           "DJANGO_STATIC_FILE_MAP_SNAPSHOT needs to be set.")
+    archive = _Archive(archive_path, format)
+    roots = output_roots()
+    try:
+        names = archive.names()
+        if MANIFEST_NAME not in names or CHECKSUMS_NAME not in names:
+            raise CommandError("%s is not an export from django_static_export" %
+                               archive_path)
+        file_map = json.loads(archive.open(MANIFEST_NAME).read())
+        checksums = json.loads(archive.open(CHECKSUMS_NAME).read())
+
+        # extract everything to temporary files in the directories they're
+        # going to be in so they can be renamed into place
+        extracted = []
+        try:
+            for name, expected in sorted(checksums.items()):
+                destination = _destination(name, roots)
+                directory = os.path.dirname(destination)
+                _django_static._ensure_dir(directory)
+                fd, tmp_path = tempfile.mkstemp(prefix='.import-', dir=directory)
+                extracted.append((tmp_path, destination))
+                with os.fdopen(fd, 'wb') as f:
+                    shutil.copyfileobj(archive.open(name), f)
+                with open(tmp_path, 'rb') as f:
+                    if checksum(f) != expected:
+                        raise CommandError("Checksum mismatch for %s" % name)
+                # mkstemp() makes files only readable by us
+                os.chmod(tmp_path, 0644)
+        except:
+            for tmp_path, destination in extracted:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            raise
+    finally:
+        archive.close()
+
+    for tmp_path, destination in extracted:
+        _django_static._rename(tmp_path, destination)
+
+    if settings.DJANGO_STATIC_USE_MANIFEST_FILE:
+        manifest_path = os.path.join(settings.DJANGO_STATIC_MEDIA_ROOTS[0],
+                                     'manifest.json')
+        _django_static._publish_content(manifest_path,
+                                        json.dumps(file_map, indent=4))
+    else:
+        _django_static._save_file_map_snapshot(
+          settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT, file_map, merge=False,
+          imported=True)
+    return len(extracted)
+
+
+class Command(BaseCommand):
+    args = '<archive>'
+    help = "Unpacks an archive made by django_static_export"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', default=None,
+                    help="'tar' (gzipped) or 'zip'. Default is based on the "
+                         "archive's file extension."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Specify the archive to import")
+        count = import_(args[0], format=options['format'])
+        if int(options.get('verbosity', 1)):
+            self.stdout.write("Imported %d files from %s" % (count, args[0]))
@@ -0,0 +1,63 @@
+"""Middleware that shows how much of each request was spent in the
+django_static template tags.
+
+Add it to MIDDLEWARE_CLASSES:
+
+    MIDDLEWARE_CLASSES = (
+        'django_static.middleware.ProfilingMiddleware',
+        ...
+    )
+
+Whenever the tags take DJANGO_STATIC_PROFILE_THRESHOLD milliseconds (default
+100) or more in total, the response gets a Server-Timing header and a line
+of JSON with what every tag did is logged to the 'django_static' logger.
+"""
+import json
+import logging
+
+from django.conf import settings
+
+from django_static import stats
+# (for the default settings)
+from django_static.templatetags import django_static as _django_static
+
+logger = logging.getLogger('django_static')
+
+
+def _server_timing(collector):
+    records = collector.records
+    misses = len([x for x in records if x['status'] != 'hit'])
+    return ('django_static;dur=%.3f;desc="%d tags, %d not hits", '
+            'django_static_build;dur=%.3f' % (collector.total() * 1000,
+                                               len(records), misses,
+                                               collector.build_total() * 1000))
+
+
+class ProfilingMiddleware(object):
+
+    def process_request(self, request):
+        stats.set_collector(stats.Collector())
+
+    def process_response(self, request, response):
+        collector = stats.get_collector()
+        if collector is None:
+            # e.g. an earlier middleware returned a response
+            return response
+        stats.set_collector(None)
+        total = collector.total()
+        if not collector.records or \
+          total * 1000 < settings.DJANGO_STATIC_PROFILE_THRESHOLD:
+            return response
+
+        server_timing = _server_timing(collector)
+        if response.has_header('Server-Timing'):
+            server_timing = response['Server-Timing'] + ', ' + server_timing
+        response['Server-Timing'] = server_timing
+
+        logger.warning(json.dumps({
+          'path': request.path,
+          'total': total,
+          'build': collector.build_total(),
+          'tags': collector.records,
+        }))
+        return response
@@ -0,0 +1,271 @@
+"""Built-in minifiers that don't need anything installed.
+
+minify_css() removes comments (except /*! ones) and whitespace that isn't
+needed in one pass over the CSS. In the same pass it finds the references to
+other files, i.e. url(...) (but not data: URIs) and @import "...", and can
+have them all rewritten in one go, which is what django_static needs anyway.
+Strings and comments are skipped as a whole so nothing in them is taken for
+a reference or has its whitespace removed.
+
+minify_js() removes comments (except /*! ones) and whitespace from
+JavaScript. It tells regular expression literals from divisions by what
+comes before them and keeps line breaks where automatic semicolon insertion
+might depend on them, the way jsmin does, but works on whole tokens found by
+a regular expression rather than on one character at a time.
+"""
+import re
+
+_CSS_TOKENS = re.compile(r'''
+    (?P<comment>/\*.*?(?:\*/|\Z))
+  | (?P<string>"(?:[^"\\\n]|\\.)*"?|'(?:[^'\\\n]|\\.)*'?)
+  | (?P<url>url\(\s*(?:"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|[^)"'\s]*)\s*\))
+  | (?P<import>@import\b)
+  | (?P<space>\s+)
+  | (?P<other>[^/"'\s@uU;{}]+|.)
+''', re.S | re.X | re.I)
+
+# whitespace after and before these characters can go
+_CSS_NO_SPACE_AFTER = frozenset('{};:,>(!/')
+_CSS_NO_SPACE_BEFORE = frozenset('{};,>)!')
+
+# at-rules whose block has declarations in it rather than more rules
+_CSS_DECLARATION_AT_RULES = ('@font-face', '@page', '@viewport')
+
+
+def _css_tokens(css, minify):
+    """return (parts, references) where ''.join(parts) is the (minified) CSS
+    and references is a list of (index, url) for every part that is a
+    reference to another file"""
+    parts = []
+    references = []
+    space = False
+    after_import = False
+    # for every open block whether it has declarations in it, in which case
+    # the whitespace before a ':' can go too (in a selector it can't)
+    blocks = []
+    statement = 0
+    append = parts.append
+    for match in _CSS_TOKENS.finditer(css):
+        kind = match.lastgroup
+        token = match.group()
+        if kind == 'space':
+            if minify:
+                space = True
+            else:
+                append(token)
+            continue
+        if kind == 'comment':
+            if minify and not token.startswith('/*!'):
+                continue
+        if space:
+            space = False
+            if parts and parts[-1][-1] not in _CSS_NO_SPACE_AFTER and \
+              token[0] not in _CSS_NO_SPACE_BEFORE and \
+              not (token[0] == ':' and blocks and blocks[-1]):
+                append(' ')
+        if kind == 'url':
+            inner = token[4:-1].strip()
+            quote = inner[:1] in ('"', "'") and inner[0] or ''
+            url = quote and inner[1:-1] or inner
+            if minify:
+                token = 'url(%s%s%s)' % (quote, url, quote)
+            if url and not url.lower().startswith('data:'):
+                start = token.index(url, 4)
+                append(token[:start])
+                references.append((len(parts), url))
+                append(url)
+                append(token[start + len(url):])
+            else:
+                append(token)
+        elif kind == 'string' and after_import and len(token) > 2 and \
+          token[-1] == token[0]:
+            append(token[0])
+            references.append((len(parts), token[1:-1]))
+            append(token[1:-1])
+            append(token[-1])
+        elif kind == 'other' and token == '}' and minify and parts and \
+          parts[-1] == ';':
+            parts[-1] = '}'
+        else:
+            append(token)
+        if kind == 'other' and token in '{};':
+            if token == '{':
+                prelude = ''.join(parts[statement:-1]).strip().lower()
+                blocks.append(not prelude.startswith('@') or
+                              prelude.startswith(_CSS_DECLARATION_AT_RULES))
+            elif token == '}' and blocks:
+                blocks.pop()
+            statement = len(parts)
+        after_import = kind == 'import'
+    return parts, references
+
+
+def minify_css(css, rewrite=None, minify=True):
+    """return the CSS minified and, if `rewrite` is given, with the files it
+    refers to replaced. rewrite() gets the list of references and returns
+    the list of what to replace them with. With minify=False the CSS is
+    left as it is apart from that."""
+    parts, references = _css_tokens(css, minify)
+    if rewrite is not None and references:
+        replacements = rewrite([url for index, url in references])
+        for (index, url), replacement in zip(references, replacements):
+            parts[index] = replacement
+    return ''.join(parts)
+
+
+def css_references(css):
+    """return the files the CSS refers to"""
+    return [url for index, url in _css_tokens(css, False)[1]]
+
+
+_JS_TOKENS = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<linecomment>//[^\n\r]*)
+  | (?P<comment>/\*.*?(?:\*/|\Z))
+  | (?P<string>"(?:[^"\\\n\r]|\\(?:\r\n|.))*"?|'(?:[^'\\\n\r]|\\(?:\r\n|.))*'?)
+  | (?P<template>`(?:[^`\\$]|\\.|\$(?!\{))*(?:`|\$\{|\Z))
+  | (?P<word>(?:[\w$#\\]|[^\x00-\x7f])+)
+  | (?P<other>[!%&()*+,\-.:;<=>?@\[\]^|~]+|.)
+''', re.S | re.X | re.U)
+
+# the rest of a template literal after a ${...} in it
+_JS_TEMPLATE_REST = re.compile(r'(?:[^`\\$]|\\.|\$(?!\{))*(?:`|\$\{|\Z)', re.S)
+
+_JS_REGEX_LITERAL = re.compile(r'''
+    /(?![*/])(?:[^/\\\[\n\r]|\\.|\[(?:[^\]\\\n\r]|\\.)*\])+/(?:[\w$]|[^\x00-\x7f])*
+''', re.X | re.U)
+
+# a / after one of these starts a regular expression rather than a division
+_JS_REGEX_AFTER_WORDS = frozenset(['return', 'typeof', 'instanceof', 'in',
+                                   'of', 'new', 'delete', 'void', 'throw',
+                                   'case', 'do', 'else', 'yield', 'await'])
+_JS_DIVISION_AFTER = frozenset(')]')
+
+# A line break is only kept between these since anywhere else it can't
+# matter to automatic semicolon insertion (same as jsmin)
+_JS_NEWLINE_AFTER = frozenset(')]}"\'`+-')
+_JS_NEWLINE_BEFORE = frozenset('([{"\'`+-!~/')
+
+
+def _js_word_character(character):
+    return character.isalnum() or character in '_$#\\' or character > '\x7f'
+
+
+def _js_space(previous, previous_kind, token, newline):
+    """return what has to be kept of the whitespace between the two tokens"""
+    last, first = previous[-1], token[0]
+    last_is_word = _js_word_character(last)
+    first_is_word = _js_word_character(first)
+    if newline and (last_is_word or last in _JS_NEWLINE_AFTER or
+                    previous_kind == 'regex') and \
+      (first_is_word or first in _JS_NEWLINE_BEFORE):
+        return '\n'
+    if last_is_word and first_is_word:
+        return ' '
+    if previous_kind == 'regex' and first_is_word:
+        # /x/ in y  (otherwise the "in" becomes flags)
+        return ' '
+    if first == last and first in '+-/':
+        # a + +b, a - -b, a / /x/
+        return ' '
+    if last == '<' and first == '!':
+        # a < !--b would start an HTML comment
+        return ' '
+    if first == '.' and previous_kind == 'word' and previous.isdigit():
+        # 1 .toString()
+        return ' '
+    return ''
+
+
+def _js_regex_allowed(previous, previous_kind, before_previous):
+    if previous is None:
+        return True
+    if previous_kind == 'word':
+        if before_previous is not None and \
+          before_previous.endswith('.') and not before_previous.endswith('..'):
+            # a property, e.g. a.return / 2, not a keyword (but ...void 0
+            # is spread)
+            return False
+        return previous in _JS_REGEX_AFTER_WORDS
+    if previous_kind != 'other':
+        # strings, template literals and regular expressions
+        return False
+    last = previous[-1]
+    if last in _JS_DIVISION_AFTER:
+        return False
+    if last in '+-' and previous[-2:-1] == last:
+        # a++ / 2
+        return False
+    return True
+
+
+def minify_js(js):
+    """return the JavaScript without comments (except /*! ones) and without
+    the whitespace that isn't needed. Line breaks are kept wherever leaving
+    them out could change where semicolons are inserted."""
+    parts = []
+    append = parts.append
+    previous = previous_kind = before_previous = None
+    space = newline = False
+    # for every ${...} in a template literal that we're in, how many {
+    # deep into it we are
+    templates = []
+    position = 0
+    length = len(js)
+    while position < length:
+        for match in _JS_TOKENS.finditer(js, position):
+            kind = match.lastgroup
+            token = match.group()
+            if kind == 'space':
+                space = True
+                newline = newline or '\n' in token or '\r' in token
+                continue
+            if kind == 'linecomment':
+                space = newline = True
+                continue
+            if kind == 'comment' and not token.startswith('/*!'):
+                space = True
+                newline = newline or '\n' in token or '\r' in token
+                continue
+            # regular expressions and templates are matched on their own
+            # and the tokenizing carries on after them
+            restart = None
+            if token == '/' and \
+              _js_regex_allowed(previous, previous_kind, before_previous):
+                regex = _JS_REGEX_LITERAL.match(js, match.start())
+                if regex is not None:
+                    kind = 'regex'
+                    token = regex.group()
+                    restart = regex.end()
+            elif templates and token in ('{', '}'):
+                if token == '{':
+                    templates[-1] += 1
+                elif templates[-1]:
+                    templates[-1] -= 1
+                else:
+                    # the end of a ${...}
+                    templates.pop()
+                    rest = _JS_TEMPLATE_REST.match(js, match.end())
+                    kind = 'template'
+                    token += rest.group()
+                    restart = rest.end()
+            if kind == 'template':
+                if token.endswith('${'):
+                    templates.append(0)
+                    # (what follows is an expression)
+                    kind = 'other'
+                else:
+                    kind = 'string'
+            if space and previous is not None:
+                append(_js_space(previous, previous_kind, token, newline))
+            space = newline = False
+            append(token)
+            if kind != 'comment':
+                before_previous = previous
+                previous, previous_kind = token, kind
+            if restart is not None:
+                position = restart
+                break
+        else:
+            break
+    return ''.join(parts)
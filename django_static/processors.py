@@ -0,0 +1,101 @@
+"""Processors that can be put together in DJANGO_STATIC_PROCESSORS.
+
+A processor is a function that takes the content (unicode), a context dict
+and whatever config it was given in the settings as keyword arguments and
+returns the new content. The context has:
+
+    filename     the file (for a combination, the combined filename)
+    filenames    the files that are combined (just the one if it isn't)
+    type         'css' or 'js'
+    optimize_if_possible, symlink_if_possible
+                 as the file is built with
+
+The result of every processor is cached by the input, the processor and its
+config unless the processor has `cacheable = False` (e.g. because it depends
+on other files). A processor whose result also depends on something else
+can have a `cache_key(context, **config)` that returns it.
+
+A processor with `combines = True` gets the list of the contents of all the
+files instead and joins them. The processors before it are run on every file
+separately.
+"""
+import re
+
+from django_static.templatetags import django_static as _django_static
+
+
+def join(contents, context, separator=u'\n'):
+    """join the files of a combination with `separator` after each one (e.g.
+    u';\\n' for Javascript files that might not end with a semicolon)"""
+    return u''.join(x.strip() + separator for x in contents)
+join.combines = True
+
+
+def optimize(content, context, optimizer=None):
+    """optimize it with `optimizer` or whichever optimizer
+    django_static would use otherwise"""
+    if optimizer is None and not _django_static.has_optimizer(context['type']):
+        return content
+    return _django_static.optimize(content, context['type'], optimizer)
+
+def _optimize_cache_key(context, optimizer=None):
+    if optimizer is None and _django_static.has_optimizer(context['type']):
+        return _django_static._optimizer(context['type'])
+    return optimizer
+optimize.cache_key = _optimize_cache_key
+
+
+def rewrite_urls(content, context):
+    """build the files referred to in url(...) and @import and put their new
+    filenames in"""
+    return _django_static._rewrite_referred_css_urls(
+      content, context['filename'], context['optimize_if_possible'],
+      context['symlink_if_possible'])[0]
+# (the new filenames change when the files do)
+rewrite_urls.cacheable = False
+
+
+_BANNER_REGEX = re.compile(r'\A\s*(?:/\*.*?\*/|//[^\n]*(?:\n|\Z))', re.S)
+
+def strip_banners(content, context, keep_licenses=True):
+    """remove the comments at the top of the file, except /*! ... */ and
+    ones with @license or @preserve in them if keep_licenses"""
+    kept = []
+    while True:
+        match = _BANNER_REGEX.match(content)
+        if match is None:
+            break
+        comment = match.group().strip()
+        if keep_licenses and (comment.startswith('/*!') or
+                              '@license' in comment or
+                              '@preserve' in comment):
+            kept.append(comment + u'\n')
+        content = content[match.end():]
+    return u''.join(kept) + content.lstrip()
+
+
+DEFAULT_PREFIXES = {
+  'appearance': ['-webkit-', '-moz-'],
+  'backface-visibility': ['-webkit-'],
+  'hyphens': ['-webkit-', '-ms-'],
+  'text-size-adjust': ['-webkit-', '-moz-', '-ms-'],
+  'user-select': ['-webkit-', '-moz-', '-ms-'],
+}
+
+def autoprefix(content, context, prefixes=None):
+    """put vendor prefixed copies in front of the declarations of the
+    properties in `prefixes` ({property: [prefix, ...]})"""
+    if prefixes is None:
+        prefixes = DEFAULT_PREFIXES
+    if not prefixes:
+        return content
+    regex = re.compile(r'(?P<before>[{;]\s*)(?P<property>%s)\s*:'
+                       r'(?P<value>[^;{}]*)' %
+                       '|'.join(re.escape(x) for x in sorted(prefixes)))
+    def replace(match):
+        property_, value = match.group('property'), match.group('value')
+        prefixed = [u'%s%s:%s;' % (prefix, property_, value)
+                    for prefix in prefixes[property_]]
+        return match.group('before') + u''.join(prefixed) + \
+          match.group()[len(match.group('before')):]
+    return regex.sub(replace, content)
@@ -0,0 +1,280 @@
+"""A file map that all processes on the machine share through a memory
+mapped file (e.g. in /dev/shm) so that a file only has to be found and
+checked once, not once per web server process.
+
+The file is a fixed size hash table with open addressing (linear probing):
+
+    header  <8s I I I>   magic, number of slots, slot size, number used
+    slots   <I Q q H H>  sequence, key hash, m_time, key length, value length
+                         followed by the key and the value (new_filename),
+                         both UTF-8
+
+Readers don't take any locks. Every slot has a sequence number that a writer
+makes odd before it changes the slot and even again afterwards (a seqlock), so
+a reader that sees an odd number, or a different number after reading the
+slot than before, simply reads it again (after a while backing off). Writers
+take an exclusive fcntl lock on the file, and a lock within the process since
+fcntl locks are per process, so there's only ever one of them.
+
+Entries are never removed. If the table is full, or an entry is too big for
+a slot, it's kept in the process instead, in the `overflow` mapping (e.g. a
+BoundedFileMap so that doesn't grow for ever either).
+
+The table outlives the processes that use it, e.g. across a deploy, so it
+can have entries for files that have changed since. With `validate` every
+entry is checked, once per process, the first time it's read and if it's
+out of date it's treated as missing so it's built again and replaced.
+"""
+import os
+import mmap
+import fcntl
+import struct
+import hashlib
+import time
+import threading
+from contextlib import contextmanager
+
+MAGIC = 'DSMAP001'
+HEADER = struct.Struct('<8sIII')
+SLOT_HEADER = struct.Struct('<IQqHH')
+SEQUENCE = struct.Struct('<I')
+HEADER_SIZE = 64
+DEFAULT_SLOTS = 65536
+DEFAULT_SLOT_SIZE = 512
+MAX_PROBES = 64
+# how many times to read a slot that's being written to before backing off,
+# for how long to sleep at most before trying again and for how long to wait
+# in total before suspecting that its writer died
+SPINS = 100
+MAX_BACKOFF = 0.001
+REPAIR_AFTER = 0.05
+
+
+def _hash(key):
+    # never 0 since that marks an empty slot
+    return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0] or 1
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class SharedFileMap(object):
+    """Dict-like mapping of filename -> (new_filename, m_time) kept in a
+    memory mapped file shared by all processes that open the same path.
+
+    validate(key, m_time), if given, says whether an entry that was put
+    there, possibly by another process, is still right. overflow is where
+    what doesn't fit in the table is kept (a dict by default)."""
+
+    def __init__(self, path, slots=DEFAULT_SLOTS, slot_size=DEFAULT_SLOT_SIZE,
+                 validate=None, overflow=None):
+        self.path = path
+        self.validate = validate
+        # the keys that have been validated in this process
+        self._valid = set()
+        self._lock = threading.RLock()
+        self._lock_depth = 0
+        if overflow is None:
+            overflow = {}
+        self._overflow = overflow
+        self.hits = 0
+        self.misses = 0
+        self.retries = 0
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            header = os.read(self._fd, HEADER.size)
+            if len(header) == HEADER.size and header.startswith(MAGIC):
+                # use whatever size the process that created it chose
+                magic, slots, slot_size, used = HEADER.unpack(header)
+            else:
+                os.ftruncate(self._fd, HEADER_SIZE + slots * slot_size)
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.write(self._fd, HEADER.pack(MAGIC, slots, slot_size, 0))
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        self.slots = slots
+        self.slot_size = slot_size
+        self._map = mmap.mmap(self._fd, HEADER_SIZE + slots * slot_size)
+
+    def _offset(self, index):
+        return HEADER_SIZE + index * self.slot_size
+
+    @contextmanager
+    def _exclusive(self):
+        """lock out the other threads and then the other processes. Can be
+        nested, e.g. when a slot is repaired while writing."""
+        with self._lock:
+            self._lock_depth += 1
+            if self._lock_depth == 1:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if not self._lock_depth:
+                    fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def _read_slot(self, offset):
+        """return (hash, m_time, key, value) of the slot at offset"""
+        _map = self._map
+        attempts = 0
+        backoff = waited = 0
+        while True:
+            attempts += 1
+            if attempts > SPINS:
+                if waited >= REPAIR_AFTER:
+                    self._repair(offset)
+                    attempts = 0
+                    backoff = waited = 0
+                else:
+                    backoff = min(backoff * 2 or 0.00001, MAX_BACKOFF)
+                    time.sleep(backoff)
+                    waited += backoff
+            sequence = SEQUENCE.unpack_from(_map, offset)[0]
+            if sequence & 1:
+                # being written to right now
+                self.retries += 1
+                continue
+            (_, hash_, m_time, key_length, value_length) = \
+              SLOT_HEADER.unpack_from(_map, offset)
+            start = offset + SLOT_HEADER.size
+            key = _map[start:start + key_length]
+            value = _map[start + key_length:start + key_length + value_length]
+            if SEQUENCE.unpack_from(_map, offset)[0] == sequence:
+                return hash_, m_time, key, value
+            self.retries += 1
+
+    def _repair(self, offset):
+        """If a slot has been odd for this long the writer has probably been
+        killed half way through. Once we can get the lock we know it's not
+        being written to, by another process or another thread in this one,
+        so then it's emptied."""
+        with self._exclusive():
+            sequence = SEQUENCE.unpack_from(self._map, offset)[0]
+            if sequence & 1:
+                SLOT_HEADER.pack_into(self._map, offset, sequence + 1, 0, 0, 0, 0)
+
+    def _find(self, key, hash_):
+        """return the offset of the slot with the key or the empty slot
+        where it would go (and False) or (None, False) if there's neither"""
+        index = hash_ % self.slots
+        for i in xrange(min(MAX_PROBES, self.slots)):
+            offset = self._offset((index + i) % self.slots)
+            slot_hash, m_time, slot_key, value = self._read_slot(offset)
+            if not slot_hash:
+                return offset, False
+            if slot_hash == hash_ and slot_key == key:
+                return offset, True
+        return None, False
+
+    def get(self, key, default=None):
+        encoded = _encode(key)
+        hash_ = _hash(encoded)
+        index = hash_ % self.slots
+        for i in xrange(min(MAX_PROBES, self.slots)):
+            offset = self._offset((index + i) % self.slots)
+            slot_hash, m_time, slot_key, value = self._read_slot(offset)
+            if not slot_hash:
+                break
+            if slot_hash == hash_ and slot_key == encoded:
+                value = value.decode('utf-8'), m_time
+                if self.validate is not None and key not in self._valid:
+                    if not self.validate(key, m_time):
+                        self.misses += 1
+                        return default
+                    self._valid.add(key)
+                self.hits += 1
+                return value
+        value = self._overflow.get(key)
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        new_filename, m_time = value
+        encoded_key = _encode(key)
+        encoded_value = _encode(new_filename)
+        if SLOT_HEADER.size + len(encoded_key) + len(encoded_value) > \
+          self.slot_size:
+            self._overflow[key] = value
+            return
+        hash_ = _hash(encoded_key)
+        with self._exclusive():
+            offset, existing = self._find(encoded_key, hash_)
+            if offset is None:
+                self._overflow[key] = value
+                return
+            _map = self._map
+            sequence = SEQUENCE.unpack_from(_map, offset)[0]
+            SEQUENCE.pack_into(_map, offset, sequence + 1)
+            start = offset + SLOT_HEADER.size
+            _map[start:start + len(encoded_key)] = encoded_key
+            end = start + len(encoded_key)
+            _map[end:end + len(encoded_value)] = encoded_value
+            SLOT_HEADER.pack_into(_map, offset, sequence + 1, hash_,
+                                  m_time, len(encoded_key),
+                                  len(encoded_value))
+            SEQUENCE.pack_into(_map, offset, sequence + 2)
+            if not existing:
+                magic, slots, slot_size, used = HEADER.unpack_from(_map, 0)
+                HEADER.pack_into(_map, 0, magic, slots, slot_size, used + 1)
+        self._valid.add(key)
+        self._overflow.pop(key, None)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return HEADER.unpack_from(self._map, 0)[3] + len(self._overflow)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        items = []
+        for index in xrange(self.slots):
+            hash_, m_time, key, value = self._read_slot(self._offset(index))
+            if hash_:
+                items.append((key.decode('utf-8'),
+                              (value.decode('utf-8'), m_time)))
+        return items + self._overflow.items()
+
+    def keys(self):
+        return [key for key, value in self.items()]
+
+    def update(self, other):
+        if hasattr(other, 'items'):
+            other = other.items()
+        for key, value in other:
+            self[key] = value
+
+    def clear(self):
+        """only forgets what this process keeps for itself since other
+        processes might be reading the shared table"""
+        self._overflow.clear()
+
+    def stats(self):
+        return {
+          'size': len(self),
+          'capacity': self.slots,
+          'hits': self.hits,
+          'misses': self.misses,
+          'retries': self.retries,
+          'overflow': len(self._overflow),
+        }
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
@@ -0,0 +1,8 @@
+from django.dispatch import Signal
+
+# Sent for everything that django_static counts or times (see
+# django_static.stats). `event` is e.g. 'hit', 'miss', 'build_symlink' or
+# 'optimize_cssmin' and `key` is the filename (or ';' joined filenames of a
+# combo) it happened for. For timings `event` is 'timing', `phase` is one of
+# 'find', 'read', 'optimize' or 'write' and `duration` is in seconds.
+asset_event = Signal(providing_args=['event', 'key', 'phase', 'duration'])
@@ -0,0 +1,283 @@
+"""Counters and timings of what django_static does.
+
+Counting is always on because it's just a dict increment. Timings are kept
+as histograms per phase ('find', 'read', 'optimize', 'write') which only
+happen when a file is actually built.
+
+Anything that wants to know about every single event, with the key it
+happened for, can connect to django_static.signals.asset_event or set
+DJANGO_STATIC_STATS_CALLBACK to the dotted path of a function that takes
+(event, key, phase=None, duration=None). Neither costs anything when not
+used.
+
+Use get_stats() (also importable from the templatetags module) to get a
+snapshot for exporting to a metrics system.
+
+To break it down per template tag rendered in one request (see
+django_static.middleware), a Collector can be set for the current thread.
+
+How long each optimizer took and how much smaller it made things is kept
+per size of file in optimizer_costs, which is what the adaptive optimizer
+policy chooses by.
+"""
+import time
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+from django_static.signals import asset_event
+
+# upper bounds, in milliseconds, of the timing histogram buckets
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+# upper bounds, in bytes, of the file sizes optimizer costs are kept for
+SIZE_BUCKETS = (4 * 1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024)
+
+# (the increments aren't atomic across threads so under heavy concurrency a
+# count can be off by a little, which is fine for metrics)
+counters = defaultdict(int)
+timings = {}
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+        milliseconds = duration * 1000
+        for i, bound in enumerate(BUCKETS):
+            if milliseconds <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def snapshot(self):
+        buckets = dict(zip(BUCKETS, self.buckets))
+        buckets['inf'] = self.buckets[-1]
+        return {
+          'count': self.count,
+          'total': self.total,
+          'max': self.max,
+          'buckets': buckets,
+        }
+
+
+def size_bucket(size):
+    for bound in SIZE_BUCKETS:
+        if size <= bound:
+            return bound
+    return 'inf'
+
+
+class OptimizerCosts(object):
+    """what every optimizer has cost and saved, per type and size bucket"""
+
+    def __init__(self):
+        # (type_, optimizer, bucket) -> [count, seconds, input size,
+        # output size]
+        self._costs = {}
+        # (type_, bucket) -> {optimizer: how many times it was chosen}
+        self.decisions = defaultdict(lambda: defaultdict(int))
+
+    def record(self, type_, optimizer, size, duration, output_size):
+        key = (type_, optimizer, size_bucket(size))
+        try:
+            cost = self._costs[key]
+        except KeyError:
+            cost = self._costs[key] = [0, 0.0, 0, 0]
+        cost[0] += 1
+        cost[1] += duration
+        cost[2] += size
+        cost[3] += output_size
+
+    def get(self, type_, optimizer, bucket):
+        """return {'count', 'duration' (on average), 'throughput' (bytes per
+        second), 'ratio' (of output to input size)} or None if it hasn't
+        been used for files that size"""
+        try:
+            count, seconds, size, output_size = \
+              self._costs[(type_, optimizer, bucket)]
+        except KeyError:
+            return None
+        return {
+          'count': count,
+          'duration': seconds / count,
+          'throughput': seconds and size / seconds or None,
+          'ratio': size and float(output_size) / size or 1.0,
+        }
+
+    def decide(self, type_, bucket, optimizer):
+        self.decisions[(type_, bucket)][optimizer] += 1
+
+    def snapshot(self):
+        """return {type_: {bucket: {optimizer: cost and 'chosen'}}}"""
+        snapshot = {}
+        keys = set(self._costs)
+        for (type_, bucket), chosen in self.decisions.items():
+            keys.update((type_, x, bucket) for x in chosen)
+        for type_, optimizer, bucket in keys:
+            cost = self.get(type_, optimizer, bucket) or {'count': 0}
+            cost['chosen'] = self.decisions.get((type_, bucket), {}) \
+              .get(optimizer, 0)
+            snapshot.setdefault(type_, {}).setdefault(str(bucket), {}) \
+              [optimizer] = cost
+        return snapshot
+
+    def clear(self):
+        self._costs.clear()
+        self.decisions.clear()
+
+optimizer_costs = OptimizerCosts()
+
+
+def _load_callback():
+    callback_name = getattr(settings, 'DJANGO_STATIC_STATS_CALLBACK', None)
+    if not callback_name:
+        return None
+    _module_name, _function_name = callback_name.rsplit('.', 1)
+    return getattr(import_module(_module_name), _function_name)
+
+callback = _load_callback()
+
+
+def _emit(event, key, phase=None, duration=None):
+    if callback is not None:
+        callback(event, key, phase=phase, duration=duration)
+    if asset_event.receivers:
+        asset_event.send(sender=None, event=event, key=key, phase=phase,
+                         duration=duration)
+
+
+def incr(event, key=None):
+    counters[event] += 1
+    if callback is not None or asset_event.receivers:
+        _emit(event, key)
+    collector = _local.collector
+    if collector is not None:
+        collector.event(event, key)
+
+
+def timing(phase, key, duration):
+    try:
+        histogram = timings[phase]
+    except KeyError:
+        histogram = timings.setdefault(phase, Histogram())
+    histogram.add(duration)
+    if callback is not None or asset_event.receivers:
+        _emit('timing', key, phase=phase, duration=duration)
+    collector = _local.collector
+    if collector is not None:
+        collector.event('timing', key, phase, duration)
+
+
+class timer(object):
+    """time the block as `phase` for `key`
+
+        with timer('read', filename):
+            content = open(filepath).read()
+    """
+
+    def __init__(self, phase, key):
+        self.phase = phase
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        timing(self.phase, self.key, time.time() - self.start)
+
+
+class _Local(threading.local):
+    collector = None
+
+_local = _Local()
+
+def get_collector():
+    return _local.collector
+
+def set_collector(collector):
+    _local.collector = collector
+
+
+class Collector(object):
+    """what happened in each template tag rendered while this was the
+    current thread's collector"""
+
+    def __init__(self):
+        self.records = []
+        self._current = None
+
+    def start(self, node):
+        record = {
+          'node': node,
+          'keys': [],
+          'status': 'hit',
+          'build': 0.0,
+          'optimizers': [],
+          'profiles': [],
+          'duration': None,
+          'nested': self._current is not None,
+          't0': time.time(),
+        }
+        self.records.append(record)
+        previous, self._current = self._current, record
+        return previous
+
+    def stop(self, previous):
+        record = self._current
+        record['duration'] = time.time() - record.pop('t0')
+        self._current = previous
+
+    def event(self, event, key, phase=None, duration=None):
+        record = self._current
+        if record is None:
+            return
+        if event == 'timing':
+            record['build'] += duration
+        elif event.startswith('optimize_'):
+            record['optimizers'].append(event[len('optimize_'):])
+        elif event in ('hit', 'miss', 'revalidation', 'notfound'):
+            if key not in record['keys']:
+                record['keys'].append(key)
+            if event != 'hit' and record['status'] != 'miss':
+                record['status'] = event == 'revalidation' and event or 'miss'
+
+    def profile(self, path):
+        if self._current is not None:
+            self._current['profiles'].append(path)
+
+    def total(self):
+        # (the time of tags within other tags is already included)
+        return sum(x['duration'] or 0 for x in self.records
+                   if not x['nested'])
+
+    def build_total(self):
+        return sum(x['build'] for x in self.records)
+
+
+def snapshot():
+    return {
+      'counters': dict(counters),
+      'timings': dict((phase, histogram.snapshot())
+                      for phase, histogram in timings.items()),
+      'optimizers': optimizer_costs.snapshot(),
+    }
+
+
+def reset():
+    counters.clear()
+    timings.clear()
+    optimizer_costs.clear()
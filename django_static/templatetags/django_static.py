@@ -5,34 +5,47 @@ import sys
 import stat
 import shutil
 import codecs
+import errno
+import hashlib
 from collections import defaultdict
 from cStringIO import StringIO
-from subprocess import Popen, PIPE
 import warnings
 import fcntl
 import json
+import threading
+import itertools
+import time
+import atexit
+import tempfile
+from collections import namedtuple
 
 # django
 from django import template
 from django.conf import settings
 from django.template import TemplateSyntaxError
+from django.utils.importlib import import_module
 
-register = template.Library()
+# (this module is also called django_static so the others in the package
+# can't just be imported)
+_stats = import_module('django_static.stats')
+_minify = import_module('django_static.minify')
 
-try:
-    import slimmer
-except ImportError:
-    slimmer = None
+register = template.Library()
 
-try:
-    import cssmin
-except ImportError:
-    cssmin = None
+# The optimizers are only imported when they're first needed since some of
+# them (e.g. slimmer) take a while to import. None if it isn't installed.
+_optional_modules = {}
 
-try:
-    import jsmin
-except ImportError:
-    jsmin = None
+def _optional_module(name):
+    try:
+        return _optional_modules[name]
+    except KeyError:
+        try:
+            module = import_module(name)
+        except ImportError:
+            module = None
+        _optional_modules[name] = module
+        return module
 
 ################################################################################
 # The reason we're setting all of these into `settings` is so that in the code
@@ -51,22 +64,167 @@ settings.DJANGO_STATIC_MEDIA_URL = \
 settings.DJANGO_STATIC_MEDIA_URL_ALWAYS = \
   getattr(settings, "DJANGO_STATIC_MEDIA_URL_ALWAYS", False)
 
+settings.DJANGO_STATIC_LINK_MODE = getattr(settings, "DJANGO_STATIC_LINK_MODE", None)
+settings.DJANGO_STATIC_HASHED_SUBDIRS = \
+  getattr(settings, "DJANGO_STATIC_HASHED_SUBDIRS", False)
+settings.DJANGO_STATIC_BUILD_SOCKET = \
+  getattr(settings, "DJANGO_STATIC_BUILD_SOCKET", None)
+settings.DJANGO_STATIC_BUILD_TIMEOUT = \
+  getattr(settings, "DJANGO_STATIC_BUILD_TIMEOUT", 10)
 settings.DJANGO_STATIC_MEDIA_ROOTS = getattr(settings, "DJANGO_STATIC_MEDIA_ROOTS",
                                [settings.MEDIA_ROOT])
 settings.DJANGO_STATIC_USE_MANIFEST_FILE = \
   getattr(settings, "DJANGO_STATIC_USE_MANIFEST_FILE", False)
+settings.DJANGO_STATIC_BATCH_THREADS = \
+  getattr(settings, "DJANGO_STATIC_BATCH_THREADS", 4)
+settings.DJANGO_STATIC_FILE_MAP_SIZE = \
+  getattr(settings, "DJANGO_STATIC_FILE_MAP_SIZE", 10000)
+settings.DJANGO_STATIC_SHARED_MAP = \
+  getattr(settings, "DJANGO_STATIC_SHARED_MAP", None)
+settings.DJANGO_STATIC_SHARED_MAP_SLOTS = \
+  getattr(settings, "DJANGO_STATIC_SHARED_MAP_SLOTS", 65536)
+settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT = \
+  getattr(settings, "DJANGO_STATIC_FILE_MAP_SNAPSHOT", None)
+settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT_INTERVAL = \
+  getattr(settings, "DJANGO_STATIC_FILE_MAP_SNAPSHOT_INTERVAL", 60)
+settings.DJANGO_STATIC_PROFILE_DIR = \
+  getattr(settings, "DJANGO_STATIC_PROFILE_DIR", None)
+settings.DJANGO_STATIC_PROFILE_THRESHOLD = \
+  getattr(settings, "DJANGO_STATIC_PROFILE_THRESHOLD", 100)
 
 if sys.platform == "win32":
     _CAN_SYMLINK = False
 else:
     _CAN_SYMLINK = settings.DJANGO_STATIC_USE_SYMLINK
 
+
+def _compact(value):
+    """return a shared copy of a string if it can be interned"""
+    if not isinstance(value, basestring):
+        return value
+    try:
+        return intern(str(value))
+    except UnicodeEncodeError:
+        return value
+
+
+class BoundedFileMap(object):
+    """Dict-like mapping of filename -> (new_filename, m_time) that never holds
+    more than `capacity` entries.
+
+    Entries live in two generations. New and recently used entries go into the
+    young one and when that is half full the old generation is thrown away
+    and the young one becomes the old one. Looking something up in the old
+    generation moves it back to the young one. That gives a cheap
+    approximation of least-recently-used eviction without having to keep a
+    linked list or a counter for every entry.
+
+    Keys and filenames are interned so the very common case of the same
+    file in many different combinations doesn't keep many copies of it.
+    """
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self._young = {}
+        self._old = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self._young[key]
+        except KeyError:
+            try:
+                value = self._old.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._put(key, value)
+        self.hits += 1
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        key = _compact(key)
+        self._old.pop(key, None)
+        self._put(key, self._compact_value(value))
+
+    def _compact_value(self, value):
+        new_filename, m_time = value
+        return (_compact(new_filename), m_time)
+
+    def _put(self, key, value):
+        young = self._young
+        young[key] = value
+        if self.capacity and len(young) >= max(1, self.capacity // 2):
+            self.evictions += len(self._old)
+            self._old = young
+            self._young = {}
+
+    def __contains__(self, key):
+        return key in self._young or key in self._old
+
+    def __len__(self):
+        return len(self._young) + len(self._old)
+
+    # Unlike get() these don't move anything between the generations (which
+    # could throw one away half way through) and don't count as hits.
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return self._old.keys() + self._young.keys()
+
+    def items(self):
+        return self._old.items() + self._young.items()
+
+    def update(self, other):
+        if hasattr(other, 'items'):
+            other = other.items()
+        for key, value in other:
+            self[key] = value
+
+    def pop(self, key, default=None):
+        value = self._young.pop(key, self)
+        if value is self:
+            value = self._old.pop(key, default)
+        return value
+
+    def clear(self):
+        self._young = {}
+        self._old = {}
+
+    def stats(self):
+        return {
+          'size': len(self),
+          'capacity': self.capacity,
+          'hits': self.hits,
+          'misses': self.misses,
+          'evictions': self.evictions,
+        }
+
+
 # Wheree the mapping filename -> annotated_filename is kept
 
 if settings.DJANGO_STATIC_USE_MANIFEST_FILE:
     _MANIFEST_PATH = os.path.join(settings.DJANGO_STATIC_MEDIA_ROOTS[0], 'manifest.json')
+    _FILE_MAP = None
+elif settings.DJANGO_STATIC_SHARED_MAP:
+    # (the shared map outlives the processes, e.g. across a deploy, so the
+    # originals are checked the first time an entry is used)
+    _FILE_MAP = import_module('django_static.sharedmap').SharedFileMap(
+      settings.DJANGO_STATIC_SHARED_MAP, settings.DJANGO_STATIC_SHARED_MAP_SLOTS,
+      validate=lambda map_key, m_time: _source_m_time(map_key) == m_time,
+      overflow=BoundedFileMap(settings.DJANGO_STATIC_FILE_MAP_SIZE))
 else:
-    _FILE_MAP = {}
+    _FILE_MAP = BoundedFileMap(settings.DJANGO_STATIC_FILE_MAP_SIZE)
 
 ## These two methods are put here if someone wants to access the django_static
 ## functionality from code rather than from a django template
@@ -84,6 +242,34 @@ def staticfile(filename):
                         symlink_if_possible=_CAN_SYMLINK,
                         optimize_if_possible=False)
 
+## And these do the same for a whole list of files in one go
+## E.g.
+##   from django_static import slimfiles_batch
+##   print slimfiles_batch(['/css/foo.css', ['/js/a.js', '/js/b.js']])
+
+def slimfiles_batch(filenames):
+    return _static_files_batch(filenames,
+                               symlink_if_possible=_CAN_SYMLINK,
+                               optimize_if_possible=True)
+
+def staticfiles_batch(filenames):
+    return _static_files_batch(filenames,
+                               symlink_if_possible=_CAN_SYMLINK,
+                               optimize_if_possible=False)
+
+## A snapshot of the counters and timings in django_static.stats, and of the
+## file map, to export to a metrics system
+## E.g.
+##   from django_static import get_stats
+##   print get_stats()['counters']['hit']
+
+def get_stats():
+    stats = _stats.snapshot()
+    if not settings.DJANGO_STATIC_USE_MANIFEST_FILE and \
+      hasattr(_FILE_MAP, 'stats'):
+        stats['file_map'] = _FILE_MAP.stats()
+    return stats
+
 
 def _load_file_proxy():
     # This is a function so that it can be unit tested more easily
@@ -97,9 +283,11 @@ def _load_file_proxy():
         file_proxy_module = import_module(_module_name)
         return getattr(file_proxy_module, _function_name)
     except AttributeError:
-        def file_proxy_nothing(uri, *args, **kwargs):
-            return uri
         return file_proxy_nothing
+
+def file_proxy_nothing(uri, *args, **kwargs):
+    return uri
+
 file_proxy = _load_file_proxy()
 
 def _load_filename_generator():
@@ -120,6 +308,95 @@ _generate_filename = _load_filename_generator()
 # file proxy function you've defined.
 fp_default_kwargs = dict(new=False, changed=False, checked=False, notfound=False)
 
+# Once a file has been built, and when not in DEBUG mode, its URL only
+# changes if its entry in the file map does so it's kept here, with the new
+# filename it was made from, ready to be returned without going through the
+# settings or (when there is none) the file proxy. The file map stays the one
+# source of truth: a URL is only used while the entry for it still has the
+# same new filename, however the map was changed (or cleared, or replaced)
+# since. It isn't used with the manifest, which would have to be read for
+# that anyway. _reset_config() empties it.
+_url_cache = {}
+
+def _remember_url(map_key, new_filename, url):
+    global _url_cache
+    if settings.DJANGO_STATIC_USE_MANIFEST_FILE:
+        return
+    if len(_url_cache) >= settings.DJANGO_STATIC_FILE_MAP_SIZE:
+        # (replaced rather than cleared for the sake of other threads)
+        _url_cache = {}
+    _url_cache[map_key] = (new_filename, url)
+
+def _cached_url(map_key):
+    """return what _static_file() would for map_key if it's in _url_cache
+    or None"""
+    if settings.DEBUG:
+        return None
+    cached = _url_cache.get(map_key)
+    if cached is None:
+        return None
+    entry = _FILE_MAP.get(map_key)
+    if entry is None or entry[0] != cached[0]:
+        return None
+    _stats.incr('hit', map_key)
+    if file_proxy is file_proxy_nothing:
+        return cached[1]
+    return file_proxy(cached[1], **fp_default_kwargs)
+
+# Within one template render the same file is often resolved many times (e.g.
+# an icon <img> inside a {% for %} loop or the same {% staticfile %} in several
+# included templates). The result of each distinct lookup is remembered in the
+# outermost level of the context's render_context which Django pops as soon
+# as the render is finished.
+_RENDER_MEMO_KEY = 'django_static_memo'
+
+def _get_render_memo(context):
+    render_context = getattr(context, 'render_context', None)
+    if render_context is None or len(render_context.dicts) < 2:
+        # not rendered through Template.render() so there's no level we
+        # can be sure will be thrown away afterwards
+        return None
+    outermost = render_context.dicts[1]
+    memo = outermost.get(_RENDER_MEMO_KEY)
+    if memo is None:
+        memo = outermost[_RENDER_MEMO_KEY] = {}
+    return memo
+
+def _memoized_static_file(memo, filename, **kwargs):
+    """same as _static_file() but only does the work once per distinct
+    filename (and options) per memo."""
+    if memo is None:
+        return _static_file(filename, **kwargs)
+    if isinstance(filename, list):
+        memo_key = ';'.join(filename)
+    else:
+        memo_key = filename
+    memo_key = (memo_key,
+                kwargs.get('optimize_if_possible', False),
+                kwargs.get('symlink_if_possible', False))
+    try:
+        return memo[memo_key]
+    except KeyError:
+        new_filename = memo[memo_key] = _static_file(filename, **kwargs)
+        return new_filename
+
+
+def _profiled(render):
+    """record how long rendering the node takes if there's a collector
+    for this thread (see django_static.middleware)"""
+    def wrapper(self, context):
+        collector = _stats.get_collector()
+        if collector is None:
+            return render(self, context)
+        previous = collector.start(self.__class__.__name__)
+        try:
+            return render(self, context)
+        finally:
+            collector.stop(previous)
+    wrapper.__name__ = render.__name__
+    wrapper.__doc__ = render.__doc__
+    return wrapper
+
 
 class SlimContentNode(template.Node):
 
@@ -127,8 +404,10 @@ class SlimContentNode(template.Node):
         self.nodelist = nodelist
         self.format = format
 
+    @_profiled
     def render(self, context):
         code = self.nodelist.render(context)
+        slimmer = _optional_module('slimmer')
         if slimmer is None:
             return code
 
@@ -220,15 +499,21 @@ class StaticFileNode(template.Node):
         self.symlink_if_possible = symlink_if_possible
         self.context_name = context_name
 
+    @_profiled
     def render(self, context):
         filename = self.filename_var.resolve(context)
         if not settings.DJANGO_STATIC:
             if settings.DJANGO_STATIC_MEDIA_URL_ALWAYS:
                 return settings.DJANGO_STATIC_MEDIA_URL + filename
             return filename
-        new_filename = _static_file([x.strip() for x in filename.split(';')],
-                            optimize_if_possible=self.optimize_if_possible,
-                            symlink_if_possible=self.symlink_if_possible)
+        # most of the time it's a file that's already been built
+        filenames = [x.strip() for x in filename.split(';')]
+        new_filename = _cached_url(';'.join(filenames))
+        if new_filename is None:
+            new_filename = _memoized_static_file(_get_render_memo(context),
+                              filenames,
+                              optimize_if_possible=self.optimize_if_possible,
+                              symlink_if_possible=self.symlink_if_possible)
         if self.context_name:
             context[self.context_name] = new_filename
             return ''
@@ -273,6 +558,7 @@ class StaticFilesNode(template.Node):
 
         self.symlink_if_possible = symlink_if_possible
 
+    @_profiled
     def render(self, context):
         """inspect the code and look for files that can be turned into combos.
         Basically, the developer could type this:
@@ -303,6 +589,7 @@ class StaticFilesNode(template.Node):
 
             return code
 
+        memo = _get_render_memo(context)
         new_js_filenames = []
         for match in SCRIPTS_REGEX.finditer(code):
             whole_tag = match.group()
@@ -321,18 +608,24 @@ class StaticFilesNode(template.Node):
 
         # Now, we need to combine these files into one
         if new_js_filenames:
-            new_js_filename = _static_file(new_js_filenames,
+            new_js_filename = _memoized_static_file(memo, new_js_filenames,
                                optimize_if_possible=optimize_if_possible,
                                symlink_if_possible=self.symlink_if_possible)
         else:
             new_js_filename = None
 
-        new_image_filenames = []
+        image_filenames = []
+        for match in IMG_REGEX.finditer(code):
+            image_filenames.extend(match.groups())
+        new_image_filenames = dict(zip(image_filenames,
+          _static_files_batch(image_filenames,
+                              symlink_if_possible=self.symlink_if_possible,
+                              memo=memo)))
+
         def image_replacer(match):
             tag = match.group()
             for filename in match.groups():
-                new_filename = _static_file(filename,
-                                            symlink_if_possible=self.symlink_if_possible)
+                new_filename = new_image_filenames[filename]
                 if new_filename != filename:
                     tag = tag.replace(filename, new_filename)
             return tag
@@ -358,11 +651,12 @@ class StaticFilesNode(template.Node):
         # Now, we need to combine these files into one
         new_css_filenames_combined = {}
         if new_css_filenames:
-            for media_type, filenames in new_css_filenames.items():
-                r = _static_file(filenames,
-                                 optimize_if_possible=self.optimize_if_possible,
-                                 symlink_if_possible=self.symlink_if_possible)
-                new_css_filenames_combined[media_type] = r
+            media_types = new_css_filenames.keys()
+            r = _static_files_batch([new_css_filenames[x] for x in media_types],
+                                    optimize_if_possible=self.optimize_if_possible,
+                                    symlink_if_possible=self.symlink_if_possible,
+                                    memo=memo)
+            new_css_filenames_combined.update(zip(media_types, r))
 
 
         if new_js_filename:
@@ -384,25 +678,71 @@ class StaticFilesNode(template.Node):
 
         return code
 
-REFERRED_CSS_URLS_REGEX = re.compile('''url\(((?!["']?data:)[^\)]+)\)''')
-REFERRED_CSS_URLLESS_IMPORTS_REGEX = re.compile('@import\s+[\'"]([^\'"]+)[\'"]')
-
-def _static_file(filename,
-                 optimize_if_possible=False,
-                 symlink_if_possible=False,
-                 warn_no_file=True):
-    """
-    """
-    if not settings.DJANGO_STATIC:
-        return file_proxy(filename, disabled=True)
-
-    def wrap_up(filename):
-        if settings.DJANGO_STATIC_MEDIA_URL_ALWAYS:
-            return settings.DJANGO_STATIC_MEDIA_URL + filename
-        elif settings.DJANGO_STATIC_MEDIA_URL:
-            return settings.DJANGO_STATIC_MEDIA_URL + filename
-        return filename
 
+## Building can be left to a separate process, the django_static_daemon
+## command, listening on the unix socket DJANGO_STATIC_BUILD_SOCKET. Requests
+## and responses are one line of JSON each:
+##   {"files": [<filename or list of filenames>, ...],
+##    "optimize": true, "symlink": true}
+##   {"results": [[<new_filename>, <m_time>, <filepath>] or null, ...]}
+## where null means the file couldn't be found.
+
+# set to True in the daemon so that it doesn't send requests to itself
+_in_build_daemon = False
+
+def _request_build(files, optimize_if_possible, symlink_if_possible):
+    """return the results from the build daemon or None if it can't be
+    reached or doesn't answer within DJANGO_STATIC_BUILD_TIMEOUT seconds"""
+    request = json.dumps({'files': files,
+                          'optimize': optimize_if_possible,
+                          'symlink': symlink_if_possible})
+    # (only imported when there is a daemon)
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(settings.DJANGO_STATIC_BUILD_TIMEOUT)
+        sock.connect(settings.DJANGO_STATIC_BUILD_SOCKET)
+        sock.sendall(request + '\n')
+        response = sock.makefile('rb').readline()
+        return json.loads(response)['results']
+    except (socket.error, ValueError, KeyError):
+        return None
+    finally:
+        sock.close()
+
+def _build_in_daemon(filename, map_key, optimize_if_possible=False,
+                     symlink_if_possible=False):
+    """return what _static_file() would for the file after the daemon has
+    built it or None if that wasn't possible"""
+    results = _request_build([filename], optimize_if_possible,
+                             symlink_if_possible)
+    if results is None:
+        return None
+    if results[0] is None:
+        return file_proxy(_wrap_up(filename),
+                          **dict(fp_default_kwargs, filepath=None,
+                                 notfound=True))
+    new_filename, m_time, new_filepath = results[0]
+    # The daemon has already updated the manifest
+    if not settings.DJANGO_STATIC_USE_MANIFEST_FILE:
+        _FILE_MAP[map_key] = (new_filename, m_time)
+    url = _wrap_up(new_filename)
+    _remember_url(map_key, new_filename, url)
+    return file_proxy(url, **dict(fp_default_kwargs, new=True,
+                                  filepath=new_filepath, checked=True))
+
+
+def _wrap_up(filename):
+    if settings.DJANGO_STATIC_MEDIA_URL_ALWAYS:
+        return settings.DJANGO_STATIC_MEDIA_URL + filename
+    elif settings.DJANGO_STATIC_MEDIA_URL:
+        return settings.DJANGO_STATIC_MEDIA_URL + filename
+    return filename
+
+
+def _split_filename(filename):
+    """return (filename, is_combined_files, map_key) for what was passed to
+    _static_file()"""
     is_combined_files = isinstance(filename, list)
     if is_combined_files and len(filename) == 1:
         # e.g. passed a list of files but only one so treat it like a
@@ -414,12 +754,188 @@ def _static_file(filename,
         map_key = ';'.join(filename)
     else:
         map_key = filename
+    return filename, is_combined_files, map_key
+
+
+def _static_file(filename,
+                 optimize_if_possible=False,
+                 symlink_if_possible=False,
+                 warn_no_file=True):
+    """
+    """
+    if not settings.DJANGO_STATIC:
+        return file_proxy(filename, disabled=True)
+
+    if isinstance(filename, list):
+        url = _cached_url(';'.join(filename))
+    else:
+        url = _cached_url(filename)
+    if url is not None:
+        return url
+
+    filename, is_combined_files, map_key = _split_filename(filename)
 
     if settings.DJANGO_STATIC_USE_MANIFEST_FILE:
         new_filename, m_time = _get(_MANIFEST_PATH, map_key)
     else:
         new_filename, m_time = _FILE_MAP.get(map_key, (None, None))
 
+    if settings.DJANGO_STATIC_PROFILE_DIR and \
+      (not new_filename or settings.DEBUG):
+        return _profile_build(map_key, filename, is_combined_files, map_key,
+                              new_filename, m_time,
+                              optimize_if_possible=optimize_if_possible,
+                              symlink_if_possible=symlink_if_possible,
+                              warn_no_file=warn_no_file)
+    return _resolve_static_file(filename, is_combined_files, map_key,
+                                new_filename, m_time,
+                                optimize_if_possible=optimize_if_possible,
+                                symlink_if_possible=symlink_if_possible,
+                                warn_no_file=warn_no_file)
+
+
+def _profile_build(name, *args, **kwargs):
+    """call _resolve_static_file() with cProfile and save the result in
+    DJANGO_STATIC_PROFILE_DIR (open it with the pstats module)"""
+    import cProfile
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(_resolve_static_file, *args, **kwargs)
+    finally:
+        directory = settings.DJANGO_STATIC_PROFILE_DIR
+        # (not _ensure_dir() since nothing here would notice it's gone)
+        _mkdir(directory)
+        path = os.path.join(directory, '%s.%s-%s.prof' % (
+          re.sub(r'[^\w.-]+', '_', name).strip('_')[:100],
+          int(time.time() * 1000), _temporary_counter.next()))
+        profile.dump_stats(path)
+        collector = _stats.get_collector()
+        if collector is not None:
+            collector.profile(path)
+
+
+# The threads that batches are built in. One pool for the whole process
+# that's only made when it's first needed (and again after a fork, since
+# threads don't survive that, or if DJANGO_STATIC_BATCH_THREADS changes) so
+# there are never more than that many builds going on at once.
+_batch_pool = None
+_batch_pool_key = None
+_batch_pool_lock = threading.Lock()
+# whether the current thread is one of the pool's
+_batch_local = threading.local()
+
+def _get_batch_pool():
+    global _batch_pool, _batch_pool_key
+    key = (os.getpid(), settings.DJANGO_STATIC_BATCH_THREADS)
+    old_pool = None
+    with _batch_pool_lock:
+        if _batch_pool_key != key:
+            if _batch_pool is not None and _batch_pool_key[0] == key[0]:
+                old_pool = _batch_pool
+            from multiprocessing.pool import ThreadPool
+            _batch_pool = ThreadPool(key[1])
+            _batch_pool_key = key
+        pool = _batch_pool
+    if old_pool is not None:
+        # (whatever it's still doing is finished first)
+        old_pool.close()
+        old_pool.join()
+    return pool
+
+def _static_files_batch(filenames,
+                        optimize_if_possible=False,
+                        symlink_if_possible=False,
+                        warn_no_file=True,
+                        memo=None):
+    """Like _static_file() but for a list of filenames, each of which can
+    itself be a list of files to combine. Returns the new filenames in the
+    same order.
+
+    The manifest is only read once for the whole list and the ones that need
+    building (or checking in DEBUG mode) are built concurrently.
+    """
+    if not settings.DJANGO_STATIC:
+        return [file_proxy(x, disabled=True) for x in filenames]
+
+    if settings.DJANGO_STATIC_USE_MANIFEST_FILE:
+        file_map = _get_all(_MANIFEST_PATH)
+    else:
+        file_map = _FILE_MAP
+
+    results = {}
+    misses = []
+    for each in filenames:
+        each, is_combined_files, map_key = _split_filename(each)
+        if map_key in results:
+            continue
+        memo_key = (map_key, optimize_if_possible, symlink_if_possible)
+        if memo is not None and memo_key in memo:
+            results[map_key] = memo[memo_key]
+            continue
+        new_filename, m_time = file_map.get(map_key, (None, None))
+        if new_filename and not settings.DEBUG:
+            _stats.incr('hit', map_key)
+            url = _wrap_up(new_filename)
+            _remember_url(map_key, new_filename, url)
+            results[map_key] = file_proxy(url, **fp_default_kwargs)
+        else:
+            # reserve the spot so it's only built once
+            results[map_key] = None
+            misses.append((each, is_combined_files, map_key,
+                           new_filename, m_time))
+
+    # what happens in the threads below should be recorded as part of
+    # the tag being rendered in this one
+    collector = _stats.get_collector()
+
+    def build(miss):
+        if settings.DJANGO_STATIC_PROFILE_DIR:
+            resolve = lambda *args, **kwargs: _profile_build(miss[2], *args, **kwargs)
+        else:
+            resolve = _resolve_static_file
+        previous = _stats.get_collector()
+        _stats.set_collector(collector)
+        try:
+            return resolve(*miss,
+                           optimize_if_possible=optimize_if_possible,
+                           symlink_if_possible=symlink_if_possible,
+                           warn_no_file=warn_no_file)
+        finally:
+            _stats.set_collector(previous)
+
+    def build_in_pool(miss):
+        _batch_local.in_pool = True
+        try:
+            return build(miss)
+        finally:
+            _batch_local.in_pool = False
+
+    # In one of the pool's threads (e.g. for the files a CSS file refers to)
+    # they're built right here since waiting for the pool from inside it
+    # could wait for ever.
+    if len(misses) > 1 and settings.DJANGO_STATIC_BATCH_THREADS > 1 and \
+      not getattr(_batch_local, 'in_pool', False):
+        built = _get_batch_pool().map(build_in_pool, misses)
+    else:
+        built = [build(x) for x in misses]
+    for miss, new_filename in zip(misses, built):
+        results[miss[2]] = new_filename
+
+    if memo is not None:
+        for map_key, new_filename in results.items():
+            memo[(map_key, optimize_if_possible, symlink_if_possible)] = \
+              new_filename
+
+    return [results[_split_filename(x)[2]] for x in filenames]
+
+
+def _resolve_static_file(filename, is_combined_files, map_key,
+                         new_filename, m_time,
+                         optimize_if_possible=False,
+                         symlink_if_possible=False,
+                         warn_no_file=True):
+    """do the work of _static_file() once the map entry (new_filename and
+    m_time) for the file has been looked up"""
 
     # we might already have done a conversion but the question is
     # if the file has changed. This we only want
@@ -428,13 +944,33 @@ def _static_file(filename,
     if new_filename:
         if settings.DEBUG:
             # need to check if the original has changed
+            _stats.incr('revalidation', map_key)
             old_new_filename = new_filename
             new_filename = None
         else:
             # This is really fast and only happens when NOT in DEBUG mode
             # since it doesn't do any comparison
-            return file_proxy(wrap_up(new_filename), **fp_default_kwargs)
+            _stats.incr('hit', map_key)
+            url = _wrap_up(new_filename)
+            _remember_url(map_key, new_filename, url)
+            return file_proxy(url, **fp_default_kwargs)
+    elif settings.DJANGO_STATIC_BUILD_SOCKET and not _in_build_daemon:
+        _stats.incr('miss', map_key)
+        # Let the build daemon do it
+        result = _build_in_daemon(filename, map_key,
+                                  optimize_if_possible=optimize_if_possible,
+                                  symlink_if_possible=symlink_if_possible)
+        if result is not None:
+            return result
+        if not is_combined_files:
+            # The daemon isn't running or didn't answer in time so the
+            # original file will have to do until next time.
+            return file_proxy(_wrap_up(filename), **fp_default_kwargs)
+        # ...but there's no original to use for a combo so we'll have to
+        # build it here after all.
+        old_new_filename = None
     else:
+        _stats.incr('miss', map_key)
         # This is important so that we can know that there wasn't an
         # old file which will help us know we don't need to delete
         # the old one
@@ -445,10 +981,12 @@ def _static_file(filename,
         if is_combined_files:
             # It's a list! We have to combine it into one file
             new_file_content = StringIO()
+            parts = []
             each_m_times = []
             extension = None
             for each in filename:
-                filepath, path = _find_filepath_in_roots(each)
+                with _stats.timer('find', map_key):
+                    filepath, path = _find_filepath_in_roots(each)
                 if not filepath:
                     raise OSError("Failed to find %s in %s" % (each,
                         ",".join(settings.DJANGO_STATIC_MEDIA_ROOTS)))
@@ -460,7 +998,10 @@ def _static_file(filename,
                 else:
                     extension = os.path.splitext(filepath)[1]
                 each_m_times.append(os.stat(filepath)[stat.ST_MTIME])
-                new_file_content.write(open(filepath, 'r').read().strip())
+                with _stats.timer('read', map_key):
+                    part = open(filepath, 'r').read()
+                parts.append(part)
+                new_file_content.write(part.strip())
                 new_file_content.write('\n')
 
             filename = _combine_filenames(filename, settings.DJANGO_STATIC_NAME_MAX_LENGTH)
@@ -471,13 +1012,15 @@ def _static_file(filename,
             new_m_time = max(each_m_times)
 
         else:
-            filepath, path = _find_filepath_in_roots(filename)
+            with _stats.timer('find', map_key):
+                filepath, path = _find_filepath_in_roots(filename)
             if not filepath:
+                _stats.incr('notfound', map_key)
                 if warn_no_file:
                     msg = "Can't find file %s in %s" % \
                       (filename, ",".join(settings.DJANGO_STATIC_MEDIA_ROOTS))
                     warnings.warn(msg)
-                return file_proxy(wrap_up(filename),
+                return file_proxy(_wrap_up(filename),
                                   **dict(fp_default_kwargs,
                                          filepath=filepath,
                                          notfound=True))
@@ -491,37 +1034,35 @@ def _static_file(filename,
                 m_time = None
             else:
                 # ...and it hasn't changed!
-                return file_proxy(wrap_up(old_new_filename))
+                return file_proxy(_wrap_up(old_new_filename))
 
         if not m_time:
             # We did not have the filename in the map OR it has changed
             apart = os.path.splitext(filename)
             new_filename = _generate_filename(apart, new_m_time)
+            if settings.DJANGO_STATIC_HASHED_SUBDIRS and \
+              (optimize_if_possible or not new_filename.endswith('.css')):
+                # Unoptimized CSS files are left where they are because
+                # any relative url() in them would break otherwise.
+                new_filename = _hashed_filename(new_filename, map_key)
+            # (this is only recorded once the file has been written so
+            # that no other thread or process uses it before that)
             fileinfo = (settings.DJANGO_STATIC_NAME_PREFIX + new_filename,
                         new_m_time)
 
-
-            if settings.DJANGO_STATIC_USE_MANIFEST_FILE:
-                _set(_MANIFEST_PATH, map_key, fileinfo)
-            else:
-                _FILE_MAP[map_key] = fileinfo
-
-
             if old_new_filename:
                 old_new_filename = old_new_filename.replace(
                                       settings.DJANGO_STATIC_NAME_PREFIX, '')
                 old_new_filepath = _filename2filepath(old_new_filename,
                         settings.DJANGO_STATIC_SAVE_PREFIX or path)
-                if not os.path.isdir(os.path.dirname(old_new_filepath)):
-                    _mkdir(os.path.dirname(old_new_filepath))
+                _ensure_dir(os.path.dirname(old_new_filepath))
 
                 if os.path.isfile(old_new_filepath):
                     os.remove(old_new_filepath)
     new_filepath = _filename2filepath(new_filename,
             settings.DJANGO_STATIC_SAVE_PREFIX or path)
 
-    if not os.path.isdir(os.path.dirname(new_filepath)):
-        _mkdir(os.path.dirname(new_filepath))
+    _ensure_dir(os.path.dirname(new_filepath))
 
 
     # Files are either slimmered or symlinked or just copied. Basically, only
@@ -541,101 +1082,352 @@ def _static_file(filename,
             content = new_file_content.getvalue().decode('utf-8')
         else:
             #content = open(filepath).read()
-            content = codecs.open(filepath, 'r', 'utf-8').read()
-        if new_filename.endswith('.js') and has_optimizer(JS):
-            content = optimize(content, JS)
+            with _stats.timer('read', map_key):
+                content = codecs.open(filepath, 'r', 'utf-8').read()
+        pipeline = _pipeline(os.path.splitext(new_filename)[1])
+        if pipeline is not None:
+            # the processors configured in DJANGO_STATIC_PROCESSORS
+            context = {
+              'filename': filename,
+              'filenames': is_combined_files and map_key.split(';') or
+                           [filename],
+              'type': os.path.splitext(new_filename)[1][1:],
+              'optimize_if_possible': optimize_if_possible,
+              'symlink_if_possible': symlink_if_possible,
+            }
+            if is_combined_files:
+                contents = [x.decode('utf-8') for x in parts]
+            else:
+                contents = None
+            with _stats.timer('optimize', map_key):
+                content = _process(pipeline, content, contents, context)
+        elif new_filename.endswith('.js') and has_optimizer(JS):
+            with _stats.timer('optimize', map_key):
+                content = optimize(content, JS)
         elif new_filename.endswith('.css') and has_optimizer(CSS):
-            content = optimize(content, CSS)
-
-            # and _static_file() all images refered in the CSS file itself
-            def replacer(match):
-                this_filename = match.groups()[0]
-
-                if (this_filename.startswith('"') and this_filename.endswith('"')) or \
-                  (this_filename.startswith("'") and this_filename.endswith("'")):
-                    this_filename = this_filename[1:-1]
-                # It's really quite common that the CSS file refers to the file
-                # that doesn't exist because if you refer to an image in CSS for
-                # a selector you never use you simply don't suffer.
-                # That's why we say not to warn on nonexisting files
-
-                replace_with = this_filename
-
-                if not (this_filename.startswith('/') or \
-                  (this_filename.startswith('http') and '://' in this_filename)):
-                    # if the referenced filename is something like
-                    # 'images/foo.jpg' or 'sub/module.css' then we need to copy the
-                    # current relative directory
-                    replace_with = this_filename
-                    this_filename = os.path.join(os.path.dirname(filename), this_filename)
-                optimize_again = optimize_if_possible and \
-                                 this_filename.lower().endswith('.css') or False
-                new_filename = _static_file(this_filename,
-                                            symlink_if_possible=symlink_if_possible,
-                                            optimize_if_possible=optimize_again,
-                                            warn_no_file=settings.DEBUG and True or False)
-                return match.group().replace(replace_with, new_filename)
-
-            content = REFERRED_CSS_URLS_REGEX.sub(replacer, content)
-            content = REFERRED_CSS_URLLESS_IMPORTS_REGEX.sub(replacer, content)
-
-        elif slimmer or cssmin:
+            # and _static_file() all images refered in the CSS file itself,
+            # which the built-in minifier does in the same pass
+            optimizer = _optimizer_for(CSS, content)
+            if optimizer == 'builtin':
+                _stats.incr('optimize_builtin')
+                size = len(content)
+                started = time.time()
+                with _stats.timer('optimize', map_key):
+                    content, resolving = _rewrite_referred_css_urls(
+                      content, filename, optimize_if_possible,
+                      symlink_if_possible, minify=True)
+                _stats.optimizer_costs.record(
+                  CSS, optimizer, size, time.time() - started - resolving,
+                  len(content))
+            else:
+                with _stats.timer('optimize', map_key):
+                    content = optimize(content, CSS, optimizer)
+                content = _rewrite_referred_css_urls(
+                  content, filename, optimize_if_possible,
+                  symlink_if_possible)[0]
+
+        elif _optional_module('slimmer') or _optional_module('cssmin'):
             raise ValueError(
               "Unable to slimmer file %s. Unrecognized extension" % new_filename)
         #print "** STORING:", new_filepath
-        codecs.open(new_filepath, 'w', 'utf-8').write(content)
-    elif symlink_if_possible and not is_combined_files:
-        #print "** SYMLINK:", filepath, '-->', new_filepath
-
-        # The reason we have to do this strange while loop is that it can
-        # happen that in between the time it takes to destroy symlink till you
-        # can create it, another thread or process might be trying to do the
-        # exact same thing with just a fraction of a second difference, thus
-        # making it possible to, at the time of creating the symlink, that it's
-        # already there which will raise an OSError.
-        #
-        # This is quite possible when Django for example starts multiple fcgi
-        # threads roughly all at the same time. An alternative approach would
-        # be to store the global variable _FILE_MAP in a cache or something
-        # which would effectively make it thread safe but that has the annoying
-        # disadvantage that it remains in the cache between server restarts and
-        # for a production environment, server restarts very often happen
-        # because you have upgraded the code (and the static files). So, an
-        # alternative is to use a cache so that thread number 2, number 3 etc
-        # gets the file mappings of the first thread and then let this cache
-        # only last for a brief amount of time. That amount of time would
-        # basically be equivalent of the time the sys admin or developer would
-        # have to wait between new code deployment and refreshed symlinks for
-        # the static files. That feels convoluted and complex so I've decided
-        # to instead use this rather obtuse while loop which is basically built
-        # to try X number of times. If it still fails after X number of attempts
-        # there's something else wrong with the IO which needs to bubble up.
-        _max_attempts = 10
-        while True:
-            try:
-                if os.path.lexists(new_filepath):
-                    # since in the other cases we write a new file, it doesn't matter
-                    # that the file existed before.
-                    # That's not the case with symlinks
-                    os.unlink(new_filepath)
-
-                os.symlink(filepath, new_filepath)
-                break
-            except OSError:
-                _max_attempts -= 1
-                if _max_attempts <= 0:
-                    raise
+        with _stats.timer('write', map_key):
+            _publish_content(new_filepath, content.encode('utf-8'))
+        _stats.incr('build_optimize', map_key)
     elif is_combined_files:
         #print "** STORING COMBO:", new_filepath
-        open(new_filepath, 'w').write(new_file_content.getvalue())
+        with _stats.timer('write', map_key):
+            _publish_content(new_filepath, new_file_content.getvalue())
+        _stats.incr('build_combo', map_key)
     else:
-        # straight copy
-        #print "** STORING COPY:", new_filepath
-        shutil.copyfile(filepath, new_filepath)
+        # symlink, hardlink or some kind of copy
+        #print "** STORING FILE:", filepath, '-->', new_filepath
+        with _stats.timer('write', map_key):
+            mode = _publish_file(filepath, new_filepath,
+                                 _link_mode(symlink_if_possible))
+        _stats.incr('build_' + mode, map_key)
 
-    return file_proxy(wrap_up(settings.DJANGO_STATIC_NAME_PREFIX + new_filename),
-                      **dict(fp_default_kwargs, new=True,
-                             filepath=new_filepath, checked=True))
+    if settings.DJANGO_STATIC_USE_MANIFEST_FILE:
+        _set(_MANIFEST_PATH, map_key, fileinfo)
+    else:
+        _FILE_MAP[map_key] = fileinfo
+        if settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT:
+            _save_file_map_snapshot_periodically()
+
+    url = _wrap_up(fileinfo[0])
+    _remember_url(map_key, fileinfo[0], url)
+    return file_proxy(url, **dict(fp_default_kwargs, new=True,
+                                  filepath=new_filepath, checked=True))
+
+
+## All generated files are first written (or symlinked) to a unique temporary
+## name in the same directory and then renamed into place. The rename is
+## atomic so another thread or process, or nginx, either sees the old file or
+## the complete new one but never a half written one. And because it
+## replaces whatever is there, it doesn't matter if two processes (e.g. fcgi
+## threads started at the same time) publish the same file at the same time.
+
+_temporary_counter = itertools.count()
+
+def _temporary_filepath(new_filepath):
+    directory, basename = os.path.split(new_filepath)
+    return os.path.join(directory, '.%s.%s-%s-%s.tmp' % (
+      basename, os.getpid(), threading.current_thread().ident,
+      _temporary_counter.next()))
+
+def _rename(tmp_filepath, new_filepath):
+    if sys.platform == "win32" and os.path.lexists(new_filepath):
+        # os.rename() won't replace existing files on Windows
+        os.remove(new_filepath)
+    os.rename(tmp_filepath, new_filepath)
+
+def _publish(new_filepath, write):
+    """call write(tmp_filepath) and rename the result to new_filepath"""
+    tmp_filepath = _temporary_filepath(new_filepath)
+    try:
+        try:
+            write(tmp_filepath)
+        except (OSError, IOError), msg:
+            if msg.errno != errno.ENOENT:
+                raise
+            # the directory might have been deleted since we last knew
+            # it existed
+            directory = os.path.dirname(new_filepath)
+            _known_dirs.discard(directory)
+            _ensure_dir(directory)
+            write(tmp_filepath)
+        _rename(tmp_filepath, new_filepath)
+    finally:
+        # If it was a hardlink to the file that is already there the rename
+        # succeeds without doing anything.
+        if os.path.lexists(tmp_filepath):
+            os.remove(tmp_filepath)
+
+def _publish_content(new_filepath, content):
+    def write(tmp_filepath):
+        with open(tmp_filepath, 'wb') as f:
+            f.write(content)
+    _publish(new_filepath, write)
+
+def _publish_copy(filepath, new_filepath):
+    _publish(new_filepath, lambda tmp_filepath: shutil.copyfile(filepath, tmp_filepath))
+
+
+## Unoptimized single files can be put in place in different ways depending on
+## DJANGO_STATIC_LINK_MODE. Each of them falls back on the next one in
+## _LINK_MODE_FALLBACKS if the platform or filesystem doesn't support it and
+## that is remembered per device so it isn't tried again.
+
+SYMLINK = 'symlink'
+HARDLINK = 'hardlink'
+REFLINK = 'reflink'
+COPY_FILE_RANGE = 'copy_file_range'
+SENDFILE = 'sendfile'
+COPY = 'copy'
+
+_LINK_MODE_FALLBACKS = {
+  SYMLINK: COPY,
+  HARDLINK: COPY,
+  REFLINK: COPY_FILE_RANGE,
+  COPY_FILE_RANGE: SENDFILE,
+  SENDFILE: COPY,
+}
+
+# From linux/fs.h
+_FICLONE = 0x40049409
+
+_unsupported_link_modes = set()
+
+def _link_mode(symlink_if_possible):
+    mode = settings.DJANGO_STATIC_LINK_MODE
+    if not mode:
+        return symlink_if_possible and SYMLINK or COPY
+    if mode not in _LINK_MODE_FALLBACKS and mode != COPY:
+        raise ValueError("Invalid DJANGO_STATIC_LINK_MODE %r" % mode)
+    if mode == SYMLINK and not symlink_if_possible:
+        return COPY
+    return mode
+
+# Python 2 has neither os.copy_file_range() nor os.sendfile() so they're
+# called in the C library. None if it doesn't have them.
+_libc_functions = {}
+
+def _libc_function(name, argtypes):
+    """return the libc function called name, whose arguments are of the
+    ctypes types called argtypes, or None if there isn't one"""
+    try:
+        return _libc_functions[name]
+    except KeyError:
+        pass
+    function = None
+    if sys.platform.startswith('linux'):
+        # (elsewhere sendfile() only sends to sockets, if it exists at all)
+        import ctypes
+        try:
+            function = getattr(ctypes.CDLL(None, use_errno=True), name)
+        except (OSError, AttributeError):
+            pass
+        else:
+            function.argtypes = [getattr(ctypes, x) for x in argtypes]
+            function.restype = ctypes.c_ssize_t
+    _libc_functions[name] = function
+    return function
+
+def _libc_call(name, argtypes, *args):
+    function = _libc_function(name, argtypes)
+    if function is None:
+        raise OSError(errno.ENOSYS, "%s() not available" % name)
+    result = function(*args)
+    if result < 0:
+        import ctypes
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return result
+
+def _copy_file_range(filepath, tmp_filepath):
+    argtypes = ('c_int', 'c_void_p', 'c_int', 'c_void_p', 'c_size_t',
+                'c_uint')
+    _copy_with(lambda src, dst, count: _libc_call(
+                 'copy_file_range', argtypes, src, None, dst, None, count, 0),
+               filepath, tmp_filepath)
+
+def _sendfile(filepath, tmp_filepath):
+    argtypes = ('c_int', 'c_int', 'c_void_p', 'c_size_t')
+    _copy_with(lambda src, dst, count: _libc_call(
+                 'sendfile', argtypes, dst, src, None, count),
+               filepath, tmp_filepath)
+
+def _copy_with(function, filepath, tmp_filepath):
+    with open(filepath, 'rb') as src, open(tmp_filepath, 'wb') as dst:
+        remaining = os.fstat(src.fileno()).st_size
+        while remaining > 0:
+            copied = function(src.fileno(), dst.fileno(), remaining)
+            if not copied:
+                break
+            remaining -= copied
+
+def _hardlink(filepath, tmp_filepath):
+    link = getattr(os, 'link', None)
+    if link is None:
+        raise OSError(errno.ENOSYS, "os.link() not available")
+    link(filepath, tmp_filepath)
+
+def _reflink(filepath, tmp_filepath):
+    with open(filepath, 'rb') as src, open(tmp_filepath, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+
+_LINK_MODE_FUNCTIONS = {
+  SYMLINK: lambda filepath, tmp_filepath: os.symlink(filepath, tmp_filepath),
+  HARDLINK: _hardlink,
+  REFLINK: _reflink,
+  COPY_FILE_RANGE: _copy_file_range,
+  SENDFILE: _sendfile,
+  COPY: shutil.copyfile,
+}
+
+def _publish_file(filepath, new_filepath, mode):
+    """put filepath in place as new_filepath and return the mode that was
+    actually used"""
+    directory = os.path.dirname(new_filepath)
+    device = _device(directory)
+    while mode != COPY:
+        if (mode, device) not in _unsupported_link_modes:
+            try:
+                _publish(new_filepath,
+                         lambda tmp_filepath: _LINK_MODE_FUNCTIONS[mode](filepath, tmp_filepath))
+                return mode
+            except (OSError, IOError), msg:
+                if msg.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+                # (by now _publish() has made the directory again if need be)
+                device = _device(directory)
+                _unsupported_link_modes.add((mode, device))
+        mode = _LINK_MODE_FALLBACKS[mode]
+    _publish_copy(filepath, new_filepath)
+    return COPY
+
+def _device(directory):
+    """return the device the directory is on or None if it has gone, in
+    which case _publish() makes it again"""
+    try:
+        return os.stat(directory).st_dev
+    except OSError, msg:
+        if msg.errno != errno.ENOENT:
+            raise
+        return None
+
+# what the different ways of linking and copying fail with when it's not
+# possible on this platform or between these filesystems
+_UNSUPPORTED_ERRNOS = set(getattr(errno, x) for x in
+  ('ENOSYS', 'EXDEV', 'EMLINK', 'EINVAL', 'ENOTTY', 'EOPNOTSUPP', 'ENOTSUP')
+  if hasattr(errno, x))
+
+
+def _hashed_filename(new_filename, map_key):
+    """put the new filename two levels of subdirectories down, named after
+    the hash of the map key, so that no single directory gets too many
+    files. E.g. /js/foo.123.js becomes /js/3f/a2/foo.123.js
+
+    The subdirectories only depend on the map key so every generation of the
+    same file ends up in the same place.
+    """
+    if isinstance(map_key, unicode):
+        map_key = map_key.encode('utf-8')
+    digest = hashlib.md5(map_key).hexdigest()
+    directory, basename = os.path.split(new_filename)
+    return os.path.join(directory, digest[:2], digest[2:4], basename)
+
+
+def _css_referred_filename(this_filename, filename):
+    """return the filename of a url referred to from inside the CSS file
+    `filename`"""
+    if not (this_filename.startswith('/') or \
+      (this_filename.startswith('http') and '://' in this_filename)):
+        # if the referenced filename is something like
+        # 'images/foo.jpg' or 'sub/module.css' then we need to copy the
+        # current relative directory
+        this_filename = os.path.join(os.path.dirname(filename), this_filename)
+    return this_filename
+
+
+def _rewrite_referred_css_urls(content, filename, optimize_if_possible,
+                               symlink_if_possible, minify=False):
+    """_static_file() all the files referred to in the CSS content, which
+    came from `filename`, and put the new filenames in. With minify=True the
+    content is minified with the built-in minifier in the same pass.
+
+    Returns the new content and how many seconds were spent on the referred
+    files."""
+    resolving = []
+    def rewrite(urls):
+        started = time.time()
+        # Resolve them all in one batch. Referred CSS files are optimized
+        # again but images and such aren't.
+        this_filenames = [_css_referred_filename(x, filename) for x in urls]
+        referred = {True: [], False: []}
+        for this_filename in this_filenames:
+            optimize_again = optimize_if_possible and \
+                             this_filename.lower().endswith('.css') or False
+            if this_filename not in referred[optimize_again]:
+                referred[optimize_again].append(this_filename)
+
+        new_filenames = {}
+        for optimize_again, batch in referred.items():
+            if not batch:
+                continue
+            # It's really quite common that the CSS file refers to the file
+            # that doesn't exist because if you refer to an image in CSS for
+            # a selector you never use you simply don't suffer.
+            # That's why we say not to warn on nonexisting files
+            results = _static_files_batch(batch,
+                                          symlink_if_possible=symlink_if_possible,
+                                          optimize_if_possible=optimize_again,
+                                          warn_no_file=settings.DEBUG and True or False)
+            new_filenames.update(zip(batch, results))
+        resolving.append(time.time() - started)
+        return [new_filenames[x] for x in this_filenames]
+
+    content = _minify.minify_css(content, rewrite=rewrite, minify=minify)
+    return content, sum(resolving)
 
 
 def _mkdir(newdir):
@@ -644,17 +1436,28 @@ def _mkdir(newdir):
         - regular file in the way, raise an exception
         - parent directory(ies) does not exist, make them as well
     """
-    if os.path.isdir(newdir):
-        pass
-    elif os.path.isfile(newdir):
-        raise OSError("a file with the same name as the desired " \
-                      "dir, '%s', already exists." % newdir)
-    else:
-        head, tail = os.path.split(newdir)
-        if head and not os.path.isdir(head):
-            _mkdir(head)
-        if tail:
-            os.mkdir(newdir)
+    try:
+        os.makedirs(newdir)
+    except OSError, msg:
+        # if another thread or process made it in the meantime that's fine
+        if msg.errno != errno.EEXIST or not os.path.isdir(newdir):
+            if os.path.isfile(newdir):
+                raise OSError("a file with the same name as the desired " \
+                              "dir, '%s', already exists." % newdir)
+            raise
+
+
+# Output directories that are known to exist so that we don't have to keep
+# asking the filesystem about the same few directories.
+_known_dirs = set()
+
+def _ensure_dir(directory):
+    if directory not in _known_dirs:
+        _mkdir(directory)
+        _known_dirs.add(directory)
+
+def _forget_known_dirs():
+    _known_dirs.clear()
 
 
 def _find_filepath_in_roots(filename):
@@ -760,92 +1563,573 @@ _combine_filenames = _load_combine_filenames_generator()
 CSS = 'css'
 JS = 'js'
 
-def has_optimizer(type_):
+## The optimizer settings are read once into _config rather than for every
+## file and which optimizer to use for CSS and JS is only worked out the first
+## time it's needed. Both are reset when the settings change (in tests) or
+## _reset_config() is called.
+
+_Config = namedtuple('_Config', 'yui_compressor closure_compiler jsmin '
+                               'css_optimizer js_optimizer '
+                               'optimizer_policy optimizer_target '
+                               'optimizer_timeout optimizer_fallback '
+                               'optimizer_failures optimizer_cool_down '
+                               'closure_batch_size processors processor_cache')
+
+def _load_config():
+    return _Config(
+      css_optimizer=getattr(settings, 'DJANGO_STATIC_CSS_OPTIMIZER', None),
+      js_optimizer=getattr(settings, 'DJANGO_STATIC_JS_OPTIMIZER', None),
+      optimizer_policy=getattr(settings, 'DJANGO_STATIC_OPTIMIZER_POLICY', None),
+      optimizer_target=getattr(settings, 'DJANGO_STATIC_OPTIMIZER_TARGET', 0),
+      optimizer_timeout=getattr(settings, 'DJANGO_STATIC_OPTIMIZER_TIMEOUT', 60),
+      optimizer_fallback=getattr(settings, 'DJANGO_STATIC_OPTIMIZER_FALLBACK',
+                                 'builtin'),
+      optimizer_failures=getattr(settings, 'DJANGO_STATIC_OPTIMIZER_FAILURES', 3),
+      optimizer_cool_down=getattr(settings, 'DJANGO_STATIC_OPTIMIZER_COOL_DOWN',
+                                  300),
+      closure_batch_size=getattr(settings, 'DJANGO_STATIC_CLOSURE_BATCH_SIZE',
+                                 100),
+      processors=getattr(settings, 'DJANGO_STATIC_PROCESSORS', None) or {},
+      processor_cache=getattr(settings, 'DJANGO_STATIC_PROCESSOR_CACHE', None),
+      yui_compressor=getattr(settings, 'DJANGO_STATIC_YUI_COMPRESSOR', None),
+      closure_compiler=getattr(settings, 'DJANGO_STATIC_CLOSURE_COMPILER', None),
+      jsmin=getattr(settings, 'DJANGO_STATIC_JSMIN', None),
+    )
+
+_config = _load_config()
+_chosen_optimizers = {}
+
+def _reset_config():
+    global _config, _url_cache
+    _config = _load_config()
+    _chosen_optimizers.clear()
+    _breakers.clear()
+    _pipelines.clear()
+    # (the URLs depend on e.g. DJANGO_STATIC_MEDIA_URL)
+    _url_cache = {}
+
+def _setting_changed(sender, setting, value, **kwargs):
+    global file_proxy, _generate_filename, _combine_filenames
+    if not setting.startswith('DJANGO_STATIC'):
+        return
+    _reset_config()
+    if setting == 'DJANGO_STATIC_FILE_PROXY':
+        file_proxy = _load_file_proxy()
+    elif setting == 'DJANGO_STATIC_FILENAME_GENERATOR':
+        _generate_filename = _load_filename_generator()
+    elif setting == 'DJANGO_STATIC_COMBINE_FILENAMES_GENERATOR':
+        _combine_filenames = _load_combine_filenames_generator()
+
+# Only override_settings() sends setting_changed. Before Django 1.8 the
+# signal lives in django.test which is slow to import so it's only connected
+# to if that has been imported already (as it has by the test runner).
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    setting_changed = getattr(sys.modules.get('django.test.signals'),
+                              'setting_changed', None)
+if setting_changed is not None:
+    setting_changed.connect(_setting_changed)
+
+def _configured_optimizer(setting, name):
+    if name not in _OPTIMIZERS:
+        raise ValueError("Unknown %s %r" % (setting, name))
+    return name
+
+def _choose_optimizer(type_):
+    """return the name of the optimizer to use for type_ or None"""
     if type_ == CSS:
-        if getattr(settings, 'DJANGO_STATIC_YUI_COMPRESSOR', None):
-            return True
-        return slimmer is not None or cssmin is not None
+        if _config.css_optimizer:
+            return _configured_optimizer('DJANGO_STATIC_CSS_OPTIMIZER',
+                                         _config.css_optimizer)
+        elif _optional_module('cssmin') is not None:
+            return 'cssmin'
+        elif _config.yui_compressor:
+            return 'yui_compressor'
+        elif _optional_module('slimmer') is not None:
+            return 'slimmer'
     elif type_ == JS:
-        if getattr(settings, 'DJANGO_STATIC_CLOSURE_COMPILER', None):
-            return True
-        if getattr(settings, 'DJANGO_STATIC_YUI_COMPRESSOR', None):
-            return True
-        if getattr(settings, 'DJANGO_STATIC_JSMIN', None):
-            assert jsmin is not None, "jsmin not installed"
-            return True
-        return slimmer is not None or cssmin is not None
+        if _config.js_optimizer:
+            return _configured_optimizer('DJANGO_STATIC_JS_OPTIMIZER',
+                                         _config.js_optimizer)
+        elif _config.closure_compiler:
+            return 'closure_compiler'
+        elif _config.yui_compressor:
+            return 'yui_compressor'
+        elif _config.jsmin:
+            assert _optional_module('jsmin') is not None, "jsmin not installed"
+            return 'jsmin'
+        elif _optional_module('slimmer') is not None or \
+          _optional_module('cssmin') is not None:
+            return 'slimmer'
     else:
         raise ValueError("Invalid type %r" % type_)
+    return None
 
-def optimize(content, type_):
+def _optimizer(type_):
+    try:
+        return _chosen_optimizers[type_]
+    except KeyError:
+        optimizer = _chosen_optimizers[type_] = _choose_optimizer(type_)
+        return optimizer
+
+def _candidate_optimizers(type_):
+    """return the names of all the optimizers there are for type_ in the
+    order of the fixed priority (with the built-in ones last)"""
+    key = ('candidates', type_)
+    try:
+        return _chosen_optimizers[key]
+    except KeyError:
+        pass
     if type_ == CSS:
-        if cssmin is not None:
-            return _run_cssmin(content)
-        elif getattr(settings, 'DJANGO_STATIC_YUI_COMPRESSOR', None):
-            return _run_yui_compressor(content, type_)
-        return slimmer.css_slimmer(content)
+        candidates = [
+          ('cssmin', _optional_module('cssmin') is not None),
+          ('yui_compressor', _config.yui_compressor),
+          ('slimmer', _optional_module('slimmer') is not None),
+        ]
     elif type_ == JS:
-        if getattr(settings, 'DJANGO_STATIC_CLOSURE_COMPILER', None):
-            return _run_closure_compiler(content)
-        if getattr(settings, 'DJANGO_STATIC_YUI_COMPRESSOR', None):
-            return _run_yui_compressor(content, type_)
-        if getattr(settings, 'DJANGO_STATIC_JSMIN', None):
-            return _run_jsmin(content)
-        return slimmer.js_slimmer(content)
+        candidates = [
+          ('closure_compiler', _config.closure_compiler),
+          ('yui_compressor', _config.yui_compressor),
+          ('jsmin', _optional_module('jsmin') is not None),
+          ('slimmer', _optional_module('slimmer') is not None),
+        ]
     else:
         raise ValueError("Invalid type %r" % type_)
+    candidates = [name for (name, available) in candidates if available]
+    candidates.append('builtin')
+    _chosen_optimizers[key] = candidates
+    return candidates
+
+def _adaptive_optimizer(type_, size):
+    """return the optimizer that has been the quickest for files this size
+    of those that make them at least DJANGO_STATIC_OPTIMIZER_TARGET smaller
+    (or the one that makes them the smallest if none do). Every one is
+    tried once for every size first."""
+    bucket = _stats.size_bucket(size)
+    costs = []
+    for optimizer in _candidate_optimizers(type_):
+        if _breaker_open(optimizer):
+            continue
+        cost = _stats.optimizer_costs.get(type_, optimizer, bucket)
+        if cost is None:
+            chosen = optimizer
+            break
+        costs.append((cost, optimizer))
+    else:
+        good_enough = [(cost['duration'], optimizer)
+                       for (cost, optimizer) in costs
+                       if 1 - cost['ratio'] >= _config.optimizer_target]
+        if good_enough:
+            chosen = min(good_enough)[1]
+        else:
+            chosen = min((cost['ratio'], optimizer)
+                         for (cost, optimizer) in costs)[1]
+    _stats.optimizer_costs.decide(type_, bucket, chosen)
+    return chosen
+
+def _optimizer_for(type_, content):
+    """return the name of the optimizer to use for this content"""
+    if _config.optimizer_policy == 'adaptive':
+        return _adaptive_optimizer(type_, len(content))
+    elif _config.optimizer_policy not in (None, 'priority'):
+        raise ValueError("Unknown DJANGO_STATIC_OPTIMIZER_POLICY %r" %
+                         _config.optimizer_policy)
+    optimizer = _optimizer(type_)
+    if optimizer is None:
+        raise ValueError("No optimizer for %r" % type_)
+    return optimizer
+
+def has_optimizer(type_):
+    if _config.optimizer_policy == 'adaptive':
+        # the built-in ones are always there
+        return bool(_candidate_optimizers(type_))
+    return _optimizer(type_) is not None
+
+def optimize(content, type_, optimizer=None):
+    if optimizer is None:
+        optimizer = _optimizer_for(type_, content)
+    if _optimized:
+        output = _optimized.pop((type_, optimizer, _digest(content)), None)
+        if output is not None:
+            _stats.incr('optimize_batched_' + optimizer)
+            return output
+    if _breaker_open(optimizer):
+        _stats.incr('optimize_skipped_' + optimizer)
+        return _optimize_fallback(content, type_)
+    _stats.incr('optimize_' + optimizer)
+    started = time.time()
+    try:
+        output = _OPTIMIZERS[optimizer](content, type_)
+    except OSError, msg:
+        if optimizer not in _EXTERNAL_OPTIMIZERS:
+            raise
+        # The process timed out or, sometimes, for
+        # unexplicable reasons, you get a Broken pipe when running the
+        # popen instance. It's always non-deterministic problem so it
+        # probably has something to do with concurrency or something
+        # really low level.
+        _stats.incr('optimize_failed_' + optimizer)
+        _breaker_failed(optimizer)
+        warnings.warn("%s failed: %s" % (optimizer, msg))
+        # (so that the adaptive policy knows it didn't make anything smaller)
+        _stats.optimizer_costs.record(type_, optimizer, len(content),
+                                      time.time() - started, len(content))
+        return _optimize_fallback(content, type_)
+    _breaker_succeeded(optimizer)
+    _stats.optimizer_costs.record(type_, optimizer, len(content),
+                                  time.time() - started, len(output))
+    return output
+
+## Instead of the optimizer (and for CSS the rewriting of the files referred
+## to) that's used by default, DJANGO_STATIC_PROCESSORS can have a list of
+## processors for each extension (see django_static.processors), e.g.
+##
+##   DJANGO_STATIC_PROCESSORS = {
+##     '.js': [
+##       'django_static.processors.strip_banners',
+##       ('django_static.processors.join', {'separator': u';\n'}),
+##       'django_static.processors.optimize',
+##     ],
+##   }
+##
+## If DJANGO_STATIC_PROCESSOR_CACHE is the name of a directory, the output of
+## every processor is kept there by the hash of its input, the processor and
+## its config so only the processors after the one whose config changed, or
+## that come after it, need to run again.
+
+# extension -> [(stage id, function, config)] or None
+_pipelines = {}
+
+def _pipeline(extension):
+    try:
+        return _pipelines[extension]
+    except KeyError:
+        pass
+    stages = _config.processors.get(extension)
+    if stages is None:
+        pipeline = None
+    else:
+        pipeline = []
+        for stage in stages:
+            if isinstance(stage, (list, tuple)):
+                stage, config = stage
+            else:
+                config = {}
+            if isinstance(stage, basestring):
+                _module_name, _function_name = stage.rsplit('.', 1)
+                function = getattr(import_module(_module_name), _function_name)
+            else:
+                function = stage
+                stage = '%s.%s' % (function.__module__, function.__name__)
+            pipeline.append((stage, function, config))
+    _pipelines[extension] = pipeline
+    return pipeline
+
+def _process(pipeline, content, contents, context):
+    """run the content, or the contents of all the files of a combination,
+    through the processors"""
+    combines = [getattr(x[1], 'combines', False) for x in pipeline]
+    if True in combines:
+        split = combines.index(True)
+    else:
+        split = 0
+    if contents is not None:
+        for stage in pipeline[:split]:
+            contents = [_run_processor(stage, x, context) for x in contents]
+        if True in combines:
+            content = _run_processor(pipeline[split], contents, context)
+        else:
+            content = u''.join(x.strip() + u'\n' for x in contents)
+    else:
+        for stage in pipeline[:split]:
+            content = _run_processor(stage, content, context)
+    for stage in pipeline[split + (True in combines):]:
+        content = _run_processor(stage, content, context)
+    return content
+
+def _run_processor(stage, content, context):
+    stage_id, function, config = stage
+    cache = _config.processor_cache
+    if cache and getattr(function, 'cacheable', True):
+        key = hashlib.md5()
+        key.update(stage_id)
+        key.update(json.dumps(config, sort_keys=True))
+        if hasattr(function, 'cache_key'):
+            key.update(repr(function.cache_key(context, **config)))
+        for each in isinstance(content, list) and content or [content]:
+            key.update(_digest(each))
+        key = key.hexdigest()
+        cache_filepath = os.path.join(cache, key[:2], key[2:])
+        try:
+            output = codecs.open(cache_filepath, 'r', 'utf-8').read()
+            _stats.incr('processor_cache_hit', stage_id)
+            return output
+        except IOError:
+            _stats.incr('processor_cache_miss', stage_id)
+    output = function(content, context, **config)
+    if cache and getattr(function, 'cacheable', True):
+        _mkdir(os.path.dirname(cache_filepath))
+        _publish_content(cache_filepath, output.encode('utf-8'))
+    return output
+
+## When many files are built at once (by the django_static_build command)
+## they can be optimized up front with optimize_batch(), which runs the
+## Closure Compiler on DJANGO_STATIC_CLOSURE_BATCH_SIZE files at a time
+## rather than starting a JVM for every file. The results are kept here,
+## by the hash of the content, until optimize() is called for it.
+
+# (type_, optimizer, digest of the content) -> optimized content
+_optimized = {}
+
+def _digest(content):
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.md5(content).hexdigest()
+
+def optimize_batch(contents, type_):
+    """return the optimized versions of the list of contents and keep them
+    for when optimize() is called for the same content"""
+    if _config.optimizer_policy == 'adaptive':
+        # (it depends on the size of each)
+        return [optimize(x, type_) for x in contents]
+    optimizer = _optimizer_for(type_, u'')
+    outputs = [None] * len(contents)
+    if optimizer == 'closure_compiler':
+        size = _config.closure_batch_size
+        for start in range(0, len(contents), size):
+            if _breaker_open(optimizer):
+                break
+            batch = contents[start:start + size]
+            try:
+                batch_outputs = _run_closure_compiler_batch(batch)
+            except OSError, msg:
+                _stats.incr('optimize_failed_' + optimizer)
+                _breaker_failed(optimizer)
+                warnings.warn("%s failed: %s" % (optimizer, msg))
+                continue
+            if batch_outputs is None:
+                # something in there has errors, which optimize() will put
+                # in the files in question
+                continue
+            _stats.incr('optimize_batch_' + optimizer)
+            _breaker_succeeded(optimizer)
+            outputs[start:start + size] = batch_outputs
+    for i, content in enumerate(contents):
+        if outputs[i] is None:
+            outputs[i] = optimize(content, type_, optimizer)
+        _optimized[(type_, optimizer, _digest(content))] = outputs[i]
+    return outputs
+
+## The optimizers that run in another process can get stuck or fail to start.
+## Then the fallback optimizer (the built-in one by default) is used instead
+## and after DJANGO_STATIC_OPTIMIZER_FAILURES failures in a row the
+## optimizer isn't tried again until DJANGO_STATIC_OPTIMIZER_COOL_DOWN
+## seconds later. After that one more failure is enough to stop trying again.
+
+_EXTERNAL_OPTIMIZERS = frozenset(['yui_compressor', 'closure_compiler'])
+
+# optimizer -> [failures in a row, time it can be tried again]
+_breakers = {}
+
+def _breaker_open(optimizer):
+    breaker = _breakers.get(optimizer)
+    return breaker is not None and breaker[1] > time.time()
+
+def _breaker_failed(optimizer):
+    breaker = _breakers.setdefault(optimizer, [0, 0])
+    breaker[0] += 1
+    if breaker[0] >= _config.optimizer_failures:
+        breaker[1] = time.time() + _config.optimizer_cool_down
+        _stats.incr('optimizer_breaker_open_' + optimizer)
+
+def _breaker_succeeded(optimizer):
+    if optimizer in _breakers:
+        del _breakers[optimizer]
+
+def _optimize_fallback(content, type_):
+    fallback = _config.optimizer_fallback
+    if not fallback:
+        return content
+    if fallback in _EXTERNAL_OPTIMIZERS:
+        raise ValueError("DJANGO_STATIC_OPTIMIZER_FALLBACK can't be %r" %
+                         fallback)
+    return optimize(content, type_, fallback)
+
+# Replaced in the tests. subprocess is imported when it's first needed.
+Popen = None
+
+# The command is run by a shell in a session (and so a process group) of its
+# own so it can be killed with whatever the shell started. The new session is
+# made by this wrapper rather than a preexec_fn, which isn't safe to use
+# while other threads (e.g. those building a batch) are running.
+_SETSID_WRAPPER = ('import os, sys; os.setsid(); '
+                   'os.execv("/bin/sh", ["/bin/sh", "-c", sys.argv[1]])')
+
+def _popen(cmd):
+    from subprocess import PIPE
+    popen = Popen
+    if popen is None:
+        from subprocess import Popen as popen
+    if sys.platform == "win32":
+        return popen(cmd, shell=True, stdout=PIPE, stdin=PIPE, stderr=PIPE)
+    return popen([sys.executable, '-c', _SETSID_WRAPPER, cmd],
+                 stdout=PIPE, stdin=PIPE, stderr=PIPE, close_fds=True)
+
+def _kill(proc):
+    """kill the process and everything it started"""
+    import signal
+    pid = getattr(proc, 'pid', None)
+    if pid is None:
+        return
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (OSError, AttributeError):
+        try:
+            proc.kill()
+        except (OSError, AttributeError):
+            pass
+
+def _communicate(proc, input):
+    """proc.communicate(input) but killing it and raising OSError if it
+    doesn't finish within DJANGO_STATIC_OPTIMIZER_TIMEOUT seconds"""
+    timeout = _config.optimizer_timeout
+    timed_out = []
+    if timeout:
+        def kill():
+            timed_out.append(True)
+            _kill(proc)
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+    try:
+        (stdoutdata, stderrdata) = proc.communicate(input)
+    finally:
+        if timeout:
+            timer.cancel()
+            # (so it's gone, and won't kill anything, once this returns)
+            timer.join()
+    if timed_out:
+        raise OSError(errno.ETIMEDOUT,
+                      "Killed after %s seconds" % timeout)
+    return stdoutdata, stderrdata
+
+def _check_output(proc, code, stdoutdata, stderrdata):
+    """raise OSError if the process failed without saying what's wrong with
+    the code, e.g. because there's no java or no such jar file, rather than
+    publishing its empty output"""
+    # (the mocked processes in the tests have no returncode)
+    returncode = getattr(proc, 'returncode', None)
+    if returncode or (not stdoutdata and code.strip()):
+        raise OSError(errno.EIO, "Exited with %s: %s" %
+                      (returncode, (stderrdata or '').strip()[:200]))
+
+# e.g. "2 error(s), 0 warning(s)" (or "2 errors" in older versions)
+_CLOSURE_ERRORS_REGEX = re.compile(r'[1-9]\d* error(\(s\)|s)')
 
 CLOSURE_COMMAND_TEMPLATE = "java -jar %(jarfile)s"
 def _run_closure_compiler(jscode):
-    cmd = CLOSURE_COMMAND_TEMPLATE % {'jarfile': settings.DJANGO_STATIC_CLOSURE_COMPILER}
-    proc = Popen(cmd, shell=True, stdout=PIPE, stdin=PIPE, stderr=PIPE)
-    try:
-        (stdoutdata, stderrdata) = proc.communicate(jscode)
-        if stderrdata:
-            # Check if there are real errors.
-            if re.search('[1-9]\d* error(s)', stderrdata) is None:
-                # Suppress the loud stderr output of closure compiler.
-                stderrdata = None
-    except OSError, msg: # pragma: no cover
-        # see comment on OSErrors inside _run_yui_compressor()
-        stderrdata = \
-          "OSError: %s. Try again by making a small change and reload" % msg
-    if stderrdata:
+    cmd = CLOSURE_COMMAND_TEMPLATE % {'jarfile': _config.closure_compiler}
+    proc = _popen(cmd)
+    (stdoutdata, stderrdata) = _communicate(proc, jscode)
+    # Check if there are real errors (otherwise the loud stderr output of
+    # closure compiler is suppressed).
+    if stderrdata and _CLOSURE_ERRORS_REGEX.search(stderrdata):
         return "/* ERRORS WHEN RUNNING CLOSURE COMPILER\n" + stderrdata + '\n*/\n' + jscode
+    _check_output(proc, jscode, stdoutdata, stderrdata)
 
     return stdoutdata
 
+# Every file is a chunk of its own (older versions of the compiler call them
+# modules), which all depend on an empty first one, and they're written to
+# files of their own.
+CLOSURE_BATCH_COMMAND_TEMPLATE = "java -jar %(jarfile)s %(arguments)s"
+def _run_closure_compiler_batch(jscodes):
+    """return the compiled jscodes or None if there were errors"""
+    import pipes
+    directory = tempfile.mkdtemp(prefix='django_static-closure-')
+    try:
+        output_prefix = os.path.join(directory, 'output-')
+        root = os.path.join(directory, 'root.js')
+        open(root, 'w').close()
+        arguments = ['--chunk_output_path_prefix', output_prefix,
+                     '--js', root, '--chunk', 'root:1']
+        for i, jscode in enumerate(jscodes):
+            filepath = os.path.join(directory, '%d.js' % i)
+            with open(filepath, 'wb') as f:
+                f.write(jscode.encode('utf-8'))
+            arguments.extend(['--js', filepath,
+                              '--chunk', 'chunk%d:1:root' % i])
+        cmd = CLOSURE_BATCH_COMMAND_TEMPLATE % {
+          'jarfile': _config.closure_compiler,
+          'arguments': ' '.join(pipes.quote(x) for x in arguments)}
+        proc = _popen(cmd)
+        (stdoutdata, stderrdata) = _communicate(proc, '')
+        if stderrdata and _CLOSURE_ERRORS_REGEX.search(stderrdata):
+            return None
+        returncode = getattr(proc, 'returncode', None)
+        if returncode:
+            raise OSError(errno.EIO, "Exited with %s: %s" %
+                          (returncode, (stderrdata or '').strip()[:200]))
+        outputs = []
+        for i in range(len(jscodes)):
+            try:
+                outputs.append(codecs.open(output_prefix + 'chunk%d.js' % i,
+                                           'r', 'utf-8').read())
+            except IOError:
+                return None
+        return outputs
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
 YUI_COMMAND_TEMPLATE = "java -jar %(jarfile)s --type=%(type)s"
 def _run_yui_compressor(code, type_):
     cmd = YUI_COMMAND_TEMPLATE % \
-      {'jarfile': settings.DJANGO_STATIC_YUI_COMPRESSOR,
+      {'jarfile': _config.yui_compressor,
        'type': type_}
-    proc = Popen(cmd, shell=True, stdout=PIPE, stdin=PIPE, stderr=PIPE)
-    try:
-        (stdoutdata, stderrdata) = proc.communicate(code)
-    except OSError, msg: # pragma: no cover
-        # Sometimes, for unexplicable reasons, you get a Broken pipe when
-        # running the popen instance. It's always non-deterministic problem
-        # so it probably has something to do with concurrency or something
-        # really low level.
-        stderrdata = \
-          "OSError: %s. Try again by making a small change and reload" % msg
+    proc = _popen(cmd)
+    (stdoutdata, stderrdata) = _communicate(proc, code)
 
-    if stderrdata:
+    # (it reports what's wrong with the code as "[ERROR] ..." lines)
+    if stderrdata and '[ERROR]' in stderrdata:
         return "/* ERRORS WHEN RUNNING YUI COMPRESSOR\n" + stderrdata + '\n*/\n' + code
+    _check_output(proc, code, stdoutdata, stderrdata)
 
     return stdoutdata
 
 
 def _run_cssmin(code):
-    output = cssmin.cssmin(code)
+    output = _optional_module('cssmin').cssmin(code)
     return output
 
 def _run_jsmin(code):
-    output = jsmin.jsmin(code)
+    output = _optional_module('jsmin').jsmin(code)
     return output
 
+def _run_slimmer(code, type_):
+    if type_ == CSS:
+        return _optional_module('slimmer').css_slimmer(code)
+    return _optional_module('slimmer').js_slimmer(code)
+
+def _run_builtin(code, type_):
+    if type_ == CSS:
+        return _minify.minify_css(code)
+    return _minify.minify_js(code)
+
+_OPTIMIZERS = {
+  'builtin': lambda code, type_: _run_builtin(code, type_),
+  'cssmin': lambda code, type_: _run_cssmin(code),
+  'yui_compressor': lambda code, type_: _run_yui_compressor(code, type_),
+  'closure_compiler': lambda code, type_: _run_closure_compiler(code),
+  'jsmin': lambda code, type_: _run_jsmin(code),
+  'slimmer': lambda code, type_: _run_slimmer(code, type_),
+}
+
 def _get(file, key):
+    return _get_all(file).get(key, (None, None))
+
+def _get_all(file):
+    _stats.incr('manifest_read')
     with _touchopen(file, "r") as f:
         previous_value = f.read()
         f.close()
@@ -853,29 +2137,198 @@ def _get(file, key):
             data = json.loads('{}')
         else:
             data = json.loads(previous_value.decode('utf8'))
-    return data.get(key, (None, None))
-
-def _set(file, key, value):
-    with _touchopen(file, "r+") as f:
-        # Acquire a non-blocking exclusive lock
-        fcntl.lockf(f, fcntl.LOCK_EX)
+    return data
 
-        # Read a previous value if present
-        previous_value = f.read()
-        if not previous_value:
-            data = json.loads('{}')
-        else:
-            data = json.loads(previous_value.decode('utf8'))
+# fcntl locks are per process so threads (e.g. those building a batch) need
+# their own lock around _set() too.
+_MANIFEST_LOCK = threading.Lock()
 
+def _set(file, key, value):
+    _stats.incr('manifest_write', key)
+    # The manifest itself is replaced with a new file, which readers don't
+    # need a lock for since they either get the old or the new one, so the
+    # writers lock a separate file. That way a writer that dies half way
+    # through doesn't leave a broken manifest behind either.
+    with _MANIFEST_LOCK, _touchopen(file + '.lock', "r+") as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        data = _get_all(file)
         data[key] = value
-
-        # Write the new value and truncate
-        f.seek(0)
-        f.write(json.dumps(data, indent=4).encode('utf8'))
-        f.truncate()
-        f.close()
+        _publish_content(file, json.dumps(data, indent=4).encode('utf8'))
 
 def _touchopen(filename, *args, **kwargs):
     fd = os.open(filename, os.O_RDWR | os.O_CREAT)
 
     return os.fdopen(fd, *args, **kwargs)
+
+
+## The in-memory _FILE_MAP can be saved to a snapshot file (on exit and every
+## DJANGO_STATIC_FILE_MAP_SNAPSHOT_INTERVAL seconds when it changes) and loaded
+## back in when the module is imported so new processes don't have to redo all
+## the finding, stat'ing and building.
+
+_FILE_MAP_SNAPSHOT_VERSION = 1
+_last_file_map_snapshot = [time.time()]
+
+def _find_output_filepath(new_filename):
+    """return where the file for a map entry's new filename is on disk or None
+    if it can't be found"""
+    prefix = settings.DJANGO_STATIC_NAME_PREFIX
+    if prefix:
+        if not new_filename.startswith(prefix):
+            return None
+        new_filename = new_filename[len(prefix):]
+    if settings.DJANGO_STATIC_SAVE_PREFIX:
+        roots = [settings.DJANGO_STATIC_SAVE_PREFIX]
+    else:
+        roots = settings.DJANGO_STATIC_MEDIA_ROOTS
+    for root in roots:
+        filepath = _filename2filepath(new_filename, root)
+        if os.path.exists(filepath):
+            return filepath
+    return None
+
+def _read_file_map_snapshot(path):
+    """return what's in the snapshot or None if there's none that was made
+    with the current settings"""
+    try:
+        data = json.loads(open(path).read().decode('utf8'))
+    except (IOError, ValueError):
+        return None
+    if data.get('version') != _FILE_MAP_SNAPSHOT_VERSION or \
+      data.get('name_prefix') != settings.DJANGO_STATIC_NAME_PREFIX or \
+      data.get('save_prefix') != settings.DJANGO_STATIC_SAVE_PREFIX:
+        return None
+    return data
+
+def _save_file_map_snapshot(path, file_map, merge=True, imported=None):
+    """save the file map to the snapshot, together with what's already in
+    it if merge (every process only has some of the files in its map).
+    An imported snapshot was made with the same files somewhere else so
+    the originals here, whose modification times will differ, aren't
+    checked when it's loaded."""
+    # (not dict(file_map), which would look every entry up)
+    files = dict(file_map.items())
+    if merge:
+        saved = _read_file_map_snapshot(path)
+        if saved is not None:
+            if imported is None:
+                imported = saved.get('imported', False)
+            if saved.get('imported'):
+                # what was imported is what this deploy was built with
+                files.update(saved['files'])
+            else:
+                for map_key, value in saved['files'].items():
+                    files.setdefault(map_key, value)
+    data = {
+      'version': _FILE_MAP_SNAPSHOT_VERSION,
+      'name_prefix': settings.DJANGO_STATIC_NAME_PREFIX,
+      'save_prefix': settings.DJANGO_STATIC_SAVE_PREFIX,
+      'imported': bool(imported),
+      'files': files,
+    }
+    # (so a process starting up never reads a half written snapshot)
+    _publish_content(path, json.dumps(data).encode('utf8'))
+    _last_file_map_snapshot[0] = time.time()
+
+# (pid, threading.Timer) of the save that's been scheduled, if there is one
+_scheduled_file_map_snapshot = [None]
+_scheduled_file_map_snapshot_lock = threading.Lock()
+
+def _save_file_map_snapshot_periodically():
+    """have the snapshot saved, in a thread of its own so the request that
+    changed the file map doesn't wait for it, at most every
+    DJANGO_STATIC_FILE_MAP_SNAPSHOT_INTERVAL seconds"""
+    interval = settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT_INTERVAL
+    if interval is None:
+        return
+    pid = os.getpid()
+    with _scheduled_file_map_snapshot_lock:
+        scheduled = _scheduled_file_map_snapshot[0]
+        # (a timer from before a fork won't ever go off in this process)
+        if scheduled is not None and scheduled[0] == pid:
+            return
+        delay = max(0, interval - (time.time() - _last_file_map_snapshot[0]))
+        timer = threading.Timer(delay, _save_scheduled_file_map_snapshot)
+        timer.daemon = True
+        _scheduled_file_map_snapshot[0] = (pid, timer)
+    timer.start()
+
+def _save_scheduled_file_map_snapshot():
+    with _scheduled_file_map_snapshot_lock:
+        # (anything that changes from now on needs another save)
+        _scheduled_file_map_snapshot[0] = None
+    path = settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT
+    if path and _FILE_MAP:
+        try:
+            _save_file_map_snapshot(path, _FILE_MAP)
+        except (IOError, OSError), msg:
+            warnings.warn("Unable to save the file map snapshot: %s" % msg)
+
+def _source_m_time(map_key):
+    """return the modification time that the map entry for map_key would
+    have if it was built now (for a combination, that of the newest of its
+    files) or None if any of its files can't be found"""
+    m_times = []
+    for filename in map_key.split(';'):
+        filepath = _find_filepath_in_roots(filename)[0]
+        if not filepath:
+            return None
+        try:
+            m_times.append(os.stat(filepath)[stat.ST_MTIME])
+        except OSError:
+            return None
+    return max(m_times)
+
+def _load_file_map_snapshot(path, check_originals=True):
+    """return the entries from the snapshot whose generated files still
+    exist and, if check_originals, whose original files haven't changed
+    since (which they can't have if the snapshot was imported)"""
+    data = _read_file_map_snapshot(path)
+    if data is None:
+        return {}
+    if data.get('imported'):
+        check_originals = False
+    file_map = {}
+    for map_key, (new_filename, m_time) in data['files'].items():
+        # (lookups outside DEBUG never check the originals so an entry
+        # for a file that was changed, e.g. by a deploy, would be used for
+        # as long as the process runs)
+        if _find_output_filepath(new_filename) and \
+          (not check_originals or _source_m_time(map_key) == m_time):
+            file_map[map_key] = (new_filename, m_time)
+    return file_map
+
+def _saved_file_map():
+    """return what's in the manifest and the file map snapshot (both, if
+    both are configured, since either might still be in use)"""
+    file_map = {}
+    if settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT:
+        # (processes that are still running might be using the entries
+        # for files that have changed since)
+        file_map.update(_load_file_map_snapshot(
+          settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT, check_originals=False))
+    if settings.DJANGO_STATIC_USE_MANIFEST_FILE:
+        manifest_path = os.path.join(settings.DJANGO_STATIC_MEDIA_ROOTS[0],
+                                     'manifest.json')
+        if os.path.isfile(manifest_path):
+            file_map.update(_get_all(manifest_path))
+    return file_map
+
+def _is_generated(new_filename):
+    """whether new_filename is the name of a file that has been built
+    according to the file map, the manifest or the file map snapshot"""
+    if _FILE_MAP is not None and \
+      new_filename in set(x[0] for __, x in _FILE_MAP.items()):
+        return True
+    return new_filename in set(x[0] for x in _saved_file_map().values())
+
+def _save_file_map_snapshot_on_exit():
+    if settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT and _FILE_MAP:
+        _save_file_map_snapshot(settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT,
+                                _FILE_MAP)
+
+if settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT and \
+  not settings.DJANGO_STATIC_USE_MANIFEST_FILE:
+    _FILE_MAP.update(_load_file_map_snapshot(
+      settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT))
+    atexit.register(_save_file_map_snapshot_on_exit)
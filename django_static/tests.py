@@ -1,6 +1,7 @@
 # -*- coding: UTF-8 -*-
 
 import codecs
+import errno
 import re
 import os
 import stat
@@ -10,6 +11,9 @@ from tempfile import mkdtemp, gettempdir
 from unittest import TestCase
 from shutil import rmtree
 import warnings
+import logging
+import json
+from cStringIO import StringIO
 
 import django_static.templatetags.django_static as _django_static
 from django_static.templatetags.django_static import _static_file, _combine_filenames
@@ -67,7 +71,21 @@ for name in [ "DEBUG",
               "DJANGO_STATIC_USE_SYMLINK",
               "DJANGO_STATIC_CLOSURE_COMPILER",
               "DJANGO_STATIC_MEDIA_ROOTS",
-              "DJANGO_STATIC_YUI_COMPRESSOR"]:
+              "DJANGO_STATIC_LINK_MODE",
+              "DJANGO_STATIC_HASHED_SUBDIRS",
+              "DJANGO_STATIC_YUI_COMPRESSOR",
+              "DJANGO_STATIC_CSS_OPTIMIZER",
+              "DJANGO_STATIC_JS_OPTIMIZER",
+              "DJANGO_STATIC_OPTIMIZER_POLICY",
+              "DJANGO_STATIC_OPTIMIZER_TARGET",
+              "DJANGO_STATIC_OPTIMIZER_TIMEOUT",
+              "DJANGO_STATIC_OPTIMIZER_FALLBACK",
+              "DJANGO_STATIC_OPTIMIZER_FAILURES",
+              "DJANGO_STATIC_OPTIMIZER_COOL_DOWN",
+              "DJANGO_STATIC_CLOSURE_BATCH_SIZE",
+              "DJANGO_STATIC_PROCESSORS",
+              "DJANGO_STATIC_PROCESSOR_CACHE",
+              "DJANGO_STATIC_FILE_MAP_SIZE"]:
     _saved_settings.append((name, getattr(settings, name, _marker)))
 
 class TestDjangoStatic(TestCase):
@@ -81,7 +99,6 @@ class TestDjangoStatic(TestCase):
         self.__added_filepaths.append(filepath)
 
     def setUp(self):
-        _django_static._FILE_MAP = {}
         self.__added_dirs = []
         self.__added_filepaths = []
         #if not os.path.isdir(TEST_MEDIA_ROOT):
@@ -98,12 +115,30 @@ class TestDjangoStatic(TestCase):
         settings.DJANGO_STATIC_MEDIA_URL = ""
         settings.DJANGO_STATIC_MEDIA_URL_ALWAYS = False
         settings.DJANGO_STATIC_USE_SYMLINK = True
+        settings.DJANGO_STATIC_LINK_MODE = None
+        settings.DJANGO_STATIC_HASHED_SUBDIRS = False
         settings.DJANGO_STATIC_FILE_PROXY = None
         settings.DJANGO_STATIC_CLOSURE_COMPILER = None
         settings.DJANGO_STATIC_YUI_COMPRESSOR = None
+        settings.DJANGO_STATIC_CSS_OPTIMIZER = None
+        settings.DJANGO_STATIC_JS_OPTIMIZER = None
+        settings.DJANGO_STATIC_OPTIMIZER_POLICY = None
+        settings.DJANGO_STATIC_OPTIMIZER_TARGET = 0
+        settings.DJANGO_STATIC_OPTIMIZER_TIMEOUT = 60
+        settings.DJANGO_STATIC_OPTIMIZER_FALLBACK = 'builtin'
+        settings.DJANGO_STATIC_OPTIMIZER_FAILURES = 3
+        settings.DJANGO_STATIC_OPTIMIZER_COOL_DOWN = 300
+        settings.DJANGO_STATIC_CLOSURE_BATCH_SIZE = 100
+        settings.DJANGO_STATIC_PROCESSORS = None
+        settings.DJANGO_STATIC_PROCESSOR_CACHE = None
         #if hasattr(settings, "DJANGO_STATIC_MEDIA_ROOTS"):
         #    del settings.DJANGO_STATIC_MEDIA_ROOTS
         settings.DJANGO_STATIC_MEDIA_ROOTS = [settings.MEDIA_ROOT]
+        settings.DJANGO_STATIC_FILE_MAP_SIZE = 10000
+        _django_static._reset_config()
+        # (the same kind of file map as when it's used for real)
+        _django_static._FILE_MAP = _django_static.BoundedFileMap(
+          settings.DJANGO_STATIC_FILE_MAP_SIZE)
 
         super(TestDjangoStatic, self).setUp()
 
@@ -113,6 +148,12 @@ class TestDjangoStatic(TestCase):
         return dir
 
     def tearDown(self):
+        # a snapshot save that a test has scheduled mustn't happen in another
+        scheduled = _django_static._scheduled_file_map_snapshot[0]
+        if scheduled is not None:
+            scheduled[1].cancel()
+            _django_static._scheduled_file_map_snapshot[0] = None
+
         for filepath in self.__added_filepaths:
             if os.path.isfile(filepath):
                 os.remove(filepath)
@@ -1466,19 +1507,24 @@ class TestDjangoStatic(TestCase):
 
         # definitely if you have defined a DJANGO_STATIC_YUI_COMPRESSOR
         settings.DJANGO_STATIC_YUI_COMPRESSOR = 'sure'
+        _django_static._reset_config()
         self.assertTrue(has_optimizer('css'))
         del settings.DJANGO_STATIC_YUI_COMPRESSOR
+        _django_static._reset_config()
 
         self.assertEqual(has_optimizer('css'), bool(slimmer or cssmin))
 
         # for javascript
         settings.DJANGO_STATIC_YUI_COMPRESSOR = 'sure'
         settings.DJANGO_STATIC_CLOSURE_COMPILER = 'sure'
+        _django_static._reset_config()
 
         self.assertTrue(has_optimizer('js'))
         del settings.DJANGO_STATIC_CLOSURE_COMPILER
+        _django_static._reset_config()
         self.assertTrue(has_optimizer('js'))
         del settings.DJANGO_STATIC_YUI_COMPRESSOR
+        _django_static._reset_config()
 
         self.assertEqual(has_optimizer('js'), bool(slimmer or cssmin))
 
@@ -1486,6 +1532,7 @@ class TestDjangoStatic(TestCase):
 
     def test_running_closure_compiler(self):
         settings.DJANGO_STATIC_CLOSURE_COMPILER = 'mocked'
+        _django_static._reset_config()
 
         import django_static.templatetags.django_static
         optimize = django_static.templatetags.django_static.optimize
@@ -1499,7 +1546,7 @@ class TestDjangoStatic(TestCase):
             def communicate(self, code):
                 self.code_in = code
                 if self.return_error:
-                    return '', 'Something wrong!'
+                    return '', 'Something wrong!\n1 error(s), 0 warning(s)'
                 else:
                     return code.strip().upper(), None
 
@@ -1521,6 +1568,7 @@ class TestDjangoStatic(TestCase):
           new_code.find('*/'))
 
         del settings.DJANGO_STATIC_CLOSURE_COMPILER
+        _django_static._reset_config()
         django_static.templatetags.django_static.Popen = MockedPopen
 
         new_code = optimize(code, 'js')
@@ -1533,6 +1581,7 @@ class TestDjangoStatic(TestCase):
             del settings.DJANGO_STATIC_CLOSURE_COMPILER
 
         settings.DJANGO_STATIC_YUI_COMPRESSOR = 'mocked'
+        _django_static._reset_config()
 
         import django_static.templatetags.django_static
         optimize = django_static.templatetags.django_static.optimize
@@ -1546,7 +1595,7 @@ class TestDjangoStatic(TestCase):
             def communicate(self, code):
                 self.code_in = code
                 if self.return_error:
-                    return '', 'Something wrong!'
+                    return '', '[ERROR] Something wrong!'
                 else:
                     return code.strip().upper(), None
 
@@ -2011,8 +2060,8 @@ class TestDjangoStatic(TestCase):
         self.assertEqual(re_html, [u'pax.jpg', u'data_foo.jpg'])
 
         # test some css
-        re_css = re.findall(_django_static.REFERRED_CSS_URLS_REGEX, css)
-        self.assertEqual(re_css, [u"'da39a3ee5e.eot'", u'pax.jpg', u"'data_yadda.jpg'"])
+        re_css = _django_static._minify.css_references(css)
+        self.assertEqual(re_css, [u'da39a3ee5e.eot', u'pax.jpg', u'data_yadda.jpg'])
 
     def test_slimall_with_defer(self):
         settings.DEBUG = False
@@ -2134,6 +2183,7 @@ class TestDjangoStatic(TestCase):
         settings.DJANGO_STATIC_JSMIN = True
         settings.DJANGO_STATIC_CLOSURE_COMPILER = None
         settings.DJANGO_STATIC_YUI_COMPRESSOR = None
+        _django_static._reset_config()
 
         dummy_content = "var foo = function(aaa) { return aaa + 1; }"
         open(settings.MEDIA_ROOT + '/test_A.js', 'w')\
@@ -2150,9 +2200,12 @@ class TestDjangoStatic(TestCase):
         self.assertTrue(len(dummy_content) > len(content))
 
     def test_fail_yui_compressor(self):
+        """a YUI Compressor that can't be run (here there's no such jar)
+        isn't taken to have made an empty file"""
         settings.DJANGO_STATIC = True
         settings.DJANGO_STATIC_CLOSURE_COMPILER = None
         settings.DJANGO_STATIC_YUI_COMPRESSOR = 'Something'
+        _django_static._reset_config()
 
         dummy_content = "var foo = function(aaa) { return aaa + 1; }"
         open(settings.MEDIA_ROOT + '/test_A.js', 'w')\
@@ -2163,18 +2216,25 @@ class TestDjangoStatic(TestCase):
         """
         template = Template(template_as_string)
         context = Context()
-        rendered = template.render(context).strip()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            rendered = template.render(context).strip()
         self.assertTrue(re.findall("/test_A\.\d+\.js", rendered))
         content = open(settings.MEDIA_ROOT + rendered).read()
-        self.assertTrue('ERROR' in content)
-        self.assertTrue(content.count('/*') and content.count('*/'))
-        # find it not compressed
-        self.assertTrue(dummy_content in content)
+        self.assertTrue('yui_compressor failed' in str(caught[0].message))
+        # the built-in optimizer was used instead
+        self.assertEqual(content, _django_static._minify.minify_js(dummy_content))
 
     def test_fail_closure_compressor(self):
+        """a Closure Compiler that can't be run (here there's no such jar)
+        isn't taken to have made an empty file"""
+        from django_static import stats
+        stats.reset()
         settings.DJANGO_STATIC = True
-        settings.DJANGO_STATIC_CLOSURE_COMPILER = 'Something'
+        settings.DJANGO_STATIC_CLOSURE_COMPILER = '/nonexistent/compiler.jar'
         settings.DJANGO_STATIC_YUI_COMPRESSOR = None
+        settings.DJANGO_STATIC_OPTIMIZER_FAILURES = 3
+        _django_static._reset_config()
 
         dummy_content = "var foo = function(aaa) { return aaa + 1; }"
         open(settings.MEDIA_ROOT + '/test_A.js', 'w')\
@@ -2185,20 +2245,1644 @@ class TestDjangoStatic(TestCase):
         """
         template = Template(template_as_string)
         context = Context()
-        rendered = template.render(context).strip()
-        self.assertTrue(re.findall("/test_A\.\d+\.js", rendered))
-        content = open(settings.MEDIA_ROOT + rendered).read()
-        self.assertTrue('ERROR' in content)
-        self.assertTrue(content.count('/*') and content.count('*/'))
-        # find it not compressed
-        self.assertTrue(dummy_content in content)
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            rendered = template.render(context).strip()
+            self.assertTrue(re.findall("/test_A\.\d+\.js", rendered))
+            content = open(settings.MEDIA_ROOT + rendered).read()
+            minified = _django_static._minify.minify_js(dummy_content)
+            self.assertEqual(content, minified)
+
+            for i in range(4):
+                self.assertEqual(_django_static.optimize(dummy_content, 'js'),
+                                 minified)
+        counters = stats.snapshot()['counters']
+        self.assertEqual(counters['optimize_failed_closure_compiler'], 3)
+        self.assertEqual(counters['optimize_skipped_closure_compiler'], 2)
+        self.assertTrue(_django_static._breaker_open('closure_compiler'))
+        stats.reset()
+
+    def test_render_memo(self):
+        """the same file rendered many times in one template render is only
+        resolved once"""
+        settings.DEBUG = True
+        settings.DJANGO_STATIC = True
+
+        open(settings.MEDIA_ROOT + '/img200.gif', 'w').write(_GIF_CONTENT)
+
+        calls = []
+        old_static_file = _django_static._static_file
+        def counting_static_file(filename, **kwargs):
+            calls.append(filename)
+            return old_static_file(filename, **kwargs)
+        _django_static._static_file = counting_static_file
+
+        try:
+            template_as_string = """{% load django_static %}
+            {% for i in items %}{% staticfile "/img200.gif" %}{% endfor %}
+            {% staticall %}
+            <img src="/img200.gif"><img src="/img200.gif">
+            {% endstaticall %}
+            """
+            template = Template(template_as_string)
+            context = Context({'items': range(5)})
+            rendered = template.render(context)
+            self.assertEqual(len(re.findall('/img200\.\d+\.gif', rendered)), 7)
+            self.assertEqual(len(calls), 1)
+
+            # a new render starts with a fresh memo
+            template.render(context)
+            self.assertEqual(len(calls), 2)
+        finally:
+            _django_static._static_file = old_static_file
+
+    def test_batch_functions(self):
+        """staticfiles_batch() and slimfiles_batch() resolve a whole list in
+        one go and return the new filenames in the same order"""
+        settings.DEBUG = False
+        settings.DJANGO_STATIC = True
+
+        open(settings.MEDIA_ROOT + '/img300.gif', 'w').write(_GIF_CONTENT)
+        open(settings.MEDIA_ROOT + '/img301.gif', 'w').write(_GIF_CONTENT)
+        open(settings.MEDIA_ROOT + '/foo300.js', 'w').write('var a = 1;\n')
+        open(settings.MEDIA_ROOT + '/bar300.js', 'w').write('var b = 2;\n')
+
+        filenames = ['/img300.gif',
+                     ['/foo300.js', '/bar300.js'],
+                     '/img301.gif',
+                     '/img300.gif']
+        result = _django_static.staticfiles_batch(filenames)
+        self.assertEqual(len(result), 4)
+        self.assertTrue(re.findall('/img300\.\d+\.gif', result[0]))
+        self.assertTrue(re.findall('/foo300_bar300\.\d+\.js', result[1]))
+        self.assertTrue(re.findall('/img301\.\d+\.gif', result[2]))
+        self.assertEqual(result[0], result[3])
+        for each in result:
+            self.assertTrue(os.path.lexists(settings.MEDIA_ROOT + each))
+
+        # the same as doing them one at a time
+        self.assertEqual(result[0], _django_static.staticfile('/img300.gif'))
+        self.assertEqual(result[1],
+                         _django_static.staticfile(['/foo300.js', '/bar300.js']))
+
+        result = _django_static.slimfiles_batch(['/foo300.js'])
+        content = open(settings.MEDIA_ROOT + result[0]).read()
+        if slimmer is not None or cssmin is not None:
+            self.assertEqual(content, 'var a=1;')
+
+        # every batch uses the same pool, even the ones for the files
+        # referred to by CSS files that are built in it
+        from multiprocessing import pool as pool_module
+        pools = []
+        old_pool = pool_module.ThreadPool
+        class CountingPool(old_pool):
+            def __init__(self, *args, **kwargs):
+                pools.append(self)
+                old_pool.__init__(self, *args, **kwargs)
+        pool_module.ThreadPool = CountingPool
+        settings.DEBUG = True
+        settings.DJANGO_STATIC_BATCH_THREADS = 2
+        try:
+            for name in ('a300', 'b300'):
+                open(settings.MEDIA_ROOT + '/%s.css' % name, 'w').write(
+                  'a { background: url(img300.gif) }\n'
+                  'b { background: url(img301.gif) }')
+            for i in range(3):
+                result = _django_static.slimfiles_batch(
+                  ['/a300.css', '/b300.css', '/foo300.js'])
+                self.assertTrue('img300.' in
+                                open(settings.MEDIA_ROOT + result[0]).read())
+        finally:
+            pool_module.ThreadPool = old_pool
+            settings.DJANGO_STATIC_BATCH_THREADS = 4
+        self.assertEqual(len(pools), 1)
+
+    def test_file_map_eviction_during_render(self):
+        """files that are evicted from a full file map while a template is
+        rendered (or a batch built in the pool) are just found again, with
+        the URLs cached for them only used while they're in the map"""
+        settings.DEBUG = False
+        settings.DJANGO_STATIC = True
+        settings.DJANGO_STATIC_FILE_MAP_SIZE = 4
+        _django_static._FILE_MAP = _django_static.BoundedFileMap(
+          settings.DJANGO_STATIC_FILE_MAP_SIZE)
+        names = ['/evicted%s.gif' % i for i in range(12)]
+        for name in names:
+            open(settings.MEDIA_ROOT + name, 'w').write(_GIF_CONTENT)
+        slimall = Template('{% load django_static %}{% slimall %}' +
+                           ''.join('<img src="%s">' % x for x in names) +
+                           '{% endslimall %}')
+        tags = Template('{% load django_static %}' +
+                        ''.join('{%% staticfile "%s" %%} ' % x for x in names))
+
+        rendered = slimall.render(Context())
+        self.assertEqual(len(re.findall(r'/evicted\d+\.\d+\.gif', rendered)),
+                         12)
+        file_map = _django_static._FILE_MAP
+        self.assertTrue(len(file_map) <= 4)
+        self.assertTrue(file_map.stats()['evictions'] > 0)
+        self.assertEqual(slimall.render(Context()), rendered)
+
+        rendered = tags.render(Context())
+        self.assertEqual(len(re.findall(r'/evicted\d+\.\d+\.gif', rendered)),
+                         12)
+        self.assertEqual(tags.render(Context()), rendered)
+        self.assertTrue(len(file_map) <= 4)
+
+        # the first ones are long gone so when their originals change (and
+        # without DEBUG nothing would notice otherwise) they're built again
+        self.assertFalse(names[0] in file_map)
+        m_time = os.stat(settings.MEDIA_ROOT + names[0])[stat.ST_MTIME] + 10
+        os.utime(settings.MEDIA_ROOT + names[0], (m_time, m_time))
+        self.assertTrue(('/evicted0.%s.gif' % m_time) in tags.render(Context()))
+        self.assertTrue(('/evicted0.%s.gif' % m_time) in
+                        slimall.render(Context()))
+
+    def test_file_map_snapshot(self):
+        """the _FILE_MAP can be saved to a snapshot and loaded back in but
+        only with the entries whose files still exist"""
+        settings.DEBUG = False
+        settings.DJANGO_STATIC = True
+
+        open(settings.MEDIA_ROOT + '/img400.gif', 'w').write(_GIF_CONTENT)
+        open(settings.MEDIA_ROOT + '/img401.gif', 'w').write(_GIF_CONTENT)
+        result_1 = _django_static.staticfile('/img400.gif')
+        result_2 = _django_static.staticfile('/img401.gif')
+
+        snapshot = os.path.join(self._mkdir(), 'snapshot.json')
+        _django_static._save_file_map_snapshot(snapshot, _django_static._FILE_MAP)
+        self.assertTrue(os.path.isfile(snapshot))
 
+        file_map = _django_static._load_file_map_snapshot(snapshot)
+        self.assertEqual(file_map['/img400.gif'][0], result_1)
+        self.assertEqual(file_map['/img401.gif'][0], result_2)
+
+        os.remove(settings.MEDIA_ROOT + result_2)
+        file_map = _django_static._load_file_map_snapshot(snapshot)
+        self.assertTrue('/img400.gif' in file_map)
+        self.assertTrue('/img401.gif' not in file_map)
+
+        # nor the ones whose original has changed since
+        m_time = os.stat(settings.MEDIA_ROOT + '/img400.gif')[stat.ST_MTIME]
+        os.utime(settings.MEDIA_ROOT + '/img400.gif', (m_time + 10, m_time + 10))
+        self.assertEqual(_django_static._load_file_map_snapshot(snapshot), {})
+
+        # a changed name prefix makes the snapshot useless
+        settings.DJANGO_STATIC_NAME_PREFIX = '/love-cache'
+        self.assertEqual(_django_static._load_file_map_snapshot(snapshot), {})
+
+        # and a missing one is just empty
+        self.assertEqual(_django_static._load_file_map_snapshot(snapshot + 'x'),
+                         {})
+        settings.DJANGO_STATIC_NAME_PREFIX = ''
+
+        # building a file has it saved, but not by the thread building it
+        import threading
+        settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT = snapshot
+        settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT_INTERVAL = 0.2
+        old_save = _django_static._save_file_map_snapshot
+        saved_by = []
+        def save(*args, **kwargs):
+            saved_by.append(threading.current_thread())
+            return old_save(*args, **kwargs)
+        _django_static._save_file_map_snapshot = save
+        try:
+            open(settings.MEDIA_ROOT + '/img402.gif', 'w').write(_GIF_CONTENT)
+            result_3 = _django_static.staticfile('/img402.gif')
+            scheduled = _django_static._scheduled_file_map_snapshot[0]
+            if scheduled is not None:
+                scheduled[1].join()
+        finally:
+            _django_static._save_file_map_snapshot = old_save
+            settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT = None
+            settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT_INTERVAL = 60
+        self.assertEqual(len(saved_by), 1)
+        self.assertNotEqual(saved_by[0], threading.current_thread())
+        file_map = _django_static._load_file_map_snapshot(snapshot)
+        self.assertEqual(file_map['/img402.gif'][0], result_3)
+
+    def test_bounded_file_map(self):
+        """BoundedFileMap never grows beyond its capacity and keeps the
+        recently used entries"""
+        file_map = _django_static.BoundedFileMap(10)
+        self.assertEqual(file_map.get('/foo.js', (None, None)), (None, None))
+        for i in range(10):
+            file_map['/foo%s.js' % i] = ('/foo%s.123.js' % i, 123)
+            # keep using the first one
+            self.assertEqual(file_map.get('/foo0.js'), ('/foo0.123.js', 123))
+        self.assertTrue(len(file_map) <= 10)
+
+        for i in range(10, 100):
+            file_map[u'/foo%s.js' % i] = (u'/foo%s.123.js' % i, 123)
+            file_map.get('/foo0.js')
+            self.assertTrue(len(file_map) <= 10)
+
+        self.assertTrue('/foo0.js' in file_map)
+        self.assertEqual(file_map['/foo0.js'], ('/foo0.123.js', 123))
+        self.assertTrue('/foo99.js' in file_map)
+        self.assertTrue('/foo1.js' not in file_map)
+        self.assertRaises(KeyError, lambda: file_map['/foo1.js'])
+
+        stats = file_map.stats()
+        self.assertEqual(stats['capacity'], 10)
+        self.assertEqual(stats['size'], len(file_map))
+        self.assertEqual(stats['evictions'], 100 - len(file_map))
+        self.assertEqual(stats['misses'], 2)
+        self.assertTrue(stats['hits'] > 100)
+
+        # non-ascii names work too
+        file_map[u'/f\xf6\xf6.js'] = (u'/f\xf6\xf6.123.js', 123)
+        self.assertEqual(file_map[u'/f\xf6\xf6.js'][0], u'/f\xf6\xf6.123.js')
+
+        # unbounded
+        file_map = _django_static.BoundedFileMap()
+        file_map.update(dict(('/foo%s.js' % i, ('/foo%s.123.js' % i, 123))
+                             for i in range(100)))
+        self.assertEqual(len(file_map), 100)
+        self.assertEqual(len(dict(file_map.items())), 100)
+
+    def test_bounded_file_map_snapshot(self):
+        """a snapshot of a real BoundedFileMap has everything in it and
+        doesn't change what's in it"""
+        file_map = _django_static.BoundedFileMap(10)
+        for i in range(9):
+            open(settings.MEDIA_ROOT + '/f%s.123.js' % i, 'w').write('')
+            file_map['/f%s.js' % i] = ('/f%s.123.js' % i, 123)
+        before = file_map.stats()
+
+        snapshot = os.path.join(self._mkdir(), 'snapshot.json')
+        _django_static._save_file_map_snapshot(snapshot, file_map)
+        self.assertEqual(file_map.stats(), before)
+        self.assertEqual(len(file_map), 9)
+        saved = json.loads(open(snapshot).read())['files']
+        self.assertEqual(sorted(saved), sorted('/f%s.js' % i for i in range(9)))
+
+        other = _django_static.BoundedFileMap(10)
+        other.update(file_map)
+        self.assertEqual(file_map.stats(), before)
+        self.assertEqual(sorted(other.items()), sorted(file_map.items()))
+
+    def test_atomic_publish(self):
+        """generated files replace what was there before via a temporary file
+        that is renamed into place"""
+        directory = self._mkdir()
+        source = os.path.join(directory, 'source.gif')
+        open(source, 'w').write(_GIF_CONTENT)
+        new_filepath = os.path.join(directory, 'source.123.gif')
+
+        _django_static._publish_content(new_filepath, 'first')
+        self.assertEqual(open(new_filepath).read(), 'first')
+        _django_static._publish_content(new_filepath, 'second')
+        self.assertEqual(open(new_filepath).read(), 'second')
+
+        if sys.platform != "win32":
+            # replacing a file with a symlink and then the symlink with another
+            _django_static._publish_file(source, new_filepath, 'symlink')
+            self.assertTrue(os.path.islink(new_filepath))
+            _django_static._publish_file(source, new_filepath, 'symlink')
+            self.assertEqual(os.readlink(new_filepath), source)
+
+        _django_static._publish_copy(source, new_filepath)
+        self.assertFalse(os.path.islink(new_filepath))
+        self.assertEqual(open(new_filepath).read(), _GIF_CONTENT)
+
+        # a failed write doesn't leave anything behind
+        def failing_write(tmp_filepath):
+            open(tmp_filepath, 'w').write('half')
+            raise IOError("disk full")
+        self.assertRaises(IOError, _django_static._publish,
+                          new_filepath, failing_write)
+        self.assertEqual(open(new_filepath).read(), _GIF_CONTENT)
+
+        self.assertEqual(sorted(os.listdir(directory)),
+                         ['source.123.gif', 'source.gif'])
+
+    def test_link_modes(self):
+        """DJANGO_STATIC_LINK_MODE decides how unoptimized files are put in
+        place and falls back to copying if that's not possible"""
+        settings.DEBUG = False
+        settings.DJANGO_STATIC = True
+        settings.DJANGO_STATIC_LINK_MODE = 'hardlink'
+
+        open(settings.MEDIA_ROOT + '/img500.gif', 'w').write(_GIF_CONTENT)
+        result = _django_static.staticfile('/img500.gif')
+        new_filepath = settings.MEDIA_ROOT + result
+        self.assertFalse(os.path.islink(new_filepath))
+        self.assertTrue(os.path.samefile(new_filepath,
+                                         settings.MEDIA_ROOT + '/img500.gif'))
+
+        # publishing the same hardlink again leaves nothing behind
+        _django_static._publish_file(settings.MEDIA_ROOT + '/img500.gif',
+                                     new_filepath, 'hardlink')
+        self.assertEqual(len(os.listdir(settings.MEDIA_ROOT)), 2)
+
+        for mode in ('reflink', 'copy_file_range', 'sendfile', 'copy'):
+            target = os.path.join(settings.MEDIA_ROOT, '%s.gif' % mode)
+            used = _django_static._publish_file(
+              settings.MEDIA_ROOT + '/img500.gif', target, mode)
+            self.assertTrue(used in ('reflink', 'copy_file_range',
+                                     'sendfile', 'copy'))
+            self.assertFalse(os.path.samefile(target,
+                                              settings.MEDIA_ROOT + '/img500.gif'))
+            self.assertEqual(open(target).read(), _GIF_CONTENT)
+        if sys.platform.startswith('linux'):
+            # done by the kernel rather than quietly copied
+            target = os.path.join(settings.MEDIA_ROOT, 'sendfile2.gif')
+            self.assertEqual(_django_static._publish_file(
+              settings.MEDIA_ROOT + '/img500.gif', target, 'sendfile'),
+              'sendfile')
+
+        # a directory that has gone is made again
+        target = os.path.join(settings.MEDIA_ROOT, 'gone', 'img500.gif')
+        _django_static._ensure_dir(os.path.dirname(target))
+        os.rmdir(os.path.dirname(target))
+        self.assertEqual(_django_static._publish_file(
+          settings.MEDIA_ROOT + '/img500.gif', target, 'hardlink'), 'hardlink')
+
+        # real errors aren't taken for a mode not being supported
+        old_link = os.link
+        def forbidden_link(*args):
+            raise OSError(errno.EPERM, "Operation not permitted")
+        os.link = forbidden_link
+        try:
+            self.assertRaises(OSError, _django_static._publish_file,
+                              settings.MEDIA_ROOT + '/img500.gif',
+                              os.path.join(settings.MEDIA_ROOT, 'eperm.gif'),
+                              'hardlink')
+            self.assertFalse([x for x in _django_static._unsupported_link_modes
+                              if x[0] == 'hardlink'])
+        finally:
+            os.link = old_link
+
+        # a mode that isn't supported falls back on copying
+        old_link = os.link
+        def unsupported_link(*args):
+            raise OSError(18, "Invalid cross-device link")
+        os.link = unsupported_link
+        try:
+            target = os.path.join(settings.MEDIA_ROOT, 'fallback.gif')
+            used = _django_static._publish_file(
+              settings.MEDIA_ROOT + '/img500.gif', target, 'hardlink')
+            self.assertEqual(used, 'copy')
+            self.assertEqual(open(target).read(), _GIF_CONTENT)
+        finally:
+            os.link = old_link
+            _django_static._unsupported_link_modes.clear()
+
+        settings.DJANGO_STATIC_LINK_MODE = 'nonsense'
+        self.assertRaises(ValueError, _django_static._link_mode, True)
+
+    def test_garbage_collection(self):
+        """the django_static_gc command deletes old generations of generated
+        files"""
+        from django.core.management import call_command
+        from django_static.management.commands.django_static_gc import \
+          collect_garbage
+
+        directory = self._mkdir()
+        settings.DJANGO_STATIC_SAVE_PREFIX = directory
+        os.mkdir(os.path.join(directory, 'css'))
+        def create(filename):
+            filepath = os.path.join(directory, filename)
+            open(filepath, 'w').write('body{}')
+            return filepath
+        create('css/foo.css')
+        foo1 = create('css/foo.1300000001.css')
+        foo2 = create('css/foo.1300000002.css')
+        foo3 = create('css/foo.1300000003.css')
+        bar1 = create('css/bar.1300000001.css')
+
+        deleted = collect_garbage([directory], keep=1, grace=0, dry_run=True)
+        self.assertEqual(sorted(deleted), [foo1, foo2])
+        self.assertTrue(os.path.isfile(foo1))
+
+        # nothing is old enough
+        deleted = collect_garbage([directory], keep=1, grace=3600)
+        self.assertEqual(deleted, [])
+
+        deleted = collect_garbage([directory], keep=2, grace=0)
+        self.assertEqual(deleted, [foo1])
+        self.assertFalse(os.path.isfile(foo1))
+        self.assertTrue(os.path.isfile(foo2))
+        self.assertTrue(os.path.isfile(bar1))
+        self.assertTrue(os.path.isfile(os.path.join(directory, 'css/foo.css')))
+        self.assertTrue(os.path.isfile(os.path.join(directory,
+                                                    '.django_static_gc.json')))
+
+        # files created since the last run are picked up
+        foo4 = create('css/foo.1300000004.css')
+        # but not the ones still in the file map snapshot
+        snapshot = os.path.join(self._mkdir(), 'snapshot.json')
+        settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT = snapshot
+        _django_static._save_file_map_snapshot(snapshot,
+          {'/css/foo.css': ('/css/foo.1300000002.css', 1300000002)})
+        try:
+            call_command('django_static_gc', directory, keep=1, grace=0,
+                         verbosity=0)
+        finally:
+            settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT = None
+        self.assertTrue(os.path.isfile(foo2))
+        self.assertFalse(os.path.isfile(foo3))
+        self.assertTrue(os.path.isfile(foo4))
+
+    def test_garbage_collection_hardlinks(self):
+        """a hardlinked file is as old as the link, not the original, when
+        it comes to --grace"""
+        from django_static.management.commands.django_static_gc import \
+          collect_garbage
+
+        settings.DEBUG = False
+        settings.DJANGO_STATIC = True
+        settings.DJANGO_STATIC_LINK_MODE = 'hardlink'
+        settings.DJANGO_STATIC_SAVE_PREFIX = self._mkdir()
+        filepath = settings.MEDIA_ROOT + '/hardlinked.gif'
+        open(filepath, 'w').write(_GIF_CONTENT)
+        results = []
+        for m_time in (1300000001, 1300000002):
+            # (built again after a deploy, by a new process)
+            _django_static._FILE_MAP.clear()
+            os.utime(filepath, (m_time, m_time))
+            results.append(_django_static.staticfile('/hardlinked.gif'))
+        self.assertEqual(results, ['/hardlinked.1300000001.gif',
+                                   '/hardlinked.1300000002.gif'])
+        old_filepath = settings.DJANGO_STATIC_SAVE_PREFIX + results[0]
+        self.assertEqual(os.stat(old_filepath).st_ino, os.stat(filepath).st_ino)
+
+        self.assertEqual(collect_garbage([settings.DJANGO_STATIC_SAVE_PREFIX],
+                                         keep=1, grace=3600), [])
+        self.assertTrue(os.path.isfile(old_filepath))
+        self.assertEqual(collect_garbage([settings.DJANGO_STATIC_SAVE_PREFIX],
+                                         keep=1, grace=0), [old_filepath])
+
+    def test_saved_file_map_union(self):
+        """with both the manifest and the file map snapshot configured what
+        either refers to counts as saved (and so isn't collected)"""
+        open(settings.MEDIA_ROOT + '/m.1300000001.css', 'w').write('')
+        open(settings.MEDIA_ROOT + '/s.1300000001.css', 'w').write('')
+        manifest = os.path.join(settings.MEDIA_ROOT, 'manifest.json')
+        _django_static._set(manifest, '/m.css',
+                            ('/m.1300000001.css', 1300000001))
+        snapshot = os.path.join(self._mkdir(), 'snapshot.json')
+        _django_static._save_file_map_snapshot(snapshot,
+          {'/s.css': ('/s.1300000001.css', 1300000001)})
+        settings.DJANGO_STATIC_USE_MANIFEST_FILE = True
+        settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT = snapshot
+        try:
+            self.assertEqual(sorted(_django_static._saved_file_map()),
+                             ['/m.css', '/s.css'])
+        finally:
+            settings.DJANGO_STATIC_USE_MANIFEST_FILE = False
+            settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT = None
+
+    def test_garbage_collection_outside_save_prefix(self):
+        """outside DJANGO_STATIC_SAVE_PREFIX django_static_gc only deletes
+        old generations of files the file map snapshot knows about"""
+        from django.core.management.base import CommandError
+        from django_static.management.commands.django_static_gc import \
+          collect_garbage
+
+        directory = settings.MEDIA_ROOT
+        def create(filename):
+            filepath = os.path.join(directory, filename)
+            open(filepath, 'w').write('x')
+            return filepath
+        create('foo.css')
+        foo1 = create('foo.1300000001.css')
+        foo2 = create('foo.1300000002.css')
+        foo3 = create('foo.1300000003.css')
+        # uploads that happen to look like generated files
+        photo1 = create('photo.1300000001.jpg')
+        photo2 = create('photo.1300000002.jpg')
+        # and two combinations whose names were cut short to the same name
+        ab1 = create('a_b.1300000001.js')
+        ab2 = create('a_b.1300000002.js')
+        ab3 = create('a_b.1300000003.js')
+
+        # without a snapshot there's no telling what's generated
+        self.assertRaises(CommandError, collect_garbage, [directory],
+                          keep=1, grace=0)
+
+        snapshot = os.path.join(self._mkdir(), 'snapshot.json')
+        settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT = snapshot
+        _django_static._save_file_map_snapshot(snapshot, {
+          '/foo.css': ('/foo.1300000003.css', 1300000003),
+          '/a/b.js;/b.js': ('/a_b.1300000003.js', 1300000003),
+          '/a/b.js;/b/b.js': ('/a_b.1300000001.js', 1300000001),
+        })
+        try:
+            deleted = collect_garbage([directory], keep=1, grace=0)
+            self.assertEqual(sorted(deleted), [foo1, foo2])
+            self.assertTrue(os.path.isfile(photo1))
+            self.assertTrue(os.path.isfile(ab1))
+
+            settings.DJANGO_STATIC_FILENAME_GENERATOR = 'x.y'
+            self.assertRaises(CommandError, collect_garbage, [directory],
+                              keep=1, grace=0)
+        finally:
+            settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT = None
+            if hasattr(settings, 'DJANGO_STATIC_FILENAME_GENERATOR'):
+                del settings.DJANGO_STATIC_FILENAME_GENERATOR
+
+    def test_known_dirs(self):
+        """output directories are only checked and created once"""
+        directory = os.path.join(self._mkdir(), 'deep', 'down')
+        _django_static._ensure_dir(directory)
+        self.assertTrue(os.path.isdir(directory))
+        self.assertTrue(directory in _django_static._known_dirs)
+
+        # it doesn't matter if it already exists
+        _django_static._mkdir(directory)
+        # but it does if a file is in the way
+        open(os.path.join(directory, 'file'), 'w').write('')
+        self.assertRaises(OSError, _django_static._mkdir,
+                          os.path.join(directory, 'file'))
+
+        # once known it's not checked again
+        rmtree(directory)
+        _django_static._ensure_dir(directory)
+        self.assertFalse(os.path.isdir(directory))
+
+        # but publishing into it still works
+        new_filepath = os.path.join(directory, 'foo.123.css')
+        _django_static._publish_content(new_filepath, 'body{}')
+        self.assertEqual(open(new_filepath).read(), 'body{}')
+
+        _django_static._forget_known_dirs()
+        self.assertFalse(directory in _django_static._known_dirs)
+
+    def test_hashed_subdirs(self):
+        """with DJANGO_STATIC_HASHED_SUBDIRS generated files are spread out
+        in subdirectories named after the hash of the original"""
+        settings.DEBUG = True
+        settings.DJANGO_STATIC = True
+        settings.DJANGO_STATIC_HASHED_SUBDIRS = True
+        settings.DJANGO_STATIC_SAVE_PREFIX = self._mkdir()
+
+        os.mkdir(settings.MEDIA_ROOT + '/js')
+        open(settings.MEDIA_ROOT + '/js/foo600.js', 'w').write('var a = 1;\n')
+        open(settings.MEDIA_ROOT + '/js/bar600.js', 'w').write('var b = 1;\n')
+        open(settings.MEDIA_ROOT + '/foo600.css', 'w').write('a{}\n')
+
+        result = _django_static.staticfile('/js/foo600.js')
+        self.assertTrue(re.findall('^/js/[0-9a-f]{2}/[0-9a-f]{2}/foo600\.\d+\.js$',
+                                   result))
+        self.assertTrue(os.path.lexists(settings.DJANGO_STATIC_SAVE_PREFIX + result))
+        other = _django_static.staticfile('/js/bar600.js')
+        self.assertNotEqual(os.path.dirname(result), os.path.dirname(other))
+
+        # the same file always goes into the same directory
+        _django_static._FILE_MAP.clear()
+        self.assertEqual(_django_static.staticfile('/js/foo600.js'), result)
+
+        # combos too
+        result = _django_static.staticfile(['/js/foo600.js', '/js/bar600.js'])
+        self.assertTrue(re.findall('^/js/[0-9a-f]{2}/[0-9a-f]{2}/foo600_bar600\.\d+\.js$',
+                                   result))
+
+        # but not CSS files that aren't slimmed
+        result = _django_static.staticfile('/foo600.css')
+        self.assertTrue(re.findall('^/foo600\.\d+\.css$', result))
+
+    def test_export_and_import(self):
+        """the generated files and the file map can be exported from one
+        server and imported on another"""
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+
+        settings.DEBUG = False
+        settings.DJANGO_STATIC = True
+        settings.DJANGO_STATIC_SAVE_PREFIX = self._mkdir()
+        settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT = \
+          os.path.join(self._mkdir(), 'snapshot.json')
+        try:
+            open(settings.MEDIA_ROOT + '/img700.gif', 'w').write(_GIF_CONTENT)
+            open(settings.MEDIA_ROOT + '/foo700.js', 'w').write('var a = 1;\n')
+            open(settings.MEDIA_ROOT + '/bar700.js', 'w').write('var b = 1;\n')
+            results = [_django_static.staticfile('/img700.gif'),
+                       _django_static.slimfile(['/foo700.js', '/bar700.js'])]
+            _django_static._save_file_map_snapshot(
+              settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT, _django_static._FILE_MAP)
+
+            exported_to = self._mkdir()
+            for archive_name in ('export.tar.gz', 'export.zip'):
+                archive_path = os.path.join(exported_to, archive_name)
+                call_command('django_static_export', archive_path, verbosity=0)
+                self.assertTrue(os.path.isfile(archive_path))
+
+                # on another server...
+                settings.DJANGO_STATIC_SAVE_PREFIX = self._mkdir()
+                settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT = \
+                  os.path.join(self._mkdir(), 'snapshot.json')
+                call_command('django_static_import', archive_path, verbosity=0)
+
+                file_map = _django_static._load_file_map_snapshot(
+                  settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT)
+                self.assertEqual(file_map['/img700.gif'][0], results[0])
+                self.assertEqual(file_map['/foo700.js;/bar700.js'][0], results[1])
+                # symlinks become real files
+                new_filepath = settings.DJANGO_STATIC_SAVE_PREFIX + results[0]
+                self.assertFalse(os.path.islink(new_filepath))
+                self.assertEqual(open(new_filepath).read(), _GIF_CONTENT)
+                new_filepath = settings.DJANGO_STATIC_SAVE_PREFIX + results[1]
+                self.assertTrue(open(new_filepath).read().startswith('var a'))
+
+            # where the originals were checked out (or copied) at another
+            # time than where the files were built
+            for filename in ('/img700.gif', '/foo700.js', '/bar700.js'):
+                filepath = settings.MEDIA_ROOT + filename
+                m_time = os.stat(filepath)[stat.ST_MTIME] + 1000
+                os.utime(filepath, (m_time, m_time))
+            file_map = _django_static._load_file_map_snapshot(
+              settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT)
+            self.assertEqual(file_map['/img700.gif'][0], results[0])
+            self.assertEqual(file_map['/foo700.js;/bar700.js'][0], results[1])
+            # and a process that only has some of the files in its file map
+            # doesn't replace the rest when it saves it
+            open(settings.DJANGO_STATIC_SAVE_PREFIX + '/x.123.gif', 'w')
+            _django_static._save_file_map_snapshot(
+              settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT,
+              {'/img700.gif': ('/img700.1.gif', 1),
+               '/x.gif': ('/x.123.gif', 123)})
+            file_map = _django_static._load_file_map_snapshot(
+              settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT)
+            self.assertEqual(sorted(file_map),
+                             ['/foo700.js;/bar700.js', '/img700.gif', '/x.gif'])
+            self.assertEqual(file_map['/img700.gif'][0], results[0])
+
+            # nothing is imported if there's nowhere to put the manifest
+            settings.DJANGO_STATIC_SAVE_PREFIX = self._mkdir()
+            settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT = None
+            self.assertRaises(CommandError, call_command,
+                              'django_static_import', archive_path, verbosity=0)
+            self.assertEqual(os.listdir(settings.DJANGO_STATIC_SAVE_PREFIX), [])
+            settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT = \
+              os.path.join(self._mkdir(), 'snapshot.json')
+
+            # a broken archive is refused
+            archive_path = os.path.join(exported_to, 'broken.zip')
+            import zipfile
+            archive = zipfile.ZipFile(archive_path, 'w')
+            archive.writestr('manifest.json', '{}')
+            archive.writestr('checksums.json', '{"files/0/foo.js": "nope"}')
+            archive.writestr('files/0/foo.js', 'var a;')
+            archive.close()
+            self.assertRaises(CommandError, call_command,
+                              'django_static_import', archive_path, verbosity=0)
+            self.assertFalse(os.path.exists(
+              os.path.join(settings.DJANGO_STATIC_SAVE_PREFIX, 'foo.js')))
+        finally:
+            settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT = None
+
+    def test_build_daemon(self):
+        """with DJANGO_STATIC_BUILD_SOCKET set the building is left to the
+        django_static_daemon process"""
+        import json
+        import threading
+        import SocketServer
+        from django_static.management.commands import django_static_daemon
+
+        settings.DEBUG = False
+        settings.DJANGO_STATIC = True
+        open(settings.MEDIA_ROOT + '/img800.gif', 'w').write(_GIF_CONTENT)
+        open(settings.MEDIA_ROOT + '/foo800.js', 'w').write('var a = 1;\n')
+        open(settings.MEDIA_ROOT + '/bar800.js', 'w').write('var b = 1;\n')
+
+        # what the daemon does
+        results = django_static_daemon.build(['/img800.gif', '/nothere.gif'],
+                                             symlink_if_possible=True)
+        new_filename, m_time, new_filepath = results[0]
+        self.assertTrue(re.findall('/img800\.\d+\.gif', new_filename))
+        self.assertTrue(os.path.lexists(new_filepath))
+        self.assertEqual(results[1], None)
+
+        # if the daemon isn't running the original is used...
+        _django_static._FILE_MAP.clear()
+        _django_static._reset_config()
+        settings.DJANGO_STATIC_BUILD_SOCKET = os.path.join(self._mkdir(), 'sock')
+        try:
+            self.assertEqual(_django_static.staticfile('/img800.gif'),
+                             '/img800.gif')
+            self.assertFalse('/img800.gif' in _django_static._FILE_MAP)
+            # ...except for combos which are built here
+            result = _django_static.staticfile(['/foo800.js', '/bar800.js'])
+            self.assertTrue(re.findall('/foo800_bar800\.\d+\.js', result))
+
+            # a pretend daemon that has built the file
+            requests = []
+            class Handler(SocketServer.StreamRequestHandler):
+                def handle(self):
+                    requests.append(json.loads(self.rfile.readline()))
+                    self.wfile.write(json.dumps({'results': results[:1]}) + '\n')
+            server = django_static_daemon.BuildServer(
+              settings.DJANGO_STATIC_BUILD_SOCKET, Handler)
+            thread = threading.Thread(target=server.handle_request)
+            thread.start()
+            try:
+                result = _django_static.staticfile('/img800.gif')
+            finally:
+                thread.join()
+                server.server_close()
+            self.assertEqual(result, new_filename)
+            self.assertEqual(requests, [{'files': ['/img800.gif'],
+                                         'optimize': False,
+                                         'symlink': True}])
+            # and now it's known
+            self.assertEqual(_django_static._FILE_MAP['/img800.gif'][0],
+                             new_filename)
+            self.assertEqual(_django_static.staticfile('/img800.gif'),
+                             new_filename)
+        finally:
+            settings.DJANGO_STATIC_BUILD_SOCKET = None
+
+    def test_shared_file_map(self):
+        """SharedFileMap keeps the file map in a memory mapped file that all
+        processes opening the same file share"""
+        from django_static import sharedmap
+        from django_static.sharedmap import SharedFileMap
+
+        path = os.path.join(self._mkdir(), 'django_static.map')
+        one = SharedFileMap(path, slots=8, slot_size=128)
+        # e.g. another process
+        two = SharedFileMap(path, slots=1000)
+        # which uses the size the first one chose
+        self.assertEqual(two.slots, 8)
+        try:
+            self.assertEqual(one.get('/foo.js', (None, None)), (None, None))
+            one['/foo.js'] = ('/foo.123.js', 123)
+            one[u'/f\xf6\xf6.js'] = (u'/f\xf6\xf6.123.js', 123)
+            self.assertEqual(two.get('/foo.js'), ('/foo.123.js', 123))
+            self.assertEqual(two[u'/f\xf6\xf6.js'], (u'/f\xf6\xf6.123.js', 123))
+            self.assertTrue('/foo.js' in two)
+            self.assertRaises(KeyError, lambda: two['/bar.js'])
+
+            # changing an entry
+            two['/foo.js'] = ('/foo.456.js', 456)
+            self.assertEqual(one['/foo.js'], ('/foo.456.js', 456))
+            self.assertEqual(len(one), 2)
+
+            # too big for a slot or for the table is kept in the process
+            one['/%s.js' % ('x' * 200)] = ('/%s.123.js' % ('x' * 200), 123)
+            self.assertTrue('/%s.js' % ('x' * 200) in one)
+            self.assertFalse('/%s.js' % ('x' * 200) in two)
+            for i in range(20):
+                one['/foo%s.js' % i] = ('/foo%s.123.js' % i, 123)
+            for i in range(20):
+                self.assertEqual(one['/foo%s.js' % i], ('/foo%s.123.js' % i, 123))
+            self.assertEqual(len([x for x in range(20)
+                                  if '/foo%s.js' % x in two]), 6)
+            self.assertEqual(len(dict(two.items())), 8)
+            self.assertEqual(one.stats()['overflow'], 15)
+            # which can be bounded too
+            three = SharedFileMap(
+              path, overflow=_django_static.BoundedFileMap(10))
+            try:
+                for i in range(100):
+                    three['/bar%s.js' % i] = ('/bar%s.123.js' % i, 123)
+                self.assertTrue(three.stats()['overflow'] <= 10)
+                self.assertEqual(three['/bar99.js'], ('/bar99.123.js', 123))
+            finally:
+                three.close()
+
+            # a writer that died half way leaves a slot that is eventually
+            # emptied
+            offset = two._find('/foo.js', sharedmap._hash('/foo.js'))[0]
+            sequence = sharedmap.SEQUENCE.unpack_from(two._map, offset)[0]
+            sharedmap.SEQUENCE.pack_into(two._map, offset, sequence + 1)
+            self.assertEqual(one.get('/foo.js'), None)
+
+            # ...even while another thread of the same process is writing
+            offset = two._find('/foo0.js', sharedmap._hash('/foo0.js'))[0]
+            sequence = sharedmap.SEQUENCE.unpack_from(two._map, offset)[0]
+            sharedmap.SEQUENCE.pack_into(two._map, offset, sequence + 1)
+            one['/bar.js'] = ('/bar.123.js', 123)
+            self.assertEqual(two.get('/foo0.js'), None)
+            self.assertEqual(two.get('/bar.js'), ('/bar.123.js', 123))
+        finally:
+            one.close()
+            two.close()
+
+        # entries put there by another process (or before a deploy) are
+        # checked once before they're used
+        checked = []
+        def validate(key, m_time):
+            checked.append(key)
+            return m_time == 456
+        path = os.path.join(self._mkdir(), 'django_static.map')
+        one = SharedFileMap(path, slots=8, slot_size=128)
+        two = SharedFileMap(path, validate=validate)
+        try:
+            one['/foo.js'] = ('/foo.123.js', 123)
+            self.assertEqual(two.get('/foo.js'), None)
+            self.assertEqual(two.get('/foo.js'), None)
+            two['/foo.js'] = ('/foo.456.js', 456)
+            self.assertEqual(two.get('/foo.js'), ('/foo.456.js', 456))
+            one['/bar.js'] = ('/bar.456.js', 456)
+            self.assertEqual(two.get('/bar.js'), ('/bar.456.js', 456))
+            self.assertEqual(two.get('/bar.js'), ('/bar.456.js', 456))
+            self.assertEqual(checked, ['/foo.js', '/foo.js', '/bar.js'])
+        finally:
+            one.close()
+            two.close()
+
+
+    def test_stats(self):
+        """what _static_file() does is counted and timed"""
+        from django_static import stats
+        from django_static.signals import asset_event
+        stats.reset()
+
+        media_root = settings.MEDIA_ROOT
+        open(os.path.join(media_root, 'stats.css'), 'w').write('body { }\n')
+        settings.DEBUG = False
+
+        events = []
+        def receiver(sender, event, key, phase, duration, **kwargs):
+            events.append((event, key, phase))
+        asset_event.connect(receiver)
+        try:
+            _static_file('/stats.css', symlink_if_possible=True)
+            _static_file('/stats.css', symlink_if_possible=True)
+            _slim_file('/stats2.css')
+            _django_static.staticfiles_batch(['/stats.css'])
+        finally:
+            asset_event.disconnect(receiver)
+
+        result = _django_static.get_stats()
+        counters = result['counters']
+        self.assertEqual(counters['miss'], 2)
+        self.assertEqual(counters['hit'], 2)
+        self.assertEqual(counters['build_symlink'], 1)
+        self.assertEqual(counters['notfound'], 1)
+        self.assertEqual(result['timings']['find']['count'], 2)
+        self.assertEqual(result['timings']['write']['count'], 1)
+        self.assertEqual(sum(result['timings']['find']['buckets'].values()), 2)
+        self.assertEqual(result['file_map']['size'], 1)
+        self.assertEqual(result['file_map']['capacity'], 10000)
+
+        self.assertTrue(('hit', '/stats.css', None) in events)
+        self.assertTrue(('timing', '/stats.css', 'write') in events)
+        self.assertTrue(('notfound', '/stats2.css', None) in events)
+
+        # in DEBUG mode the file is checked again every time
+        settings.DEBUG = True
+        _static_file('/stats.css', symlink_if_possible=True)
+        self.assertEqual(_django_static.get_stats()['counters']['revalidation'], 1)
+
+        # the callback setting
+        settings.DJANGO_STATIC_STATS_CALLBACK = 'django_static.tests.stats_callback'
+        stats.callback = stats._load_callback()
+        try:
+            _static_file('/stats.css', symlink_if_possible=True)
+        finally:
+            del settings.DJANGO_STATIC_STATS_CALLBACK
+            stats.callback = stats._load_callback()
+        self.assertTrue(('revalidation', '/stats.css') in _stats_callback_events)
+
+        stats.reset()
+        self.assertEqual(_django_static.get_stats()['counters'], {})
+
+    def test_profiling_middleware(self):
+        """the time spent in each tag of a request is reported"""
+        from django.http import HttpResponse
+        from django.test.client import RequestFactory
+        from django_static import stats
+        from django_static.middleware import ProfilingMiddleware, logger
+
+        media_root = settings.MEDIA_ROOT
+        open(os.path.join(media_root, 'profiled.css'), 'w').write('body { }\n')
+        open(os.path.join(media_root, 'profiled.gif'), 'wb').write(_GIF_CONTENT)
+        settings.DEBUG = False
+        template_as_string = """{% load django_static %}
+        {% slimfile "/profiled.css" %}
+        {% slimfile "/profiled.css" %}
+        {% staticall %}<img src="/profiled.gif">{% endstaticall %}
+        """
+        template = Template(template_as_string)
+        profile_dir = os.path.join(self._mkdir(), 'profiles')
+        settings.DJANGO_STATIC_PROFILE_DIR = profile_dir
+        settings.DJANGO_STATIC_PROFILE_THRESHOLD = 0
+
+        logged = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                logged.append(record.getMessage())
+        handler = Handler()
+        logger.addHandler(handler)
+        try:
+            middleware = ProfilingMiddleware()
+            request = RequestFactory().get('/page')
+            middleware.process_request(request)
+            template.render(Context())
+            response = middleware.process_response(request, HttpResponse())
+        finally:
+            logger.removeHandler(handler)
+            settings.DJANGO_STATIC_PROFILE_DIR = None
+            settings.DJANGO_STATIC_PROFILE_THRESHOLD = 100
+        self.assertEqual(stats.get_collector(), None)
+
+        self.assertTrue(response['Server-Timing'].startswith(
+          'django_static;dur='))
+        self.assertTrue('desc="3 tags, 2 not hits"' in response['Server-Timing'])
+
+        self.assertEqual(len(logged), 1)
+        report = json.loads(logged[0])
+        self.assertEqual(report['path'], '/page')
+        tags = report['tags']
+        self.assertEqual([x['node'] for x in tags],
+                         ['StaticFileNode', 'StaticFileNode', 'StaticFilesNode'])
+        self.assertEqual(tags[0]['keys'], ['/profiled.css'])
+        self.assertEqual(tags[0]['status'], 'miss')
+        self.assertEqual(len(tags[0]['optimizers']), 1)
+        self.assertTrue(tags[0]['build'] > 0)
+        self.assertEqual(tags[1]['status'], 'hit')
+        self.assertEqual(tags[2]['keys'], ['/profiled.gif'])
+        self.assertEqual(tags[2]['status'], 'miss')
+
+        # only the builds were profiled
+        self.assertEqual(len(tags[0]['profiles']), 1)
+        self.assertEqual(len(tags[2]['profiles']), 1)
+        self.assertEqual(len(os.listdir(profile_dir)), 2)
+        import pstats
+        pstats.Stats(tags[0]['profiles'][0])
+
+        # nothing is reported for quick requests
+        middleware.process_request(request)
+        template.render(Context())
+        response = middleware.process_response(request, HttpResponse())
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    def test_failed_builds_are_not_recorded(self):
+        """the file map and the manifest only ever refer to complete files"""
+        import errno
+        media_root = settings.MEDIA_ROOT
+        open(os.path.join(media_root, 'full.js'), 'w').write('var a = 1;\n')
+
+        original_publish = _django_static._publish
+        def full_disk_publish(new_filepath, write):
+            def failing_write(tmp_filepath):
+                open(tmp_filepath, 'w').write('var')
+                raise IOError(errno.ENOSPC, "No space left on device")
+            return original_publish(new_filepath, failing_write)
+        _django_static._publish = full_disk_publish
+        try:
+            self.assertRaises(IOError, _slim_file, '/full.js')
+        finally:
+            _django_static._publish = original_publish
+        self.assertEqual(len(_django_static._FILE_MAP), 0)
+        self.assertEqual([x for x in os.listdir(media_root) if x != 'full.js'],
+                         [])
+
+        # the manifest is replaced, not rewritten, and writers lock another file
+        manifest_path = os.path.join(self._mkdir(), 'manifest.json')
+        _django_static._set(manifest_path, '/a.js', ['/a.123.js', 123])
+        _django_static._set(manifest_path, '/b.js', ['/b.123.js', 123])
+        self.assertEqual(json.load(open(manifest_path)),
+                         {'/a.js': ['/a.123.js', 123],
+                          '/b.js': ['/b.123.js', 123]})
+        self.assertTrue(os.path.isfile(manifest_path + '.lock'))
+
+        _django_static._publish = full_disk_publish
+        try:
+            self.assertRaises(IOError, _django_static._set, manifest_path,
+                              '/c.js', ['/c.123.js', 123])
+        finally:
+            _django_static._publish = original_publish
+        self.assertEqual(len(json.load(open(manifest_path))), 2)
+
+    def test_cached_config(self):
+        """the optimizer settings are only read once, until they change"""
+        from django.test.utils import override_settings
+        self.assertEqual(_django_static._optimizer('css'),
+                         cssmin and 'cssmin' or slimmer and 'slimmer' or None)
+        self.assertTrue(_django_static._optional_module('nonexistant') is None)
+
+        # changing settings directly isn't noticed...
+        settings.DJANGO_STATIC_CLOSURE_COMPILER = 'compiler.jar'
+        self.assertNotEqual(_django_static._optimizer('js'), 'closure_compiler')
+        # ...until the config is reset
+        _django_static._reset_config()
+        self.assertEqual(_django_static._optimizer('js'), 'closure_compiler')
+        settings.DJANGO_STATIC_CLOSURE_COMPILER = None
+        _django_static._reset_config()
+
+        # but override_settings() resets it
+        with override_settings(DJANGO_STATIC_YUI_COMPRESSOR='yui.jar'):
+            self.assertEqual(_django_static._optimizer('js'), 'yui_compressor')
+        self.assertNotEqual(_django_static._optimizer('js'), 'yui_compressor')
+
+        # and the hooks are reloaded
+        with override_settings(DJANGO_STATIC_FILE_PROXY='django_static.tests.fake_file_proxy'):
+            self.assertEqual(_django_static.file_proxy, fake_file_proxy)
+        self.assertNotEqual(_django_static.file_proxy, fake_file_proxy)
+
+    def test_url_cache(self):
+        """once built the final URL of a file is returned straight away"""
+        settings.DEBUG = False
+        settings.DJANGO_STATIC_MEDIA_URL = '//cdn'
+        filepath = settings.MEDIA_ROOT + '/cached.js'
+        open(filepath, 'w').write('var a = 1;\n')
+
+        url = _django_static.staticfile('/cached.js')
+        self.assertTrue(re.findall('^//cdn/cached\.\d+\.js$', url))
+        self.assertEqual(_django_static._url_cache['/cached.js'][1], url)
+
+        # it doesn't go through the settings...
+        settings.DJANGO_STATIC_MEDIA_URL = '//nope'
+        self.assertEqual(_django_static.staticfile('/cached.js'), url)
+        template = Template('{% load django_static %}{% staticfile "/cached.js" %}')
+        self.assertEqual(template.render(Context()), url)
+        settings.DJANGO_STATIC_MEDIA_URL = '//cdn'
+
+        # ...but the file proxy is still called if there is one
+        old_file_proxy = _django_static.file_proxy
+        _django_static.file_proxy = fake_file_proxy
+        try:
+            self.assertEqual(_django_static.staticfile('/cached.js'), url)
+            self.assertEqual(_last_fake_file_uri, url)
+            self.assertEqual(_last_fake_file_keyword_arguments,
+                             _django_static.fp_default_kwargs)
+        finally:
+            _django_static.file_proxy = old_file_proxy
+
+        # in DEBUG mode the file is checked every time
+        settings.DEBUG = True
+        os.utime(filepath, (time.time() + 10, time.time() + 10))
+        new_url = _django_static.staticfile('/cached.js')
+        self.assertNotEqual(new_url, url)
+        self.assertEqual(_django_static._url_cache['/cached.js'][1], new_url)
+
+        # whatever changes the file map changes the URL
+        settings.DEBUG = False
+        _django_static._FILE_MAP.clear()
+        os.utime(filepath, (time.time() + 20, time.time() + 20))
+        url = _django_static.staticfile('/cached.js')
+        self.assertNotEqual(new_url, url)
+        _django_static._FILE_MAP['/cached.js'] = ('/cached.123.js', 123)
+        self.assertEqual(_django_static.staticfile('/cached.js'),
+                         '//cdn/cached.123.js')
+        _django_static._FILE_MAP = _django_static.BoundedFileMap(
+          settings.DJANGO_STATIC_FILE_MAP_SIZE)
+        os.utime(filepath, (time.time() + 30, time.time() + 30))
+        new_url = _django_static.staticfile('/cached.js')
+        self.assertNotEqual(new_url, url)
+
+        # combinations are too, however they're written in the template
+        open(settings.MEDIA_ROOT + '/cached2.js', 'w').write('var b = 1;\n')
+        url = _django_static.staticfile(['/cached.js', '/cached2.js'])
+        self.assertEqual(
+          _django_static._url_cache['/cached.js;/cached2.js'][1], url)
+        template = Template('{% load django_static %}'
+                            '{% staticfile "/cached.js; /cached2.js" %}')
+        old_memoized_static_file = _django_static._memoized_static_file
+        def memoized_static_file(*args, **kwargs):
+            raise AssertionError("not taken from the URL cache")
+        _django_static._memoized_static_file = memoized_static_file
+        try:
+            self.assertEqual(template.render(Context()), url)
+        finally:
+            _django_static._memoized_static_file = old_memoized_static_file
+        settings.DJANGO_STATIC_MEDIA_URL = '//cdn2'
+        _django_static._reset_config()
+        self.assertTrue(_django_static.staticfile('/cached.js').startswith('//cdn2/'))
+
+    def test_builtin_js_minifier_corpus(self):
+        """what the built-in JavaScript minifier makes of a small corpus
+        does the same as the original when run (by node, if it's installed)
+        and parses"""
+        from distutils.spawn import find_executable
+        from subprocess import Popen, PIPE
+        node = find_executable('node') or find_executable('nodejs')
+        if node is None:
+            return
+        minify_js = _django_static._minify.minify_js
+
+        # each is the body of a function whose result is compared
+        corpus = [
+          # automatic semicolon insertion
+          u"var a = 1\nvar b = a\n++a\nreturn [a, b]",
+          u"function f() {\n    return\n        1\n}\nreturn f()",
+          u"var a = 8, b = 2, g = 2\nreturn a\n/b/g",
+          u"var a = 1, b = 2\nvar c = a\n+b\nreturn c",
+          u"var i = 0\ni\n++\ni\nreturn i",
+          u"var x = [1]\nvar y = x\n[0]\nreturn y",
+          # regular expressions or divisions
+          u"var a = {'return': 12, 'typeof': 6, 'in': 3, 'delete': 4}\n"
+          u"return [a.return / 2 / 3, a.typeof / 2 / 1, a . in / 3 / 1,\n"
+          u"        a?.delete / 2 / 2, a.return / 2 + '  /  ']",
+          u"var g = 2, i = 1; return [4 / g / i, 4/g/i, (4) / 2 / 1]",
+          u"return [/=/.test('a=b'), 'a/b'.replace(/\\//g, ''),\n"
+          u"        /[/]/.source, typeof /x/, /x/ instanceof RegExp]",
+          u"var a = 3; a++ / 2; return [a++ / 2, a-- / 1 / 1, -a / -1]",
+          u"var x = 1; x /= 2; return [x, 1 / /2/.source]",
+          u"return [/x/ in {'/x/': 1}, void /x/, [...void 0 || []]]",
+          u"function* f() { yield /a/g.source; yield 4 / 2 }\n"
+          u"return [...f()]",
+          u"switch (1) { case /1/.test('1') ? 1 : 0: return 'regex' }",
+          u"var a = 4, b = 2\nreturn a + +b - -b + - -a / + +b",
+          # comments and strings
+          u"/*! keep me */\nreturn 1 // comment",
+          u"return 'a // b /* c */' + \"d \\\" e // f\" + '\\\\'",
+          u"/* a comment\n * over lines */ return `x ${1 + `// ${2}`} y`",
+          u"var a = 1 /* between */ - /* and */ 1; return a",
+          u"return '<!--' + 1 < !-1",
+          u"var été = 1; return été + 1 .toString()",
+        ]
+        minified = [minify_js(x) for x in corpus]
+        self.assertTrue(minified[15].startswith(u'/*! keep me */'))
+        # and some whole libraries, which are only parsed
+        libraries = []
+        for filename in ('jquery-1.3.2.min.js', 'script.js', 'canbe.js'):
+            libraries.append(minify_js(codecs.open(
+              os.path.join(os.path.dirname(__file__), '..', 'media',
+                           'javascript', filename), 'r', 'utf-8').read()))
+
+        script = (
+          "var input = JSON.parse(require('fs').readFileSync(0, 'utf8'));\n"
+          "function run(body, call) {\n"
+          "  try {\n"
+          "    var f = new Function(body);\n"
+          "    return call ? JSON.stringify(f()) : 'parsed';\n"
+          "  } catch (e) {\n"
+          "    return e.name;\n"
+          "  }\n"
+          "}\n"
+          "console.log(JSON.stringify({\n"
+          "  corpus: input.corpus.map(function (x) {\n"
+          "    return [run(x[0], true), run(x[1], true)]; }),\n"
+          "  libraries: input.libraries.map(function (x) {\n"
+          "    return run(x, false); })\n"
+          "}));\n")
+        proc = Popen([node, '-e', script], stdin=PIPE, stdout=PIPE)
+        out = proc.communicate(json.dumps({
+          'corpus': zip(corpus, minified), 'libraries': libraries}))[0]
+        results = json.loads(out)
+        for code, new_code, (expected, result) in \
+          zip(corpus, minified, results['corpus']):
+            self.assertFalse(expected in ('SyntaxError', 'ReferenceError'),
+                             code)
+            self.assertEqual(result, expected,
+                             "%r became %r" % (code, new_code))
+        self.assertEqual(results['libraries'], ['parsed'] * len(libraries))
+
+    def test_builtin_css_minifier(self):
+        """the built-in CSS minifier rewrites the references as it minifies"""
+        minify_css = _django_static._minify.minify_css
+        self.assertEqual(minify_css(u"""
+            /*! license */
+            /* url(commented.png) */
+            a:hover , p  > b {
+                color : red ! important ;
+                content: "url(string.png) ;  }";
+            }
+            @media screen { div :first-child { margin : 0 ; } }
+        """), u'/*! license */a:hover,p>b{color:red!important;'
+              u'content:"url(string.png) ;  }"}'
+              u'@media screen{div :first-child{margin:0}}')
+
+        settings.DEBUG = False
+        settings.DJANGO_STATIC_CSS_OPTIMIZER = 'builtin'
+        _django_static._reset_config()
+        self.assertEqual(_django_static._optimizer('css'), 'builtin')
+
+        os.mkdir(settings.MEDIA_ROOT + '/css')
+        open(settings.MEDIA_ROOT + '/css/sub.css', 'w').write('b { color : blue }')
+        open(settings.MEDIA_ROOT + '/css/icon.gif', 'wb').write(
+          _GIF_CONTENT.decode('base64'))
+        open(settings.MEDIA_ROOT + '/css/main.css', 'w').write("""
+            @import "sub.css";
+            a { background : url( 'icon.gif' ) }
+            i { background: url(data:image/gif;base64,R0lGODlh) }
+        """)
+        new_filename = _django_static.slimfile('/css/main.css')
+        content = open(settings.MEDIA_ROOT + new_filename).read()
+        self.assertTrue(re.findall(
+          r'^@import "/css/sub\.\d+\.css";'
+          r"a\{background:url\('/css/icon\.\d+\.gif'\)\}"
+          r'i\{background:url\(data:image/gif;base64,R0lGODlh\)\}$', content),
+          content)
+        sub_filename = re.findall('/css/sub\.\d+\.css', content)[0]
+        self.assertEqual(open(settings.MEDIA_ROOT + sub_filename).read(),
+                         'b{color:blue}')
+
+        settings.DJANGO_STATIC_CSS_OPTIMIZER = 'nonexistant'
+        _django_static._reset_config()
+        self.assertRaises(ValueError, _django_static.has_optimizer, 'css')
+
+    def test_builtin_js_minifier(self):
+        """the built-in JavaScript minifier tells regular expressions from
+        divisions and keeps the line breaks semicolons might depend on"""
+        minify_js = _django_static._minify.minify_js
+        self.assertEqual(minify_js(u"""
+            /*! license */
+            var a = b / 2 / c, re = /[/]\//g.test( "x" ) ; // comment "
+            var s = 'it\\'s // not a comment' , t = `x ${ y + `//${ z }` } w` ;
+            function f ( ) {
+                return
+                    a + +b - -c
+            }
+            x = a++ / 2
+            if ( /x/ in y ) { }
+            i = 1 .toString ( )
+        """), u'/*! license */'
+              u'var a=b/2/c,re=/[/]\\//g.test("x");'
+              u"var s='it\\'s // not a comment',t=`x ${y+`//${z}`} w`;"
+              u'function f(){return\na+ +b- -c}\n'
+              u'x=a++/2\n'
+              u'if(/x/ in y){}\n'
+              u'i=1 .toString()')
+        # a keyword as a property name is just a name
+        self.assertEqual(minify_js(u"x = a.return / 2 + '  /  '"),
+                         u"x=a.return/2+'  /  '")
+
+        # minifying something that's already minified changes nothing
+        jquery = codecs.open(os.path.join(os.path.dirname(__file__), '..',
+                                          'media', 'javascript',
+                                          'jquery-1.3.2.min.js'),
+                             'r', 'utf-8').read()
+        minified = minify_js(jquery)
+        self.assertTrue(len(minified) < len(jquery))
+        self.assertEqual(minify_js(minified), minified)
+
+        settings.DEBUG = False
+        settings.DJANGO_STATIC_JS_OPTIMIZER = 'builtin'
+        _django_static._reset_config()
+        self.assertEqual(_django_static._optimizer('js'), 'builtin')
+        open(settings.MEDIA_ROOT + '/builtin.js', 'w').write(
+          'function add ( a , b ) {\n  // add them\n  return a + b ;\n}\n')
+        new_filename = _django_static.slimfile('/builtin.js')
+        self.assertEqual(open(settings.MEDIA_ROOT + new_filename).read(),
+                         'function add(a,b){return a+b;}')
+
+    def test_adaptive_optimizer(self):
+        """the adaptive policy picks the quickest optimizer that makes files
+        of that size small enough"""
+        from django_static import stats
+        stats.reset()
+        settings.DJANGO_STATIC_OPTIMIZER_POLICY = 'adaptive'
+        settings.DJANGO_STATIC_OPTIMIZER_TARGET = 0.3
+        settings.DJANGO_STATIC_YUI_COMPRESSOR = 'yui.jar'
+        _django_static._reset_config()
+        self.assertTrue(_django_static.has_optimizer('css'))
+        candidates = _django_static._candidate_optimizers('css')
+        self.assertTrue('yui_compressor' in candidates)
+        self.assertEqual(candidates[-1], 'builtin')
+
+        # every one is tried once for every size of file first
+        chosen = []
+        for optimizer in candidates:
+            chosen.append(_django_static._adaptive_optimizer('css', 1000))
+            if optimizer == 'yui_compressor':
+                stats.optimizer_costs.record('css', optimizer, 1000, 1.0, 800)
+            else:
+                stats.optimizer_costs.record('css', optimizer, 1000, 0.001, 900)
+        self.assertEqual(chosen, candidates)
+
+        # when none make it 30% smaller the one that makes it smallest...
+        self.assertEqual(_django_static._adaptive_optimizer('css', 1000),
+                         'yui_compressor')
+        # ...and otherwise the quickest one that does
+        stats.optimizer_costs.record('css', 'builtin', 1000, 0.001, 0)
+        stats.optimizer_costs.record('css', 'yui_compressor', 1000, 1.0, 0)
+        self.assertEqual(_django_static._adaptive_optimizer('css', 1000),
+                         'builtin')
+        # which is worked out separately for bigger files
+        self.assertEqual(_django_static._adaptive_optimizer('css', 100000),
+                         candidates[0])
+
+        # and it really is used
+        settings.DJANGO_STATIC_YUI_COMPRESSOR = None
+        _django_static._reset_config()
+        stats.reset()
+        open(settings.MEDIA_ROOT + '/adaptive.css', 'w').write(
+          'a { color : red }\n' * 10)
+        for optimizer in _django_static._candidate_optimizers('css'):
+            stats.optimizer_costs.record('css', optimizer, 180, 1.0, 180)
+        stats.optimizer_costs.record('css', 'builtin', 180, 0.0, 20)
+        new_filename = _django_static.slimfile('/adaptive.css')
+        self.assertEqual(open(settings.MEDIA_ROOT + new_filename).read(),
+                         'a{color:red}' * 10)
+        optimizers = _django_static.get_stats()['optimizers']
+        self.assertEqual(optimizers['css']['4096']['builtin']['chosen'], 1)
+        self.assertEqual(optimizers['css']['4096']['builtin']['count'], 3)
+
+        settings.DJANGO_STATIC_OPTIMIZER_POLICY = 'wrong'
+        _django_static._reset_config()
+        self.assertRaises(ValueError, _django_static.optimize, u'', 'css')
+        stats.reset()
+
+    def test_optimizer_timeout(self):
+        """a stuck optimizer is killed and the built-in one used instead and
+        after too many failures it isn't tried for a while"""
+        from django_static import stats
+        stats.reset()
+        settings.DJANGO_STATIC_YUI_COMPRESSOR = 'yui.jar'
+        settings.DJANGO_STATIC_OPTIMIZER_TIMEOUT = 0.5
+        settings.DJANGO_STATIC_OPTIMIZER_FAILURES = 2
+        _django_static._reset_config()
+        old_template = _django_static.YUI_COMMAND_TEMPLATE
+        # (the sleep is started by the shell so the whole group has to go)
+        _django_static.YUI_COMMAND_TEMPLATE = \
+          "sleep 30; cat # %(jarfile)s %(type)s"
+        try:
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                for i in range(3):
+                    t0 = time.time()
+                    content = _django_static.optimize(
+                      u'a { color : red }', 'css', 'yui_compressor')
+                    self.assertTrue(time.time() - t0 < 5)
+                    self.assertEqual(content, u'a{color:red}')
+            self.assertEqual(len(caught), 2)
+            self.assertTrue('Killed after 0.5 seconds' in str(caught[0].message))
+            counters = stats.snapshot()['counters']
+            self.assertEqual(counters['optimize_failed_yui_compressor'], 2)
+            self.assertEqual(counters['optimize_skipped_yui_compressor'], 1)
+            self.assertEqual(counters['optimize_builtin'], 3)
+
+            # or the content is left as it is
+            settings.DJANGO_STATIC_OPTIMIZER_FALLBACK = None
+            _django_static._reset_config()
+            with warnings.catch_warnings(record=True):
+                warnings.simplefilter('always')
+                self.assertEqual(_django_static.optimize(
+                  u'a { color : red }', 'css', 'yui_compressor'),
+                  u'a { color : red }')
+        finally:
+            _django_static.YUI_COMMAND_TEMPLATE = old_template
+            stats.reset()
+
+    def test_build_command_batches_closure_compiler(self):
+        """django_static_build compiles all the Javascript files in as few
+        runs of the Closure Compiler as possible"""
+        from django.core.management import call_command
+        from django_static import stats
+        stats.reset()
+        settings.DEBUG = False
+        settings.DJANGO_STATIC_CLOSURE_COMPILER = 'compiler.jar'
+        settings.DJANGO_STATIC_CLOSURE_BATCH_SIZE = 2
+        _django_static._reset_config()
+
+        # something that works like the compiler with chunks
+        directory = self._mkdir()
+        compiler = os.path.join(directory, 'compiler.py')
+        runs = os.path.join(directory, 'runs')
+        open(compiler, 'w').write(
+          "import sys\n"
+          "args = sys.argv[1:]\n"
+          "open(%r, 'a').write('run\\n')\n"
+          "prefix = args[args.index('--chunk_output_path_prefix') + 1]\n"
+          "inputs = [args[i + 1] for i, x in enumerate(args) if x == '--js']\n"
+          "chunks = [args[i + 1] for i, x in enumerate(args) if x == '--chunk']\n"
+          "for filepath, chunk in zip(inputs, chunks):\n"
+          "    open(prefix + chunk.split(':')[0] + '.js', 'w')"
+          ".write(open(filepath).read().upper())\n" % runs)
+        old_templates = (_django_static.CLOSURE_BATCH_COMMAND_TEMPLATE,
+                         _django_static.CLOSURE_COMMAND_TEMPLATE)
+        _django_static.CLOSURE_BATCH_COMMAND_TEMPLATE = \
+          '%s %s %%(arguments)s' % (sys.executable, compiler)
+        # (which would give an empty file)
+        _django_static.CLOSURE_COMMAND_TEMPLATE = 'true %(jarfile)s'
+
+        filenames = []
+        for name in ('a', 'b', 'c'):
+            open(settings.MEDIA_ROOT + '/%s.js' % name, 'w').write(
+              'var %s = 1;' % name)
+            filenames.append('/%s.js' % name)
+        open(settings.MEDIA_ROOT + '/d.css', 'w').write('d { color : red }')
+        filenames.append('/d.css')
+        from django.core.management.base import CommandError
+        # nothing would know what has been built
+        self.assertRaises(CommandError, call_command, 'django_static_build',
+                          all=True, verbosity=0)
+        snapshot = os.path.join(directory, 'snapshot.json')
+        settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT = snapshot
+        try:
+            out = StringIO()
+            call_command('django_static_build', all=True, verbosity=2,
+                         stdout=out)
+        finally:
+            settings.DJANGO_STATIC_FILE_MAP_SNAPSHOT = None
+            (_django_static.CLOSURE_BATCH_COMMAND_TEMPLATE,
+             _django_static.CLOSURE_COMMAND_TEMPLATE) = old_templates
+        self.assertTrue('Built 4 files' in out.getvalue())
+        self.assertEqual(sorted(json.loads(open(snapshot).read())['files']),
+                         ['/a.js', '/b.js', '/c.js', '/d.css'])
+
+        self.assertEqual(open(runs).read(), 'run\nrun\n')
+        counters = stats.snapshot()['counters']
+        self.assertEqual(counters['optimize_batch_closure_compiler'], 2)
+        self.assertEqual(counters['optimize_batched_closure_compiler'], 3)
+        self.assertFalse(_django_static._optimized)
+        for name in ('a', 'b', 'c'):
+            new_filename = _django_static._FILE_MAP['/%s.js' % name][0]
+            self.assertEqual(open(settings.MEDIA_ROOT + new_filename).read(),
+                             'VAR %s = 1;' % name.upper())
+        self.assertTrue(_django_static._FILE_MAP['/d.css'][0])
+        stats.reset()
+
+    def test_processor_pipeline(self):
+        """with DJANGO_STATIC_PROCESSORS the files are run through the
+        processors configured for their extension and, with
+        DJANGO_STATIC_PROCESSOR_CACHE, only the ones whose input or config
+        changed are run again"""
+        from django_static import stats
+        stats.reset()
+        settings.DEBUG = False
+        settings.DJANGO_STATIC_CSS_OPTIMIZER = 'builtin'
+        settings.DJANGO_STATIC_PROCESSOR_CACHE = self._mkdir()
+
+        def configure(separator):
+            settings.DJANGO_STATIC_PROCESSORS = {
+              '.css': [
+                'django_static.tests.counting_processor',
+                'django_static.processors.strip_banners',
+                ('django_static.processors.join', {'separator': separator}),
+                'django_static.processors.autoprefix',
+                'django_static.processors.optimize',
+                'django_static.processors.rewrite_urls',
+              ],
+            }
+            _django_static._reset_config()
+            _django_static._FILE_MAP = _django_static.BoundedFileMap(
+              settings.DJANGO_STATIC_FILE_MAP_SIZE)
+
+        open(settings.MEDIA_ROOT + '/pipe.gif', 'w').write(_GIF_CONTENT)
+        open(settings.MEDIA_ROOT + '/pipe1.css', 'w').write(
+          '/* Copyright nobody */\n/*! keep me */\n'
+          'a { user-select : none; background: url(pipe.gif) }')
+        open(settings.MEDIA_ROOT + '/pipe2.css', 'w').write('b { color : red }')
+        template = Template("""{% load django_static %}
+        {% slimall %}
+        <link href="/pipe1.css" rel="stylesheet">
+        <link href="/pipe2.css" rel="stylesheet">
+        {% endslimall %}""")
+
+        def render():
+            rendered = template.render(Context())
+            new_filename = re.findall('href="([^"]+)"', rendered)[0]
+            return open(settings.MEDIA_ROOT + new_filename).read()
+
+        configure(u'\n')
+        del _processed[:]
+        content = render()
+        self.assertFalse('Copyright' in content)
+        self.assertTrue(content.startswith('/*! keep me */'))
+        self.assertTrue('a{-webkit-user-select:none;-moz-user-select:none;'
+                        '-ms-user-select:none;user-select:none;'
+                        'background:url(/pipe.' in content)
+        self.assertTrue(content.endswith('b{color:red}'))
+        # it's run on each file before they're joined
+        self.assertEqual(len(_processed), 2)
+
+        # changing the separator only runs what comes after the join again
+        configure(u'\n/* next */\n')
+        del _processed[:]
+        stats.reset()
+        content = render()
+        self.assertEqual(_processed, [])
+        counters = stats.snapshot()['counters']
+        # counting_processor and strip_banners for both files
+        self.assertEqual(counters['processor_cache_hit'], 4)
+        # join, autoprefix and optimize (but not rewrite_urls)
+        self.assertEqual(counters['processor_cache_miss'], 3)
+        self.assertTrue('background:url(/pipe.' in content)
+
+        # without a cache everything is run every time
+        settings.DJANGO_STATIC_PROCESSOR_CACHE = None
+        configure(u'\n')
+        del _processed[:]
+        render()
+        self.assertEqual(len(_processed), 2)
+        stats.reset()
+
+    def test_serve_view(self):
+        """django_static.views.serve sends generated files as immutable,
+        answers conditional requests without the file, negotiates .gz
+        copies and supports byte ranges"""
+        import gzip
+        from django.http import Http404
+        from django.test.client import RequestFactory
+        from django_static import views
+        views._assets.clear()
+        factory = RequestFactory()
+
+        def content(response):
+            return ''.join(response.streaming_content)
+
+        open(settings.MEDIA_ROOT + '/served.js', 'w').write('var a = 1;')
+        settings.DEBUG = False
+        new_filename = _django_static.staticfile('/served.js')
+        self.assertNotEqual(new_filename, '/served.js')
+        new_filepath = settings.MEDIA_ROOT + new_filename
+        g = gzip.open(new_filepath + '.gz', 'wb')
+        g.write('var a = 1;')
+        g.close()
+
+        response = views.serve(factory.get(new_filename), new_filename)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(content(response), 'var a = 1;')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertTrue('immutable' in response['Cache-Control'])
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        etag = response['ETag']
+
+        response = views.serve(
+          factory.get(new_filename, HTTP_ACCEPT_ENCODING='deflate, gzip'),
+          new_filename)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(content(response)))
+                         .read(), 'var a = 1;')
+        response = views.serve(
+          factory.get(new_filename, HTTP_ACCEPT_ENCODING='gzip;q=0'),
+          new_filename)
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+        response = views.serve(factory.get(new_filename, HTTP_RANGE='bytes=4-'),
+                               new_filename)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 4-9/10')
+        self.assertEqual(content(response), 'a = 1;')
+        response = views.serve(factory.get(new_filename, HTTP_RANGE='bytes=-2'),
+                               new_filename)
+        self.assertEqual(content(response), '1;')
+        response = views.serve(factory.get(new_filename,
+                                           HTTP_RANGE='bytes=10-'),
+                               new_filename)
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+
+        response = views.serve(factory.head(new_filename), new_filename)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(response.content, '')
+        response = views.serve(factory.post(new_filename), new_filename)
+        self.assertEqual(response.status_code, 405)
+
+        # what's known about a generated file is kept so a conditional
+        # request doesn't need it
+        os.remove(new_filepath)
+        response = views.serve(
+          factory.get(new_filename, HTTP_IF_NONE_MATCH=etag), new_filename)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        response = views.serve(
+          factory.get(new_filename,
+                      HTTP_IF_MODIFIED_SINCE=response['Last-Modified']),
+          new_filename)
+        self.assertEqual(response.status_code, 304)
+        # ...but if it's gone when it's needed that's a 404
+        self.assertRaises(Http404, views.serve, factory.get(new_filename),
+                          new_filename)
+
+        # files that aren't generated can change
+        response = views.serve(factory.get('/served.js'), '/served.js')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=0')
+        self.assertFalse(response.has_header('Vary'))
+        open(settings.MEDIA_ROOT + '/served.js', 'w').write('var b = 22;')
+        response = views.serve(factory.get('/served.js'), '/served.js')
+        self.assertEqual(content(response), 'var b = 22;')
+        # even if they look like they are
+        open(settings.MEDIA_ROOT + '/photo.1300000001.jpg', 'w').write('a')
+        response = views.serve(factory.get('/x'), '/photo.1300000001.jpg')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=0')
+        open(settings.MEDIA_ROOT + '/photo.1300000001.jpg', 'w').write('bb')
+        response = views.serve(factory.get('/x'), '/photo.1300000001.jpg')
+        self.assertEqual(content(response), 'bb')
+        # but everything in DJANGO_STATIC_SAVE_PREFIX is
+        settings.DJANGO_STATIC_SAVE_PREFIX = settings.MEDIA_ROOT
+        views._assets.clear()
+        response = views.serve(factory.get('/x'), '/photo.1300000001.jpg')
+        self.assertTrue('immutable' in response['Cache-Control'])
+        settings.DJANGO_STATIC_SAVE_PREFIX = ''
+
+        self.assertRaises(Http404, views.serve, factory.get('/x'),
+                          '../%s/served.js' % os.path.basename(
+                            settings.MEDIA_ROOT))
+        self.assertRaises(Http404, views.serve, factory.get('/x'), '/nothere.js')
+        # nor hidden files
+        open(settings.MEDIA_ROOT + '/.django_static_gc.json', 'w').write('{}')
+        os.mkdir(settings.MEDIA_ROOT + '/.hidden')
+        open(settings.MEDIA_ROOT + '/.hidden/a.js', 'w').write('')
+        open(settings.MEDIA_ROOT + '/manifest.json.lock', 'w').write('')
+        for path in ('/.django_static_gc.json', '/.hidden/a.js',
+                     '/%2Edjango_static_gc.json', '/manifest.json.lock'):
+            self.assertRaises(Http404, views.serve, factory.get('/x'), path)
+        views._assets.clear()
 
 # These have to be mutable so that we can record that they have been used as
 # global variables.
 _last_fake_file_uri = None
 _last_fake_file_keyword_arguments = None
 
+# the contents counting_processor has been run on
+_processed = []
+
+def counting_processor(content, context):
+    _processed.append(content)
+    return content
+
 def fake_file_proxy(uri, **k):
     # reset the global mutables used to check that file_proxy() was called
     global _last_fake_file_uri
@@ -2207,3 +3891,7 @@ def fake_file_proxy(uri, **k):
     _last_fake_file_uri = uri
     _last_fake_file_keyword_arguments = k
     return uri
+
+_stats_callback_events = []
+def stats_callback(event, key, phase=None, duration=None):
+    _stats_callback_events.append((event, key))
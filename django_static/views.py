@@ -1 +1,295 @@
-# Create your views here.
+"""A view that serves the files django_static generates (and any others in
+DJANGO_STATIC_MEDIA_ROOTS), e.g. in development or when there's nothing in
+front of Django to do it:
+
+    urlpatterns += patterns('',
+        url(r'^static/(?P<path>.*)$', 'django_static.views.serve'),
+    )
+
+The generated files have the timestamp in their name so their content never
+changes. They're sent with a far-future `Cache-Control: immutable` and what's
+known about them (where they are, their size, ETag and content type) is
+looked up once and kept so that a conditional request for one is answered
+with a 304 without touching the filesystem. Other files, including those that
+only look generated (e.g. an upload called photo.1300000001.jpg), are stat'ed
+on every request. A file is taken to be generated if it's in
+DJANGO_STATIC_SAVE_PREFIX or the file map, the manifest or the snapshot
+refers to it.
+
+If there's a gzipped copy of a file next to it (e.g. screen.1234567890.css.gz)
+that's sent instead to clients that accept gzip. A single byte range
+(`Range: bytes=...`) is supported too.
+"""
+import os
+import re
+import stat
+import mimetypes
+import posixpath
+from collections import namedtuple
+from urllib import unquote
+from wsgiref.util import FileWrapper
+
+from django.conf import settings
+from django.http import (Http404, HttpResponse, HttpResponseNotAllowed,
+                         HttpResponseNotModified, StreamingHttpResponse)
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+try:
+    # Django 1.8 and later
+    from django.http import FileResponse
+except ImportError:
+    FileResponse = None
+
+# (for the default settings)
+from django_static.templatetags import django_static as _django_static
+
+
+TIMESTAMPED_REGEX = re.compile('\.(\d{10})\.')
+
+# a year, which is as long as caches are allowed to keep anything
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+CACHE_CONTROL = 'public, max-age=0'
+
+CHUNK_SIZE = 64 * 1024
+
+_RANGE_REGEX = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# what django_static keeps next to the files that isn't for serving
+_PRIVATE_NAMES = frozenset(['manifest.json.lock'])
+
+_Variant = namedtuple('_Variant', 'filepath size m_time etag')
+_Asset = namedtuple('_Asset', 'plain gzipped content_type immutable')
+
+class _AssetMap(_django_static.BoundedFileMap):
+    """(document root or None, path) -> _Asset"""
+
+    def _compact_value(self, value):
+        return value
+
+_assets = _AssetMap(settings.DJANGO_STATIC_FILE_MAP_SIZE)
+
+
+def _variant(filepath, suffix=''):
+    try:
+        stat_result = os.stat(filepath)
+    except OSError:
+        return None
+    if not stat.S_ISREG(stat_result.st_mode):
+        return None
+    m_time = int(stat_result.st_mtime)
+    size = stat_result.st_size
+    return _Variant(filepath, size, m_time,
+                    '"%x-%x%s"' % (m_time, size, suffix))
+
+
+def _clean_path(path):
+    """return the path relative to the document root or raise Http404 if
+    it tries to get out of it or to a hidden file (e.g. the garbage
+    collector's state, lock files or temporary files)"""
+    path = posixpath.normpath(unquote(path)).lstrip('/')
+    parts = path.split('/')
+    if not path or parts[-1] in _PRIVATE_NAMES or \
+      [x for x in parts if x.startswith('.') or
+       os.path.splitdrive(x)[0] or '\\' in x]:
+        raise Http404("%r can't be served" % path)
+    return path
+
+
+def _immutable(path, root):
+    if not TIMESTAMPED_REGEX.search(path):
+        return False
+    if settings.DJANGO_STATIC_SAVE_PREFIX and \
+      os.path.abspath(root) == \
+      os.path.abspath(settings.DJANGO_STATIC_SAVE_PREFIX):
+        # (only generated files are put there)
+        return True
+    return _django_static._is_generated(settings.DJANGO_STATIC_NAME_PREFIX +
+                                        '/' + path)
+
+
+def _find(path, document_root):
+    if document_root is not None:
+        roots = [document_root]
+    elif settings.DJANGO_STATIC_SAVE_PREFIX:
+        roots = [settings.DJANGO_STATIC_SAVE_PREFIX]
+    else:
+        roots = settings.DJANGO_STATIC_MEDIA_ROOTS
+    for root in roots:
+        plain = _variant(os.path.join(root, path))
+        if plain is not None:
+            content_type, encoding = mimetypes.guess_type(path)
+            if encoding:
+                # e.g. a .tar.gz, which is sent as it is
+                content_type = 'application/octet-stream'
+            return _Asset(plain, _variant(plain.filepath + '.gz', '-gz'),
+                          content_type or 'application/octet-stream',
+                          _immutable(path, root))
+    return None
+
+
+def _lookup(path, document_root):
+    key = (document_root, path)
+    asset = _assets.get(key)
+    if asset is not None and not asset.immutable:
+        # it can change so check that it hasn't
+        plain = _variant(asset.plain.filepath)
+        gzipped = asset.gzipped and _variant(asset.gzipped.filepath, '-gz')
+        if plain != asset.plain or gzipped != asset.gzipped:
+            asset = None
+    if asset is None:
+        asset = _find(path, document_root)
+        if asset is None:
+            _assets.pop(key, None)
+            raise Http404("%r doesn't exist" % path)
+        _assets[key] = asset
+    return asset
+
+
+def _accepts_gzip(accept_encoding):
+    for coding in accept_encoding.split(','):
+        parts = coding.split(';')
+        if parts[0].strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        for parameter in parts[1:]:
+            name, _, value = parameter.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def _not_modified(request, variant):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        # (a weak comparison is fine for GET and HEAD)
+        etags = [x.strip() for x in if_none_match.split(',')]
+        return '*' in etags or variant.etag in etags or \
+          'W/' + variant.etag in etags
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since is not None:
+        return not was_modified_since(if_modified_since, variant.m_time,
+                                      variant.size)
+    return False
+
+
+def _byte_range(request, variant):
+    """return (start, end) of the range asked for, None for all of it or
+    False if it can't be satisfied"""
+    header = request.META.get('HTTP_RANGE')
+    if not header:
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range.strip() not in (variant.etag,
+                                             http_date(variant.m_time)):
+        # it has changed since the client got the first part
+        return None
+    match = _RANGE_REGEX.match(header.strip())
+    if match is None:
+        # e.g. several ranges, which aren't worth supporting
+        return None
+    first, last = match.groups()
+    size = variant.size
+    if first:
+        start = int(first)
+        end = size - 1
+        if last:
+            if int(last) < start:
+                return None
+            end = min(int(last), end)
+    elif last:
+        start = max(size - int(last), 0)
+        end = size - 1
+    else:
+        return None
+    if start > end:
+        return False
+    return start, end
+
+
+def _read_range(f, start, length):
+    try:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def _set_headers(response, asset, variant):
+    response['ETag'] = variant.etag
+    response['Last-Modified'] = http_date(variant.m_time)
+    if asset.immutable:
+        response['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    else:
+        response['Cache-Control'] = CACHE_CONTROL
+    if asset.gzipped is not None:
+        response['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def serve(request, path, document_root=None):
+    """serve the file `path` from `document_root` or, by default,
+    DJANGO_STATIC_SAVE_PREFIX or else the first of DJANGO_STATIC_MEDIA_ROOTS
+    that has it"""
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    path = _clean_path(path)
+    asset = _lookup(path, document_root)
+
+    variant = asset.plain
+    if asset.gzipped is not None and \
+      _accepts_gzip(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+        variant = asset.gzipped
+
+    if _not_modified(request, variant):
+        return _set_headers(HttpResponseNotModified(), asset, variant)
+
+    byte_range = _byte_range(request, variant)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % variant.size
+        return _set_headers(response, asset, variant)
+
+    if request.method == 'HEAD':
+        f = None
+    else:
+        try:
+            f = open(variant.filepath, 'rb')
+        except IOError:
+            # e.g. deleted by django_static_gc
+            _assets.pop((document_root, path), None)
+            raise Http404("%r doesn't exist" % path)
+
+    if byte_range is not None:
+        start, end = byte_range
+        length = end - start + 1
+        if f is None:
+            content = []
+        else:
+            content = _read_range(f, start, length)
+        response = StreamingHttpResponse(content, status=206,
+                                         content_type=asset.content_type)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end,
+                                                        variant.size)
+    else:
+        length = variant.size
+        if f is None:
+            response = HttpResponse(content_type=asset.content_type)
+        elif FileResponse is not None:
+            # which the WSGI server can send with its wsgi.file_wrapper
+            response = FileResponse(f, content_type=asset.content_type)
+        else:
+            response = StreamingHttpResponse(FileWrapper(f, CHUNK_SIZE),
+                                             content_type=asset.content_type)
+    response['Content-Length'] = str(length)
+    response['Accept-Ranges'] = 'bytes'
+    if variant is asset.gzipped:
+        response['Content-Encoding'] = 'gzip'
+    return _set_headers(response, asset, variant)
@@ -24,6 +24,8 @@ setup(
       packages=[
         'django_static',
         'django_static.templatetags',
+        'django_static.management',
+        'django_static.management.commands',
         ],
       classifiers=[
         'Development Status :: 5 - Production/Stable',